@@ -13,4 +13,15 @@ from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'config.settings')
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+from orders.async_pipeline import lifespan  # noqa: E402  (needs the app registry)
+
+
+async def application(scope, receive, send):
+    # Django only speaks HTTP; the lifespan events let the async pipeline finish (or hand
+    # back) its in-flight messages when gunicorn recycles or stops this worker
+    if scope['type'] == 'lifespan':
+        await lifespan(receive, send)
+    else:
+        await django_application(scope, receive, send)
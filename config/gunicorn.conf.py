@@ -0,0 +1,57 @@
+"""
+gunicorn settings for the production profile (DJANGO_ENV=production).
+
+    gunicorn -c config/gunicorn.conf.py
+
+Workers are sized from the CPU count; override anything via env (WEB_CONCURRENCY,
+GUNICORN_THREADS, GUNICORN_BIND, ...). GUNICORN_ASGI=1 serves config.asgi with
+uvicorn workers instead of config.wsgi with threads.
+"""
+
+import multiprocessing
+import os
+import shutil
+
+bind = os.environ.get('GUNICORN_BIND', '0.0.0.0:8000')
+cores = multiprocessing.cpu_count()
+
+if os.environ.get('GUNICORN_ASGI', '0') == '1':
+    # ASGI: needed for the async webhook (/webhooks/telegram/async/). Each uvicorn
+    # worker is an event loop, so one per core (+1) keeps the CPUs busy.
+    wsgi_app = 'config.asgi:application'
+    worker_class = 'uvicorn_worker.UvicornWorker'
+    workers = int(os.environ.get('WEB_CONCURRENCY', cores + 1))
+else:
+    # WSGI with threads: the fast-ack webhook is a short DB write, and a thread per
+    # request avoids the async->sync hop Django does for sync views under ASGI.
+    wsgi_app = 'config.wsgi:application'
+    worker_class = 'gthread'
+    workers = int(os.environ.get('WEB_CONCURRENCY', cores * 2 + 1))
+    threads = int(os.environ.get('GUNICORN_THREADS', 4))
+
+# Telegram retries a webhook that doesn't answer quickly; the webhook only writes one row
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 30))
+graceful_timeout = 30
+keepalive = 5
+
+# Recycle workers now and then (bounded memory growth); jitter avoids restarting all at once
+max_requests = int(os.environ.get('GUNICORN_MAX_REQUESTS', 5000))
+max_requests_jitter = 500
+
+# Not preloaded: every worker must open its own DB pool after the fork
+preload_app = False
+
+# One /metrics/ target for all workers: prometheus_client's multiprocess mode keeps each
+# worker's values here and any of them serves the sum (orders/metrics.py). Emptied at
+# startup, so the counters restart with the server.
+metrics_dir = os.environ.setdefault('PROMETHEUS_MULTIPROC_DIR', '/tmp/orders-metrics')
+
+
+def on_starting(server):
+    shutil.rmtree(metrics_dir, ignore_errors=True)
+    os.makedirs(metrics_dir, exist_ok=True)
+
+
+def child_exit(server, worker):
+    from prometheus_client import multiprocess
+    multiprocess.mark_process_dead(worker.pid)
@@ -12,22 +12,33 @@ https://docs.djangoproject.com/en/5.2/ref/settings/
 
 from pathlib import Path
 import os
+from django.core.exceptions import ImproperlyConfigured
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
 
 
-# Quick-start development settings - unsuitable for production
-# See https://docs.djangoproject.com/en/5.2/howto/deployment/checklist/
+# Deployment profile, picked by DJANGO_ENV:
+# - development (default): runserver, DEBUG on, a new DB connection per request
+# - production: gunicorn + uvicorn workers (config/gunicorn.conf.py), DEBUG off,
+#   pooled / persistent DB connections. See docker-compose.prod.yml.
+DJANGO_ENV = os.environ.get('DJANGO_ENV', 'development')
+PRODUCTION = DJANGO_ENV == 'production'
 
 # SECURITY WARNING: keep the secret key used in production secret!
-SECRET_KEY = 'django-insecure-!&(1w!ft9w8umv7)ig(2e^3*lx6g03lf9$e!ra6m#iiwqiaw_4'
+SECRET_KEY = os.environ.get(
+    'DJANGO_SECRET_KEY',
+    'django-insecure-!&(1w!ft9w8umv7)ig(2e^3*lx6g03lf9$e!ra6m#iiwqiaw_4',
+)
+if PRODUCTION and SECRET_KEY.startswith('django-insecure-'):
+    raise ImproperlyConfigured("Set DJANGO_SECRET_KEY when DJANGO_ENV=production.")
 
 # SECURITY WARNING: don't run with debug turned on in production!
-DEBUG = True
+# (DEBUG also keeps every SQL query of a request in memory)
+DEBUG = os.environ.get('DJANGO_DEBUG', '0' if PRODUCTION else '1') == '1'
 
-# Allow all hosts for development (specially since we're using ngrok)
-ALLOWED_HOSTS = ['*']
+# Allow all hosts by default (specially since we're using ngrok)
+ALLOWED_HOSTS = os.environ.get('DJANGO_ALLOWED_HOSTS', '*').split(',')
 
 
 # Application definition
@@ -44,6 +55,8 @@ INSTALLED_APPS = [
 
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
+    # Serves the collected static files (Admin Panel) from gunicorn / uvicorn
+    'whitenoise.middleware.WhiteNoiseMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -86,6 +99,32 @@ DATABASES = {
     }
 }
 
+# Connection reuse (production by default). With psycopg 3 every process keeps a
+# pool of DB_POOL_MAX_SIZE connections (Django's native pool, also safe under ASGI);
+# `process_messages` grows its own pool to its thread count (ORDER_WORKER_CONCURRENCY
+# + main thread + calendar dispatcher + 2 spare) when DB_POOL_MAX_SIZE is smaller;
+# with DB_POOL_MAX_SIZE=0 or psycopg2, connections persist for DB_CONN_MAX_AGE
+# seconds and are health-checked before each reuse.
+try:
+    import psycopg_pool  # noqa: F401
+    DB_POOL_AVAILABLE = True
+except ImportError:
+    DB_POOL_AVAILABLE = False
+
+DB_POOL_MAX_SIZE = int(os.environ.get('DB_POOL_MAX_SIZE', 5 if PRODUCTION else 0))
+
+if DB_POOL_MAX_SIZE and DB_POOL_AVAILABLE:
+    DATABASES['default']['OPTIONS'] = {
+        'pool': {
+            'min_size': int(os.environ.get('DB_POOL_MIN_SIZE', 1)),
+            'max_size': DB_POOL_MAX_SIZE,
+            'timeout': float(os.environ.get('DB_POOL_TIMEOUT_SECONDS', 10)),
+        },
+    }
+else:
+    DATABASES['default']['CONN_MAX_AGE'] = int(os.environ.get('DB_CONN_MAX_AGE', 60 if PRODUCTION else 0))
+    DATABASES['default']['CONN_HEALTH_CHECKS'] = True
+
 
 # Password validation
 # https://docs.djangoproject.com/en/5.2/ref/settings/#auth-password-validators
@@ -122,8 +161,209 @@ USE_TZ = True
 # https://docs.djangoproject.com/en/5.2/howto/static-files/
 
 STATIC_URL = 'static/'
+STATIC_ROOT = BASE_DIR / 'staticfiles'  # manage.py collectstatic (production)
+# WhiteNoise serves STATIC_ROOT; in production the files are gzipped and get hashed
+# names (cacheable forever), which needs collectstatic before the server starts.
+STORAGES = {
+    'default': {'BACKEND': 'django.core.files.storage.FileSystemStorage'},
+    'staticfiles': {
+        'BACKEND': 'whitenoise.storage.CompressedManifestStaticFilesStorage' if PRODUCTION
+        else 'django.contrib.staticfiles.storage.StaticFilesStorage',
+    },
+}
 
 # Default primary key field type
 # https://docs.djangoproject.com/en/5.2/ref/settings/#default-auto-field
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
+
+
+# Cache
+# Shared between the web process and the workers. DatabaseCache tables: the migrations
+# run `createcachetable` (0005, 0014); after adding an alias here, run
+# `python manage.py createcachetable` (or migrate) before starting the servers.
+# Each table is culled by a third once it holds MAX_ENTRIES rows, and every set() counts
+# its rows, so high-churn LLM answers get their own table: they can't evict the
+# customer entries (orders/customer_cache.py) or the agenda pages and generations
+# (orders/agenda.py) kept in 'default'.
+
+CACHE_MAX_ENTRIES = int(os.environ.get('CACHE_MAX_ENTRIES', 20000))
+LLM_CACHE_SHARED_MAX_ENTRIES = int(os.environ.get('LLM_CACHE_SHARED_MAX_ENTRIES', 10000))
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+        'LOCATION': 'orders_cache',
+        # Customers + 1 agenda generation and a few pages per customer
+        'OPTIONS': {'MAX_ENTRIES': CACHE_MAX_ENTRIES},
+    },
+    'llm': {
+        'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+        'LOCATION': 'orders_llm_cache',
+        'OPTIONS': {'MAX_ENTRIES': LLM_CACHE_SHARED_MAX_ENTRIES},
+    },
+}
+
+# LLM parse cache (orders/ai_service.py): in-process LRU of LLM_CACHE_MAX_ENTRIES +
+# the shared 'llm' cache above
+
+LLM_CACHE_ENABLED = os.environ.get('LLM_CACHE_ENABLED', '1') == '1'
+LLM_CACHE_ALIAS = 'llm'
+LLM_CACHE_MAX_ENTRIES = int(os.environ.get('LLM_CACHE_MAX_ENTRIES', 1024))
+LLM_CACHE_TTL_SECONDS = int(os.environ.get('LLM_CACHE_TTL_SECONDS', 60 * 60 * 24))
+
+# Local order grammar (orders/order_grammar.py): plain NEW_ORDER messages ("Bella pesan
+# 2 brownies 150rb besok jam 5") are parsed without DeepSeek when the grammar's
+# confidence is at least ORDER_GRAMMAR_MIN_CONFIDENCE.
+
+ORDER_GRAMMAR_ENABLED = os.environ.get('ORDER_GRAMMAR_ENABLED', '1') == '1'
+ORDER_GRAMMAR_MIN_CONFIDENCE = float(os.environ.get('ORDER_GRAMMAR_MIN_CONFIDENCE', 0.8))
+
+# LLM micro-batching (orders/ai_service.py ParseBatcher): messages reaching the LLM
+# within LLM_BATCH_MAX_WAIT_MS share one DeepSeek call, up to LLM_BATCH_SIZE each.
+# Off by default (1): a batch saves prompt tokens but takes longer to generate.
+
+LLM_BATCH_SIZE = int(os.environ.get('LLM_BATCH_SIZE', 1))
+LLM_BATCH_MAX_WAIT_MS = float(os.environ.get('LLM_BATCH_MAX_WAIT_MS', 50))
+LLM_BATCH_SENDERS = int(os.environ.get('LLM_BATCH_SENDERS', 4))
+
+# Streamed DeepSeek answers (orders/ai_service.py stream_order_with_ai): the pipeline
+# acts on the intent as soon as it arrives and, for a new order, first replies
+# "processing" (LLM_STREAM_PROCESSING_REPLY). Takes precedence over batching.
+
+LLM_STREAMING = os.environ.get('LLM_STREAMING', '0') == '1'
+LLM_STREAM_PROCESSING_REPLY = os.environ.get('LLM_STREAM_PROCESSING_REPLY', '1') == '1'
+
+# LLM providers (orders/llm_providers.py), in order of preference: deepseek, gemini
+# (needs GOOGLE_API_KEY) and stub (offline, answers like the load-test stub). A slow
+# request gets a hedged second one after the LLM_HEDGE_PERCENTILE of the provider's
+# recent latencies (0 = never), for at most LLM_HEDGE_BUDGET of the requests.
+# LLM_BREAKER_FAILURES failures in a row take a provider out of rotation for
+# LLM_BREAKER_COOLDOWN_SECONDS.
+
+LLM_PROVIDERS = [name.strip() for name in os.environ.get('LLM_PROVIDERS', 'deepseek').split(',') if name.strip()]
+DEEPSEEK_TIMEOUT_SECONDS = float(os.environ.get('DEEPSEEK_TIMEOUT_SECONDS', 30))
+GEMINI_MODEL = os.environ.get('GEMINI_MODEL', 'gemini-2.0-flash')
+GEMINI_TIMEOUT_SECONDS = float(os.environ.get('GEMINI_TIMEOUT_SECONDS', 20))
+LLM_STUB_LATENCY_MS = float(os.environ.get('LLM_STUB_LATENCY_MS', 300))
+LLM_STUB_FAILURE_RATE = float(os.environ.get('LLM_STUB_FAILURE_RATE', 0))
+LLM_STUB_TIMEOUT_SECONDS = float(os.environ.get('LLM_STUB_TIMEOUT_SECONDS', 5))
+LLM_HEDGE_PERCENTILE = float(os.environ.get('LLM_HEDGE_PERCENTILE', 95))
+LLM_HEDGE_MIN_SAMPLES = int(os.environ.get('LLM_HEDGE_MIN_SAMPLES', 20))
+LLM_HEDGE_BUDGET = float(os.environ.get('LLM_HEDGE_BUDGET', 0.05))
+LLM_BREAKER_FAILURES = int(os.environ.get('LLM_BREAKER_FAILURES', 5))
+LLM_BREAKER_COOLDOWN_SECONDS = float(os.environ.get('LLM_BREAKER_COOLDOWN_SECONDS', 30))
+
+# DeepSeek prompt and token accounting (orders/llm_usage.py, `manage.py llm_usage`).
+# LLM_COMPACT_SCHEMA=1 asks for items as [description, quantity, price, client_name]
+# arrays instead of objects (fewer output tokens). Prices: USD per 1M tokens, see
+# https://api-docs.deepseek.com/quick_start/pricing
+
+LLM_COMPACT_SCHEMA = os.environ.get('LLM_COMPACT_SCHEMA', '0') == '1'
+LLM_USAGE_LOGGING = os.environ.get('LLM_USAGE_LOGGING', '1') == '1'
+LLM_USAGE_RETENTION_DAYS = int(os.environ.get('LLM_USAGE_RETENTION_DAYS', 90))
+DEEPSEEK_PRICE_CACHE_HIT = float(os.environ.get('DEEPSEEK_PRICE_CACHE_HIT', 0.028))
+DEEPSEEK_PRICE_CACHE_MISS = float(os.environ.get('DEEPSEEK_PRICE_CACHE_MISS', 0.28))
+DEEPSEEK_PRICE_OUTPUT = float(os.environ.get('DEEPSEEK_PRICE_OUTPUT', 0.42))
+
+
+# chat_id -> Customer cache (orders/customer_cache.py): how long a process trusts
+# its local copy before re-checking the shared cache.
+
+CUSTOMER_CACHE_TTL_SECONDS = int(os.environ.get('CUSTOMER_CACHE_TTL_SECONDS', 300))
+
+
+# Message worker (manage.py process_messages)
+# The webhook only queues RawMessages; these control how the worker drains them.
+
+ORDER_WORKER_CONCURRENCY = int(os.environ.get('ORDER_WORKER_CONCURRENCY', 4))
+ORDER_WORKER_MAX_ATTEMPTS = int(os.environ.get('ORDER_WORKER_MAX_ATTEMPTS', 5))
+ORDER_WORKER_LEASE_SECONDS = int(os.environ.get('ORDER_WORKER_LEASE_SECONDS', 120))
+ORDER_WORKER_RETRY_BASE_SECONDS = int(os.environ.get('ORDER_WORKER_RETRY_BASE_SECONDS', 5))
+ORDER_WORKER_POLL_SECONDS = float(os.environ.get('ORDER_WORKER_POLL_SECONDS', 0.5))
+
+
+# Calendar outbox (orders/calendar_outbox.py): order changes queue a CalendarSyncTask in
+# their own transaction; a dispatcher thread in the worker (CALENDAR_SYNC_IN_WORKER) or
+# `manage.py sync_calendar` makes the API calls. Changes to one order within
+# CALENDAR_SYNC_DELAY_SECONDS become one call. Event ids are CALENDAR_EVENT_ID_PREFIX +
+# the order id (Google allows only the letters a-v and digits).
+
+CALENDAR_SYNC_IN_WORKER = os.environ.get('CALENDAR_SYNC_IN_WORKER', '1') == '1'
+CALENDAR_SYNC_DELAY_SECONDS = float(os.environ.get('CALENDAR_SYNC_DELAY_SECONDS', 2))
+CALENDAR_SYNC_POLL_SECONDS = float(os.environ.get('CALENDAR_SYNC_POLL_SECONDS', 1))
+CALENDAR_SYNC_BATCH_SIZE = int(os.environ.get('CALENDAR_SYNC_BATCH_SIZE', 50))
+CALENDAR_SYNC_LEASE_SECONDS = int(os.environ.get('CALENDAR_SYNC_LEASE_SECONDS', 120))
+CALENDAR_SYNC_MAX_ATTEMPTS = int(os.environ.get('CALENDAR_SYNC_MAX_ATTEMPTS', 8))
+CALENDAR_SYNC_RETRY_BASE_SECONDS = int(os.environ.get('CALENDAR_SYNC_RETRY_BASE_SECONDS', 5))
+CALENDAR_EVENT_ID_PREFIX = os.environ.get('CALENDAR_EVENT_ID_PREFIX', 'order')
+
+
+# Outbound HTTP pools (orders/http_clients.py), one pool per upstream host.
+# Sized so every worker thread can keep a warm keep-alive connection.
+
+HTTP_POOL_MAX_KEEPALIVE = int(os.environ.get('HTTP_POOL_MAX_KEEPALIVE', ORDER_WORKER_CONCURRENCY))
+HTTP_POOL_MAX_CONNECTIONS = int(os.environ.get('HTTP_POOL_MAX_CONNECTIONS', ORDER_WORKER_CONCURRENCY * 2))
+HTTP_POOL_KEEPALIVE_SECONDS = float(os.environ.get('HTTP_POOL_KEEPALIVE_SECONDS', 60))
+HTTP_TIMEOUT_SECONDS = float(os.environ.get('HTTP_TIMEOUT_SECONDS', 30))
+
+
+# Outbound Telegram queue (orders/telegram_utils.py TelegramSender)
+# Telegram allows ~30 msg/s per bot and ~1 msg/s per chat; replies to the same
+# chat within the coalescing window are merged into one message.
+
+TELEGRAM_SENDER_THREADS = int(os.environ.get('TELEGRAM_SENDER_THREADS', 4))
+TELEGRAM_COALESCE_SECONDS = float(os.environ.get('TELEGRAM_COALESCE_SECONDS', 0.3))
+TELEGRAM_GLOBAL_RATE = float(os.environ.get('TELEGRAM_GLOBAL_RATE', 30))
+TELEGRAM_CHAT_RATE = float(os.environ.get('TELEGRAM_CHAT_RATE', 1))
+TELEGRAM_CHAT_BURST = int(os.environ.get('TELEGRAM_CHAT_BURST', 3))
+
+
+# RawMessage retention (manage.py compact_raw_messages)
+
+RAW_MESSAGE_HOT_DAYS = int(os.environ.get('RAW_MESSAGE_HOT_DAYS', 30))
+RAW_MESSAGE_RETENTION_MONTHS = int(os.environ.get('RAW_MESSAGE_RETENTION_MONTHS', 12))
+
+
+# Async pipeline (orders/async_pipeline.py, POST /webhooks/telegram/async/ under ASGI)
+# Max updates processed concurrently per process; also sizes the async HTTP pools.
+
+ASYNC_PIPELINE_CONCURRENCY = int(os.environ.get('ASYNC_PIPELINE_CONCURRENCY', 200))
+# On shutdown / worker recycling, seconds the in-flight messages get to finish before they
+# are cancelled and handed back to the worker. Keep it below gunicorn's graceful_timeout (30).
+ASYNC_PIPELINE_SHUTDOWN_SECONDS = float(os.environ.get('ASYNC_PIPELINE_SHUTDOWN_SECONDS', 20))
+
+
+# Metrics (orders/metrics.py): per-stage latency histograms at GET /metrics/
+# (Prometheus text format). With METRICS_TOKEN set, scrapers must send
+# "Authorization: Bearer <token>"; the production profile requires it. Stages are also OpenTelemetry spans when
+# opentelemetry-api is installed; they are exported over OTLP when
+# OTEL_EXPORTER_OTLP_ENDPOINT is set and opentelemetry-sdk is installed.
+
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN', '')
+if PRODUCTION and not METRICS_TOKEN:
+    raise ImproperlyConfigured("Set METRICS_TOKEN when DJANGO_ENV=production (/metrics/ would be public).")
+METRICS_OTEL_ENABLED = os.environ.get('METRICS_OTEL_ENABLED', '1') == '1'
+OTEL_EXPORTER_OTLP_ENDPOINT = os.environ.get('OTEL_EXPORTER_OTLP_ENDPOINT', '')
+OTEL_SERVICE_NAME = os.environ.get('OTEL_SERVICE_NAME', 'chat-to-order')
+# Metrics are per process, except for processes sharing PROMETHEUS_MULTIPROC_DIR (read by
+# prometheus_client itself; config/gunicorn.conf.py sets it for gunicorn's workers).
+# The worker has no web server: `process_messages` serves its own metrics on this port
+# (0 = off). Unauthenticated, so it listens on localhost unless WORKER_METRICS_HOST says otherwise.
+WORKER_METRICS_PORT = int(os.environ.get('WORKER_METRICS_PORT', 0))
+WORKER_METRICS_HOST = os.environ.get('WORKER_METRICS_HOST', '127.0.0.1')
+
+
+# Telegram update de-duplication (orders/update_dedup.py)
+# Redelivered update_ids are dropped; the in-process set answers repeats without a
+# query, and TelegramUpdate rows are kept TELEGRAM_UPDATE_RETENTION_DAYS days.
+
+TELEGRAM_DEDUP_TTL_SECONDS = int(os.environ.get('TELEGRAM_DEDUP_TTL_SECONDS', 3600))
+TELEGRAM_DEDUP_MAX_ENTRIES = int(os.environ.get('TELEGRAM_DEDUP_MAX_ENTRIES', 50000))
+TELEGRAM_UPDATE_RETENTION_DAYS = int(os.environ.get('TELEGRAM_UPDATE_RETENTION_DAYS', 7))
+
+
+# Long-polling ingest (manage.py poll_updates), the alternative to the webhook
+
+TELEGRAM_POLL_TIMEOUT = int(os.environ.get('TELEGRAM_POLL_TIMEOUT', 30))
+TELEGRAM_POLL_LIMIT = int(os.environ.get('TELEGRAM_POLL_LIMIT', 100))
@@ -1,5 +1,7 @@
 from django.contrib import admin
-from .models import Customer, RawMessage, Order
+from .models import Customer, RawMessage, Order, LLMCall, CalendarSyncTask
+from .message_queue import requeue_messages
+from .calendar_outbox import requeue_calendar_tasks
 
 @admin.register(Customer)
 class CustomerAdmin(admin.ModelAdmin):
@@ -8,13 +10,37 @@ class CustomerAdmin(admin.ModelAdmin):
 
 @admin.register(RawMessage)
 class RawMessageAdmin(admin.ModelAdmin):
-    list_display = ('customer', 'timestamp', 'is_processed')
-    list_filter = ('is_processed', 'timestamp')
+    list_display = ('customer', 'timestamp', 'is_processed', 'attempts', 'is_dead_letter')
+    list_filter = ('is_processed', 'is_dead_letter', 'timestamp')
     readonly_fields = ('timestamp',)
+    actions = ['requeue']
+
+    @admin.action(description="Requeue selected messages for the worker")
+    def requeue(self, request, queryset):
+        count = requeue_messages(queryset)
+        self.message_user(request, f"{count} message(s) requeued.")
 
 @admin.register(Order)
 class OrderAdmin(admin.ModelAdmin):
     # Added 'price' to this list
     list_display = ('customer', 'item_description', 'price', 'due_date', 'status', 'ai_confidence')
     list_filter = ('status', 'due_date')
-    search_fields = ('item_description',)
\ No newline at end of file
+    search_fields = ('item_description',)
+
+@admin.register(LLMCall)
+class LLMCallAdmin(admin.ModelAdmin):
+    list_display = ('created_at', 'kind', 'messages', 'prompt_tokens', 'cached_tokens', 'completion_tokens',
+                    'latency_ms', 'ok')
+    list_filter = ('kind', 'ok', 'created_at')
+
+@admin.register(CalendarSyncTask)
+class CalendarSyncTaskAdmin(admin.ModelAdmin):
+    list_display = ('order_id', 'action', 'created_at', 'available_at', 'attempts', 'is_dead_letter', 'last_error')
+    list_filter = ('action', 'is_dead_letter')
+    search_fields = ('order_id',)
+    actions = ['requeue']
+
+    @admin.action(description="Retry selected calendar syncs now")
+    def requeue(self, request, queryset):
+        count = requeue_calendar_tasks(queryset)
+        self.message_user(request, f"{count} calendar sync(s) requeued.")
@@ -0,0 +1,139 @@
+import uuid
+from datetime import datetime, time, timedelta
+from django.core.cache import cache
+from django.utils import timezone
+from .models import Order
+
+# Per-customer "next 3 days" agenda for LIST_ORDERS.
+# The rendered pages are cached (shared Django cache), so repeated "cek order" costs no
+# Order query at all. The page key includes a per-customer generation that every Order
+# change replaces (see signals.py): a reader that rendered old rows before a write can
+# only store them under the old generation, which nobody reads any more. The short TTL
+# bounds anything that slips through (e.g. the generation evicted from the cache).
+
+AGENDA_DAYS = 3
+PAGE_CACHE_TTL = 5 * 60
+
+# Leave room under Telegram's 4096 limit for the page footer
+PAGE_LENGTH = 3800
+
+
+def agenda_range_filter(days=AGENDA_DAYS):
+    """
+    due_date filter for "today .. today+days" (inclusive) as a plain datetime range.
+    Unlike due_date__date__range this doesn't wrap the column in a cast, so the
+    (customer, due_date) index can serve it.
+    """
+    start = timezone.make_aware(datetime.combine(timezone.localdate(), time.min))
+    return {'due_date__gte': start, 'due_date__lt': start + timedelta(days=days + 1)}
+
+
+def _generation_key(customer_id):
+    return f"agenda-gen:{customer_id}"
+
+
+def _current_generation(customer_id):
+    key = _generation_key(customer_id)
+    generation = cache.get(key)
+    if generation is None:
+        cache.add(key, uuid.uuid4().hex, timeout=None)
+        generation = cache.get(key)
+    return generation
+
+
+def _cache_key(customer_id, generation):
+    # The date is part of the key: the window moves at midnight without any invalidation
+    return f"agenda:{customer_id}:{generation}:{timezone.localdate().isoformat()}"
+
+
+def _render_pages(rows):
+    """Renders (id, client_name, item_description, status, due_date) rows into message pages."""
+    if not rows:
+        return ["📅 No active orders found for the next 3 days."]
+
+    lines = []
+    current_date_header = None
+    for order_id, client_name, item_description, status, due_date in rows:
+        # Group visually by date
+        order_date = timezone.localtime(due_date).strftime('%d %b')  # e.g., "27 Dec"
+        if order_date != current_date_header:
+            lines.append(f"\n📅 *{order_date}*")
+            current_date_header = order_date
+
+        # Icon based on status
+        icon = "✅" if status == 'CONFIRMED' else "⏳"
+
+        # Format: [ID] Who - What
+        lines.append(f"[{order_id}] {client_name} - {item_description} ({icon})")
+
+    pages = []
+    current = []
+    length = 0
+    last_header = None
+    for line in lines:
+        if current and length + len(line) + 1 > PAGE_LENGTH:
+            pages.append(current)
+            # Repeat the date header when a day continues on the next page
+            current = [last_header] if last_header and not line.startswith("\n📅") else []
+            length = sum(len(l) + 1 for l in current)
+        if line.startswith("\n📅"):
+            last_header = line
+        current.append(line)
+        length += len(line) + 1
+    pages.append(current)
+
+    rendered = []
+    for number, page_lines in enumerate(pages, start=1):
+        header = "📋 **Orders (Next 3 Days):**"
+        if len(pages) > 1:
+            header += f" — page {number}/{len(pages)}"
+        body = "\n".join([header] + page_lines)
+        if number < len(pages):
+            body += f"\n\n➡️ Reply 'Cek order hal {number + 1}' for the next page."
+        rendered.append(body)
+    return rendered
+
+
+def get_agenda_pages(customer_id):
+    """Returns the rendered agenda pages for a customer, from cache when possible."""
+    # The generation is read BEFORE the rows: pages rendered from rows older than a
+    # write end up under the generation that write replaced
+    try:
+        key = _cache_key(customer_id, _current_generation(customer_id))
+        pages = cache.get(key)
+    except Exception as e:
+        print(f"Agenda Cache Error (get): {e}")
+        key = pages = None
+    if pages is not None:
+        return pages
+
+    # One query, only the columns the message needs
+    rows = list(
+        Order.objects.filter(customer_id=customer_id, **agenda_range_filter())
+        .exclude(status='CANCELLED')
+        .order_by('due_date')
+        .values_list('id', 'client_name', 'item_description', 'status', 'due_date')
+    )
+    pages = _render_pages(rows)
+
+    if key is None:
+        return pages
+    try:
+        cache.set(key, pages, timeout=PAGE_CACHE_TTL)
+    except Exception as e:
+        print(f"Agenda Cache Error (set): {e}")
+    return pages
+
+
+def get_agenda_page(customer_id, page=1):
+    pages = get_agenda_pages(customer_id)
+    page = min(max(page or 1, 1), len(pages))
+    return pages[page - 1]
+
+
+def invalidate_agenda(customer_id):
+    """Starts a new generation: every cached page of this customer is out of date."""
+    try:
+        cache.set(_generation_key(customer_id), uuid.uuid4().hex, timeout=None)
+    except Exception as e:
+        print(f"Agenda Cache Error (delete): {e}")
@@ -1,132 +1,815 @@
+import asyncio
+import copy
+import hashlib
+import inspect
 import json
 import os
-# import google.generativeai as genai
-from openai import OpenAI
+import queue
+import re
+import threading
+import time
+import weakref
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+import httpx
+from asgiref.sync import sync_to_async
+from openai import AsyncOpenAI, OpenAI
+from django.conf import settings
+from django.core.cache import caches
 from django.utils import timezone
-
-# 1. Configure Gemini
-# genai.configure(api_key=os.environ.get("GOOGLE_API_KEY"))
+from .intent_rules import classify_intent, record_fallthrough
+from .http_clients import get_http_client, get_async_http_client
+from .llm_providers import LLMRouter, StubProvider, release_db_after
+from .llm_usage import record_llm_call
+from .metrics import stage, stage_duration
+from .order_grammar import parse_order_grammar
+from .stream_json import JSONStreamParser
 
 # 1. Configure Client for DeepSeek
+# (uses the shared pooled HTTP client, see orders/http_clients.py)
+# DEEPSEEK_API_BASE lets load tests point at a local stub (see orders/stub_servers.py)
+DEEPSEEK_API_BASE = os.environ.get("DEEPSEEK_API_BASE", "https://api.deepseek.com")
+DEEPSEEK_TIMEOUT = httpx.Timeout(60.0, connect=5.0)
+
 client = OpenAI(
     api_key=os.environ.get("DEEPSEEK_API_KEY"),
-    base_url="https://api.deepseek.com"  # <--- This connects to DeepSeek
+    base_url=DEEPSEEK_API_BASE,  # <--- This connects to DeepSeek
+    http_client=get_http_client('deepseek', timeout=DEEPSEEK_TIMEOUT),
 )
 
-# ... imports (same as before) ...
-# ... client configuration (same as before) ...
+# 2. Gemini, through its OpenAI-compatible endpoint: an optional second provider
+# (LLM_PROVIDERS, see orders/llm_providers.py). Needs GOOGLE_API_KEY.
+GEMINI_API_BASE = os.environ.get("GEMINI_API_BASE", "https://generativelanguage.googleapis.com/v1beta/openai/")
 
-def parse_order_with_ai(text_message):
-    current_time = timezone.now().strftime("%Y-%m-%d %H:%M")
-    
-    system_prompt = f"""
+_APIS = {  # provider -> (API key variable, base URL)
+    'deepseek': ("DEEPSEEK_API_KEY", DEEPSEEK_API_BASE),
+    'gemini': ("GOOGLE_API_KEY", GEMINI_API_BASE),
+}
+_clients = {'deepseek': client}
+
+
+def get_client(name='deepseek'):
+    sync_client = _clients.get(name)
+    if sync_client is None:
+        api_key_env, base_url = _APIS[name]
+        sync_client = _clients[name] = OpenAI(
+            api_key=os.environ.get(api_key_env),
+            base_url=base_url,
+            http_client=get_http_client(name, timeout=DEEPSEEK_TIMEOUT),
+        )
+    return sync_client
+
+
+# Async client for the async pipeline, created per event loop (see get_async_http_client)
+_async_clients = {}
+
+
+def get_async_client(name='deepseek'):
+    http_client = get_async_http_client(name, timeout=DEEPSEEK_TIMEOUT)
+    async_client = _async_clients.get(http_client)
+    if async_client is None:
+        api_key_env, base_url = _APIS[name]
+        async_client = AsyncOpenAI(
+            api_key=os.environ.get(api_key_env),
+            base_url=base_url,
+            http_client=http_client,
+        )
+        _async_clients[http_client] = async_client
+    return async_client
+
+
+class ParseCache:
+    """
+    Two-tier cache for LLM parses: an in-process LRU in front of a shared Django cache
+    (see settings.LLM_CACHE_ALIAS), both with TTL expiry.
+
+    The key is the normalized message plus today's date, because the LLM resolves
+    relative dates ("besok", "lusa") against the current day.
+    """
+
+    def __init__(self, max_entries, ttl_seconds, alias):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.alias = alias
+        self._entries = OrderedDict()  # key -> (expires_at, result)
+        self._lock = threading.Lock()
+        self._stats = {'memory_hits': 0, 'shared_hits': 0, 'misses': 0, 'stores': 0, 'evictions': 0, 'bypassed': 0}
+
+    @staticmethod
+    def make_key(text_message):
+        normalized = re.sub(r"\s+", " ", (text_message or "").lower()).strip()
+        bucket = timezone.localdate().isoformat()
+        digest = hashlib.sha1(f"{bucket}|{normalized}".encode()).hexdigest()
+        return f"llm-parse:{digest}"
+
+    def get(self, key):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry[0] > now:
+                self._entries.move_to_end(key)
+                self._stats['memory_hits'] += 1
+                return copy.deepcopy(entry[1])
+            if entry:
+                del self._entries[key]
+
+        try:
+            result = caches[self.alias].get(key)
+        except Exception as e:
+            print(f"Parse Cache Error (shared get): {e}")
+            result = None
+
+        with self._lock:
+            if result is None:
+                self._stats['misses'] += 1
+                return None
+            self._stats['shared_hits'] += 1
+            self._remember(key, result, now)
+        return copy.deepcopy(result)
+
+    def set(self, key, result):
+        with self._lock:
+            self._stats['stores'] += 1
+            self._remember(key, copy.deepcopy(result), time.monotonic())
+        try:
+            caches[self.alias].set(key, result, timeout=self.ttl_seconds)
+        except Exception as e:
+            print(f"Parse Cache Error (shared set): {e}")
+
+    def record_bypass(self):
+        with self._lock:
+            self._stats['bypassed'] += 1
+
+    def _remember(self, key, result, now):
+        # caller holds self._lock
+        self._entries[key] = (now + self.ttl_seconds, result)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self._stats['evictions'] += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats, size=len(self._entries))
+        lookups = stats['memory_hits'] + stats['shared_hits'] + stats['misses']
+        stats['hit_rate'] = ((stats['memory_hits'] + stats['shared_hits']) / lookups) if lookups else 0.0
+        return stats
+
+
+parse_cache = ParseCache(
+    max_entries=settings.LLM_CACHE_MAX_ENTRIES,
+    ttl_seconds=settings.LLM_CACHE_TTL_SECONDS,
+    alias=settings.LLM_CACHE_ALIAS,
+)
+
+
+# Micro-batching: messages that reach the LLM within LLM_BATCH_MAX_WAIT_MS of each
+# other (up to LLM_BATCH_SIZE) share one chat completion, so a burst pays for the
+# system prompt once instead of once per message. A message the batch answer does
+# not cover (or a failed batch) falls back to its own parse_order_with_ai() call.
+
+FALLBACK = object()  # batch result meaning "parse this one on its own"
+
+
+class ParseBatcher:
+    """Batches parse requests from worker threads; one dispatcher thread forms the batches."""
+
+    def __init__(self, max_size, max_wait, senders):
+        self.max_size = max_size
+        self.max_wait = max_wait
+        self.senders = senders
+        self._queue = queue.Queue()
+        self._pool = None
+        self._lock = threading.Lock()
+        self.stats = {'batches': 0, 'batched': 0, 'fallbacks': 0}
+
+    def parse(self, text_message):
+        self._start()
+        future = Future()
+        self._queue.put((text_message, future))
+        result = future.result()
+        if result is FALLBACK:
+            return parse_order_with_ai(text_message)
+        return result
+
+    def _start(self):
+        with self._lock:
+            if self._pool is None:
+                self._pool = ThreadPoolExecutor(max_workers=self.senders, thread_name_prefix='llm-batch')
+                threading.Thread(target=self._collect, daemon=True, name='llm-batcher').start()
+
+    def _collect(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < self.max_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            # Batches are sent concurrently; the next one forms while this one is in flight
+            self._pool.submit(release_db_after, self._send, batch)
+
+    def _send(self, batch):
+        results = {}
+        try:
+            if len(batch) > 1:
+                results = parse_orders_with_ai_batch([text for text, _ in batch])
+        finally:
+            self._resolve(batch, results)
+
+    def _resolve(self, batch, results):
+        with self._lock:
+            if len(batch) > 1:
+                self.stats['batches'] += 1
+            self.stats['batched'] += sum(1 for i in range(len(batch)) if i in results)
+            self.stats['fallbacks'] += sum(1 for i in range(len(batch)) if i not in results)
+        for i, (_, future) in enumerate(batch):
+            future.set_result(results.get(i, FALLBACK))
+
+
+class AsyncParseBatcher:
+    """ParseBatcher for one event loop: the window is a loop timer, batches are tasks."""
+
+    def __init__(self, max_size, max_wait, stats):
+        self.max_size = max_size
+        self.max_wait = max_wait
+        self.stats = stats  # shared with the thread batcher
+        self._pending = []
+        self._timer = None
+        self._tasks = set()
+
+    async def parse(self, text_message):
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((text_message, future))
+        if len(self._pending) >= self.max_size:
+            self._flush()
+        elif self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(self.max_wait, self._flush)
+
+        result = await future
+        if result is FALLBACK:
+            return await aparse_order_with_ai(text_message)
+        return result
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        if batch:
+            task = asyncio.get_running_loop().create_task(self._send(batch))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _send(self, batch):
+        results = {}
+        try:
+            if len(batch) > 1:
+                results = await aparse_orders_with_ai_batch([text for text, _ in batch])
+        finally:
+            parse_batcher._resolve(batch, results)
+
+
+parse_batcher = ParseBatcher(
+    max_size=settings.LLM_BATCH_SIZE,
+    max_wait=settings.LLM_BATCH_MAX_WAIT_MS / 1000,
+    senders=settings.LLM_BATCH_SENDERS,
+)
+_async_batchers = weakref.WeakKeyDictionary()  # event loop -> AsyncParseBatcher
+
+
+def _streaming(on_event):
+    # Streaming and batching are DeepSeek features: skipped while its circuit is open
+    return on_event is not None and settings.LLM_STREAMING and llm_router.available('deepseek')
+
+
+def _ask_llm(text_message, on_event=None):
+    record_fallthrough()
+    if _streaming(on_event):
+        return stream_order_with_ai(text_message, on_event)
+    if settings.LLM_BATCH_SIZE > 1:
+        return parse_batcher.parse(text_message)
+    return parse_order_with_ai(text_message)
+
+
+async def _aask_llm(text_message, on_event=None):
+    record_fallthrough()
+    if _streaming(on_event):
+        return await astream_order_with_ai(text_message, on_event)
+    if settings.LLM_BATCH_SIZE <= 1:
+        return await aparse_order_with_ai(text_message)
+    loop = asyncio.get_running_loop()
+    batcher = _async_batchers.get(loop)
+    if batcher is None:
+        batcher = _async_batchers[loop] = AsyncParseBatcher(
+            settings.LLM_BATCH_SIZE, settings.LLM_BATCH_MAX_WAIT_MS / 1000, parse_batcher.stats,
+        )
+    return await batcher.parse(text_message)
+
+
+def parse_message(text_message, use_cache=True, on_event=None):
+    """
+    Entry point used by the pipeline. Command-style messages ("Ok 15", "Batal 12",
+    "Cek order") are resolved locally by the rule classifier and plain orders
+    ("Bella pesan 2 brownies besok") by the order grammar; repeated messages are
+    answered from the parse cache; everything else goes to DeepSeek.
+    Pass use_cache=False (or set LLM_CACHE_ENABLED=0) to always ask the LLM.
+    With LLM_STREAMING, on_event receives the DeepSeek answer as it streams
+    (see stream_order_with_ai); it is not called for rule, grammar or cache answers.
+    """
+    rule_result = classify_intent(text_message) or parse_order_grammar(text_message)
+    if rule_result:
+        return rule_result
+
+    if not (use_cache and settings.LLM_CACHE_ENABLED):
+        parse_cache.record_bypass()
+        return _ask_llm(text_message, on_event)
+
+    key = parse_cache.make_key(text_message)
+    cached = parse_cache.get(key)
+    if cached is not None:
+        return cached
+
+    result = _ask_llm(text_message, on_event)
+    if result:
+        # Never cache failures (None): the next attempt should hit DeepSeek again
+        parse_cache.set(key, result)
+    return result
+
+
+# The system prompt is constant, so DeepSeek's context cache can serve it from the
+# second request on (prompt_cache_hit_tokens, see orders/llm_usage.py). Anything that
+# changes per request (the current time) goes in a message AFTER it.
+
+PROMPT_INTENTS = """
     You are an Order Management Assistant.
-    Current Time: {current_time}
-    
+
     Classify the user's intent:
     1. NEW_ORDER: User is buying (e.g. "Bella pesan...", "Order 2...", "Beli...").
     2. CONFIRM: User agrees (e.g. "Ok", "Ya", "Ok 15").
     3. CANCEL: User cancels specific item (e.g. "Batal 12", "Cancel #5").
     4. LIST_ORDERS: User wants to see list (e.g. "Cek order", "List hari ini").
     5. UNKNOWN: Anything else.
-    
+    """
+
+PROMPT_STRUCTURE = """
     Structure:
-    {{
+    {
         "intent": "NEW_ORDER" | "CONFIRM" | "CANCEL" | "LIST_ORDERS" | "UNKNOWN",
         "items": [
-            {{ 
+            { 
                 "description": "kue cubit", 
                 "quantity": 1, 
                 "price": 100000, 
                 "client_name": "Bella" 
-            }}
+            }
         ],
         "due_date": "2025-12-26 09:00:00",
         "order_id": integer
-    }}
-    
+    }
+
     CRITICAL RULES:
     1. "items" MUST be a list of OBJECTS. Do NOT return a list of strings like ["kue cubit"].
+    """
+
+# LLM_COMPACT_SCHEMA: same fields, about half the output tokens for an order
+PROMPT_STRUCTURE_COMPACT = """
+    Structure (compact JSON, no spaces):
+    {"intent":"NEW_ORDER"|"CONFIRM"|"CANCEL"|"LIST_ORDERS"|"UNKNOWN","order_id":integer|null,"due_date":"2025-12-26 09:00","items":[["kue cubit",1,100000,"Bella"]]}
+
+    CRITICAL RULES:
+    1. Each item is an array: [description, quantity, price, client_name]. Omit "items" when there are none.
+    """
+
+PROMPT_RULES = """
     2. Client Name Extraction:
        - "Bella pesan 1 kue" -> client_name: "Bella"
        - "Pesan 1 kue buat Budi" -> client_name: "Budi"
        - If no name found, use "Owner".
     3. Price: "100k" = 100000.
+    4. Dates: resolve "besok", "lusa", weekday names etc. against the Current Time given before the message.
     """
+
+SYSTEM_PROMPT = PROMPT_INTENTS + PROMPT_STRUCTURE + PROMPT_RULES
+SYSTEM_PROMPT_COMPACT = PROMPT_INTENTS + PROMPT_STRUCTURE_COMPACT + PROMPT_RULES
+ITEM_FIELDS = ('description', 'quantity', 'price', 'client_name')
+
+
+def system_prompt():
+    return SYSTEM_PROMPT_COMPACT if settings.LLM_COMPACT_SCHEMA else SYSTEM_PROMPT
+
+
+def context_message():
+    """The per-request part of the prompt, sent after the cacheable system prompt."""
+    now = timezone.localtime()
+    return {"role": "system", "content": f"Current Time: {now:%Y-%m-%d %H:%M} ({timezone.get_current_timezone_name()})"}
+
+
+def _chat_request(text_message, model="deepseek-chat"):  # This is their main V3 model
+    return dict(
+        model=model,
+        messages=[
+            {"role": "system", "content": system_prompt()},
+            context_message(),
+            {"role": "user", "content": text_message}
+        ],
+        temperature=0.1,
+        stream=False
+    )
+
+
+def _complete(kind, request, messages=1):
+    """client.chat.completions.create(), recorded in the LLM usage log (orders/llm_usage.py)."""
+    started = time.monotonic()
+    response = None
     try:
-        # 3. Call DeepSeek
-        response = client.chat.completions.create(
-            model="deepseek-chat",  # This is their main V3 model
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": text_message}
-            ],
-            temperature=0.1,
-            stream=False
-        )
-        
-        # 4. Parse Response
-        ai_content = response.choices[0].message.content
-        
-        # Safety cleanup: sometimes AI adds ```json at the start
-        clean_json = ai_content.replace("```json", "").replace("```", "").strip()
-        
-        parsed_data = json.loads(clean_json)
-        return parsed_data
-
-    except Exception as e:
-        print(f"DeepSeek Error: {e}")
-        return None
-
-def parse_order_with_ai_gemini(text_message):
+        response = client.chat.completions.create(**request)
+        return response
+    finally:
+        record_llm_call(kind, request['model'], response, time.monotonic() - started, messages)
+
+
+async def _acomplete(kind, request, messages=1):
+    started = time.monotonic()
+    response = None
+    try:
+        response = await get_async_client().chat.completions.create(**request)
+        return response
+    finally:
+        await sync_to_async(record_llm_call)(kind, request['model'], response, time.monotonic() - started, messages)
+
+
+def _expand_items(result):
+    """Compact-schema items ([description, quantity, price, client_name]) -> the usual dicts."""
+    if isinstance(result, dict):
+        items = result.get('items') or []
+        result['items'] = [
+            dict(zip(ITEM_FIELDS, item)) if isinstance(item, list) else item for item in items
+        ]
+    return result
+
+
+def _decode_ai_content(ai_content):
+    # Safety cleanup: sometimes AI adds ```json at the start
+    clean_json = ai_content.replace("```json", "").replace("```", "").strip()
+    return json.loads(clean_json)
+
+
+def _result_intent(result):
+    """Intent label for the llm_parse stage metric."""
+    intent = result.get('intent') if isinstance(result, dict) else None
+    return str(intent).upper() if intent else 'UNKNOWN'
+
+
+def _decode_response(response):
+    result = _expand_items(_decode_ai_content(response.choices[0].message.content))
+    if not isinstance(result, dict):
+        raise ValueError(f"expected a JSON object, got {type(result).__name__}")
+    return result
+
+
+class ChatProvider:
+    """An OpenAI-compatible chat API (DeepSeek, Gemini) as an LLM provider for the router."""
+
+    def __init__(self, name, model, timeout):
+        self.name = name
+        self.model = model
+        self.timeout = timeout
+
+    def parse(self, text_message, hedge=False):
+        request = _chat_request(text_message, model=self.model)
+        started = time.monotonic()
+        response = None
+        try:
+            # No SDK retries: the router falls back / retries and keeps the circuit breaker honest
+            response = get_client(self.name).with_options(timeout=self.timeout, max_retries=0) \
+                .chat.completions.create(**request)
+        finally:
+            record_llm_call('parse', self.model, response, time.monotonic() - started,
+                            provider=self.name, hedge=hedge)
+        return _decode_response(response)
+
+    async def aparse(self, text_message, hedge=False):
+        request = _chat_request(text_message, model=self.model)
+        started = time.monotonic()
+        response, cancelled = None, False
+        try:
+            response = await get_async_client(self.name).with_options(timeout=self.timeout, max_retries=0) \
+                .chat.completions.create(**request)
+        except asyncio.CancelledError:
+            cancelled = True  # lost a hedge race: not a failed call
+            raise
+        finally:
+            if not cancelled:
+                await sync_to_async(record_llm_call)('parse', self.model, response, time.monotonic() - started,
+                                                     provider=self.name, hedge=hedge)
+        return _decode_response(response)
+
+
+def _build_providers():
+    providers = []
+    for name in settings.LLM_PROVIDERS:
+        if name == 'deepseek':
+            providers.append(ChatProvider('deepseek', 'deepseek-chat', settings.DEEPSEEK_TIMEOUT_SECONDS))
+        elif name == 'gemini':
+            if not os.environ.get('GOOGLE_API_KEY'):
+                print("LLM provider 'gemini' skipped: GOOGLE_API_KEY is not set.")
+                continue
+            providers.append(ChatProvider('gemini', settings.GEMINI_MODEL, settings.GEMINI_TIMEOUT_SECONDS))
+        elif name == 'stub':
+            providers.append(StubProvider(
+                latency=settings.LLM_STUB_LATENCY_MS / 1000,
+                failure_rate=settings.LLM_STUB_FAILURE_RATE,
+                timeout=settings.LLM_STUB_TIMEOUT_SECONDS,
+            ))
+        else:
+            print(f"Unknown LLM provider '{name}' in LLM_PROVIDERS; ignored.")
+    return providers
+
+
+llm_router = LLMRouter(
+    _build_providers(),
+    hedge_percentile=settings.LLM_HEDGE_PERCENTILE,
+    hedge_min_samples=settings.LLM_HEDGE_MIN_SAMPLES,
+    failure_threshold=settings.LLM_BREAKER_FAILURES,
+    cooldown=settings.LLM_BREAKER_COOLDOWN_SECONDS,
+    hedge_budget=settings.LLM_HEDGE_BUDGET,
+    hedge_workers=2 * settings.ORDER_WORKER_CONCURRENCY,
+)
+
+
+def parse_order_with_ai(text_message):
+    """One message -> parse dict from the first provider that answers (see llm_router), or None."""
+    with stage('llm_parse') as span:
+        result = llm_router.parse(text_message)
+        if result is None:
+            span.outcome = 'error'
+        else:
+            span.intent = _result_intent(result)
+        return result
+
+
+async def aparse_order_with_ai(text_message):
+    """parse_order_with_ai() on the async clients: the event loop is free while the LLM thinks."""
+    with stage('llm_parse') as span:
+        result = await llm_router.aparse(text_message)
+        if result is None:
+            span.outcome = 'error'
+        else:
+            span.intent = _result_intent(result)
+        return result
+
+
+# Streaming (LLM_STREAMING): the answer is read while it is generated and handed to
+# the caller's on_event(event) field by field (see orders/stream_json.py), so the
+# pipeline can act on the intent long before the last order item is written.
+
+STOP_STREAM = object()  # on_event return value: the rest of the answer isn't needed
+# on_event gets this when the stream failed: forget its events, the routed parse follows
+STREAM_RESTART = ('restart',)
+
+
+def _stream_request(text_message):
+    request = _chat_request(text_message)
+    request.update(stream=True, stream_options={'include_usage': True})
+    return request
+
+
+def _stream_event(event):
+    """Compact-schema item arrays -> dicts, so callbacks always see the usual item shape."""
+    if event[0] == 'item' and isinstance(event[1], list):
+        return 'item', dict(zip(ITEM_FIELDS, event[1]))
+    return event
+
+
+def _stream_result(parser, stopped):
+    # A stream closed early has no closing brace: use the fields that were complete
+    result = dict(parser.fields) if stopped else _decode_ai_content(parser.text)
+    return _expand_items(result)
+
+
+def _observe_time_to_intent(intent, started):
+    stage_duration.labels(stage='llm_intent', intent=str(intent).upper(), outcome='ok').observe(time.monotonic() - started)
+
+
+def _checked_stream_result(parser, stopped):
+    result = _stream_result(parser, stopped)
+    if not isinstance(result, dict) or not result.get('intent'):
+        raise ValueError(f"unusable streamed answer: {parser.text[:200]!r}")
+    return result
+
+
+def _streaming_client(async_client=False):
+    # Same timeout as the routed DeepSeek calls; no SDK retries: a failed stream falls
+    # back to the router, which retries / falls back and keeps the circuit breaker honest
+    deepseek = get_async_client() if async_client else client
+    return deepseek.with_options(timeout=settings.DEEPSEEK_TIMEOUT_SECONDS, max_retries=0)
+
+
+def stream_order_with_ai(text_message, on_event):
     """
-    Sends the text to Google Gemini and returns a JSON object with order details.
+    parse_order_with_ai() with stream=True. on_event(event) gets ('field', key, value) and
+    ('item', item) events as soon as each one is complete (the intent comes first);
+    returning STOP_STREAM from it closes the stream early. If the stream fails or its
+    answer is unusable, on_event gets STREAM_RESTART and the message goes through
+    parse_order_with_ai(). Returns the same dict as parse_order_with_ai(), or None.
     """
-    current_time = timezone.now().strftime("%Y-%m-%d %H:%M")
-
-    # 2. Select Model (Gemini 1.5 Flash is fast and cheap)
-    # We enforce JSON output using generation_config
-    model = genai.GenerativeModel(
-        # "gemini-1.5-flash-001",
-        "gemini-2.0-flash-001",
-        generation_config={"response_mime_type": "application/json"}
-    )
+    result = _stream_order(text_message, on_event)
+    if result is None:
+        on_event(STREAM_RESTART)
+        result = parse_order_with_ai(text_message)
+    return result
 
-    # 3. The Prompt
-    prompt = f"""
-    You are an Order Management Assistant for a catering in Indonesia.
-    Current Time: {current_time}
-    
-    Analyze this message: "{text_message}"
-    
-    Extract the order details into this JSON structure:
-    {{
-        "intent": "NEW_ORDER" or "CANCEL" or "UNKNOWN",
-        "items": [
-            {{
-                "description": "item name", 
-                "quantity": integer, 
-                "price": integer (null if not found)
-            }}
+
+def _stream_order(text_message, on_event):
+    request = _stream_request(text_message)
+    parser = JSONStreamParser()
+    started = time.monotonic()
+    response, ok = None, False
+    with stage('llm_parse') as span:
+        try:
+            stream = _streaming_client().chat.completions.create(**request)
+            last_chunk, stopped = None, False
+            try:
+                for chunk in stream:
+                    last_chunk = chunk if chunk.usage or last_chunk is None else last_chunk
+                    if not chunk.choices:
+                        continue
+                    for event in parser.feed(chunk.choices[0].delta.content or ''):
+                        if event[:2] == ('field', 'intent'):
+                            _observe_time_to_intent(event[2], started)
+                        if on_event(_stream_event(event)) is STOP_STREAM:
+                            stopped = True
+                    if stopped:
+                        break
+            finally:
+                stream.close()
+            response = last_chunk  # the final chunk carries the usage (include_usage)
+            result = _checked_stream_result(parser, stopped)
+            span.intent = _result_intent(result)
+            ok = True
+            return result
+        except Exception as e:
+            print(f"DeepSeek Stream Error: {e}")
+            span.outcome = 'error'
+            return None
+        finally:
+            llm_router.report('deepseek', ok)
+            record_llm_call('stream', request['model'], response, time.monotonic() - started)
+
+
+async def astream_order_with_ai(text_message, on_event):
+    """stream_order_with_ai() on the async client; on_event may be a coroutine function."""
+    result = await _astream_order(text_message, on_event)
+    if result is None:
+        outcome = on_event(STREAM_RESTART)
+        if inspect.isawaitable(outcome):
+            await outcome
+        result = await aparse_order_with_ai(text_message)
+    return result
+
+
+async def _astream_order(text_message, on_event):
+    request = _stream_request(text_message)
+    parser = JSONStreamParser()
+    started = time.monotonic()
+    response, ok = None, False
+    with stage('llm_parse') as span:
+        try:
+            stream = await _streaming_client(async_client=True).chat.completions.create(**request)
+            last_chunk, stopped = None, False
+            try:
+                async for chunk in stream:
+                    last_chunk = chunk if chunk.usage or last_chunk is None else last_chunk
+                    if not chunk.choices:
+                        continue
+                    for event in parser.feed(chunk.choices[0].delta.content or ''):
+                        if event[:2] == ('field', 'intent'):
+                            _observe_time_to_intent(event[2], started)
+                        outcome = on_event(_stream_event(event))
+                        if inspect.isawaitable(outcome):
+                            outcome = await outcome
+                        if outcome is STOP_STREAM:
+                            stopped = True
+                    if stopped:
+                        break
+            finally:
+                await stream.close()
+            response = last_chunk
+            result = _checked_stream_result(parser, stopped)
+            span.intent = _result_intent(result)
+            ok = True
+            return result
+        except Exception as e:
+            print(f"DeepSeek Stream Error: {e}")
+            span.outcome = 'error'
+            return None
+        finally:
+            llm_router.report('deepseek', ok)
+            await sync_to_async(record_llm_call)('stream', request['model'], response, time.monotonic() - started)
+
+
+BATCH_INSTRUCTIONS = """
+    BATCH MODE:
+    The user message is a JSON array of chat messages: [{"index": 0, "text": "..."}, ...].
+    Parse EACH message on its own, with the structure and rules above.
+    Reply with ONE JSON object, one result per message:
+    {"results": [{"index": 0, "intent": "...", "items": [...], "due_date": "...", "order_id": ...}, ...]}
+    """
+
+
+def _batch_request(texts):
+    messages = [{'index': i, 'text': text} for i, text in enumerate(texts)]
+    return dict(
+        model="deepseek-chat",
+        messages=[
+            {"role": "system", "content": system_prompt() + BATCH_INSTRUCTIONS},
+            context_message(),
+            {"role": "user", "content": json.dumps(messages, ensure_ascii=False)},
         ],
-        "due_date": "YYYY-MM-DD HH:MM:SS" (Convert relative dates like 'besok' to ISO format),
-        "confidence": float (0.0 to 1.0)
-    }}
-    
-    Notes:
-    - If price is in text (e.g., '50rb', '50k'), convert to number (50000).
-    - If no specific time is given for a date, default to 09:00:00.
+        temperature=0.1,
+        response_format={'type': 'json_object'},
+        stream=False,
+    )
+
+
+def _decode_batch(ai_content, count):
+    """{index: parse} for every well-formed result; anything else is left out (-> fallback)."""
+    results = {}
+    entries = _decode_ai_content(ai_content)
+    if isinstance(entries, dict):
+        entries = entries.get('results')
+    for entry in entries if isinstance(entries, list) else []:
+        if not isinstance(entry, dict) or not entry.get('intent'):
+            continue
+        index = entry.pop('index', None)
+        if isinstance(index, int) and 0 <= index < count and index not in results:
+            results[index] = _expand_items(entry)
+    return results
+
+
+def parse_orders_with_ai_batch(texts):
+    """
+    Parses several messages with one DeepSeek call. Returns {index: parse}; indexes
+    missing from the answer (or all of them, if the call fails) must be parsed alone.
     """
+    if not llm_router.available('deepseek'):
+        return {}  # circuit open: each message goes to the router on its own
+    with stage('llm_parse_batch') as span:
+        try:
+            response = _complete('batch', _batch_request(texts), messages=len(texts))
+            results = _decode_batch(response.choices[0].message.content, len(texts))
+        except Exception as e:
+            print(f"DeepSeek Batch Error: {e}")
+            results = {}
+        llm_router.report('deepseek', bool(results))
+        if len(results) < len(texts):
+            span.outcome = 'partial' if results else 'error'
+        return results
 
-    try:
-        # 4. Generate Content
-        response = model.generate_content(prompt)
-        
-        # 5. Parse Response
-        # Gemini returns the text directly as JSON string
-        parsed_data = json.loads(response.text)
-        return parsed_data
-
-    except Exception as e:
-        print(f"Gemini Error: {e}")
-        return None
\ No newline at end of file
+
+async def aparse_orders_with_ai_batch(texts):
+    """parse_orders_with_ai_batch() on the async client."""
+    if not llm_router.available('deepseek'):
+        return {}  # circuit open: each message goes to the router on its own
+    with stage('llm_parse_batch') as span:
+        try:
+            response = await _acomplete('batch', _batch_request(texts), messages=len(texts))
+            results = _decode_batch(response.choices[0].message.content, len(texts))
+        except Exception as e:
+            print(f"DeepSeek Batch Error: {e}")
+            results = {}
+        llm_router.report('deepseek', bool(results))
+        if len(results) < len(texts):
+            span.outcome = 'partial' if results else 'error'
+        return results
+
+
+async def aparse_message(text_message, use_cache=True, on_event=None):
+    """Async parse_message(): same rules -> grammar -> cache -> DeepSeek order."""
+    rule_result = classify_intent(text_message) or parse_order_grammar(text_message)
+    if rule_result:
+        return rule_result
+
+    if not (use_cache and settings.LLM_CACHE_ENABLED):
+        parse_cache.record_bypass()
+        return await _aask_llm(text_message, on_event)
+
+    key = parse_cache.make_key(text_message)
+    # The shared tier is the DB cache, so the lookup runs off the event loop
+    cached = await sync_to_async(parse_cache.get)(key)
+    if cached is not None:
+        return cached
+
+    result = await _aask_llm(text_message, on_event)
+    if result:
+        await sync_to_async(parse_cache.set)(key, result)
+    return result
@@ -0,0 +1,205 @@
+import asyncio
+import contextvars
+import time
+import traceback
+import weakref
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import close_old_connections
+from .models import Order
+from .message_queue import mark_processed, mark_failed, release_messages
+from .agenda import get_agenda_page
+from .ai_service import aparse_message
+from .telegram_utils import asend_telegram_reply
+from .pipeline import (
+    AI_ERROR_REPLY, PROCESSING_REPLY, AIParseError, _target_ids, cancel_orders, clean_order_items, confirm_orders,
+    parse_due_date, render_review_reply, create_orders, stream_intent_action,
+)
+from .metrics import observe_message, set_intent
+
+# asyncio version of pipeline.handle_message(), used by the ASGI webhook
+# (views.telegram_webhook_async). DeepSeek and Telegram go through async HTTP clients
+# and the ORM through Django's async API; calendar events are left to the outbox
+# dispatcher (orders/calendar_outbox.py).
+# One process can keep hundreds of updates in flight while they wait on the network.
+
+
+async def ahandle_message(raw_msg):
+    """
+    Runs the intent pipeline for one saved RawMessage (customer must be loaded).
+    Returns a short status string; exceptions are left to the caller, like handle_message().
+    """
+    customer = raw_msg.customer
+    chat_id = customer.chat_id
+
+    streamed_items = []
+
+    async def on_event(event):
+        action = stream_intent_action(event, streamed_items)
+        if action == 'processing':
+            await asend_telegram_reply(chat_id, PROCESSING_REPLY)
+        return action
+
+    ai_result = await aparse_message(raw_msg.text, on_event=on_event)
+    if not ai_result:
+        raise AIParseError("no LLM provider could parse the message")
+
+    raw_intent = ai_result.get('intent', 'UNKNOWN')
+    intent = raw_intent.upper() if raw_intent else 'UNKNOWN'
+    set_intent(intent)
+
+    if intent == 'NEW_ORDER':
+        items = streamed_items or clean_order_items(ai_result.get('items'))
+        due_date = parse_due_date(ai_result.get('due_date'))
+        if not items:
+            await asend_telegram_reply(chat_id, "❓ I couldn't find any items in that order. Try 'Pesan 2 brownies buat besok'.")
+            return 'no_items'
+
+        # transaction.atomic() has no async form: the whole insert runs in one sync call
+        orders = await sync_to_async(create_orders)(customer, raw_msg, items, due_date)
+        await asend_telegram_reply(chat_id, render_review_reply(orders, ai_result.get('due_date')))
+
+    elif intent == 'CONFIRM':
+        target_ids = _target_ids(ai_result)
+        if target_ids:
+            queryset = Order.objects.filter(id__in=target_ids, customer=customer, status='PENDING')
+        else:
+            queryset = Order.objects.filter(customer=customer, status='PENDING').order_by('-created_at')[:1]
+        orders = [order async for order in queryset]
+
+        if not orders:
+            await asend_telegram_reply(chat_id, "❓ No pending order found to confirm.")
+            return 'ok'
+
+        # transaction.atomic() again: the status and the calendar outbox rows in one sync call
+        await sync_to_async(confirm_orders)(customer, orders, raw_msg)
+        await asend_telegram_reply(chat_id, "\n\n".join(
+            f"✅ Order #{order.id} ({order.item_description}) Confirmed!" for order in orders
+        ))
+
+    elif intent == 'CANCEL':
+        target_ids = _target_ids(ai_result)
+        if not target_ids:
+            await asend_telegram_reply(chat_id, "⚠️ To cancel, you must provide the ID (e.g., 'Cancel 5').")
+            return 'ok'
+
+        orders = [order async for order in Order.objects.filter(id__in=target_ids, customer=customer)]
+        if orders:
+            await sync_to_async(cancel_orders)(customer, orders, raw_msg)
+        found_ids = {o.id for o in orders}
+        lines = [f"❌ Order #{o.id} has been CANCELLED." for o in orders]
+        lines += [f"❓ Could not find Order #{i}." for i in target_ids if i not in found_ids]
+        await asend_telegram_reply(chat_id, "\n\n".join(lines))
+
+    elif intent == 'LIST_ORDERS':
+        page = await sync_to_async(get_agenda_page)(customer.id, ai_result.get('page'))
+        await asend_telegram_reply(chat_id, page)
+
+    else:
+        await asend_telegram_reply(chat_id, "I didn't understand. Try 'Pesan...', 'Ok [ID]', 'Cancel [ID]', or 'Cek Order'.")
+
+    return 'ok'
+
+
+class _LoopState:
+    """Concurrency limit, per-chat locks and running tasks of one event loop."""
+
+    def __init__(self):
+        self.semaphore = asyncio.Semaphore(settings.ASYNC_PIPELINE_CONCURRENCY)
+        self.chat_locks = {}  # customer_id -> [asyncio.Lock, users]
+        self.tasks = {}  # task -> the RawMessage it handles
+
+
+_states = weakref.WeakKeyDictionary()
+
+
+def _loop_state():
+    loop = asyncio.get_running_loop()
+    state = _states.get(loop)
+    if state is None:
+        state = _states[loop] = _LoopState()
+    return state
+
+
+async def _process(raw_msg):
+    state = _loop_state()
+    # Messages from the same chat run in arrival order ("Pesan ..." then "Ok 15")
+    entry = state.chat_locks.setdefault(raw_msg.customer_id, [asyncio.Lock(), 0])
+    entry[1] += 1
+    try:
+        async with entry[0], state.semaphore:
+            started = time.perf_counter()
+            try:
+                status = await ahandle_message(raw_msg)
+                if not raw_msg.is_processed:  # order changes mark it in their own transaction
+                    await sync_to_async(mark_processed)(raw_msg)
+                observe_message('async', status, time.perf_counter() - started)
+                print(f"Async pipeline: message #{raw_msg.id} -> {status}")
+            except Exception as e:
+                status = 'ai_error' if isinstance(e, AIParseError) else 'error'
+                if status == 'error':
+                    traceback.print_exc()
+                observe_message('async', status, time.perf_counter() - started)
+                # Same bookkeeping as the worker: it retries the message after the backoff
+                if await sync_to_async(mark_failed)(raw_msg, e) and status == 'ai_error':
+                    await asend_telegram_reply(raw_msg.customer.chat_id, AI_ERROR_REPLY)
+            finally:
+                await sync_to_async(close_old_connections)()
+    finally:
+        entry[1] -= 1
+        if not entry[1]:
+            del state.chat_locks[raw_msg.customer_id]
+
+
+def schedule_message(raw_msg):
+    """
+    Starts processing a saved RawMessage in the background of the running event loop
+    and returns the task. The task gets a fresh context, so it is not tied to the
+    request that created it; its ORM calls share asgiref's single sync thread.
+    """
+    state = _loop_state()
+    task = asyncio.get_running_loop().create_task(_process(raw_msg), context=contextvars.Context())
+    state.tasks[task] = raw_msg
+    task.add_done_callback(lambda done: state.tasks.pop(done, None))
+    return task
+
+
+async def wait_for_pending_messages():
+    """Waits until every message scheduled on this loop has been handled (benchmarks, shutdown)."""
+    state = _loop_state()
+    while state.tasks:
+        await asyncio.gather(*list(state.tasks), return_exceptions=True)
+
+
+async def shutdown_pending_messages(timeout):
+    """
+    For a server shutting down (or a worker being recycled): gives the scheduled messages
+    `timeout` seconds to finish, then cancels the rest and hands them back to the queue
+    (lease cleared, attempt not counted), so the worker picks them up at once instead of
+    after the lease runs out. Returns the number handed back.
+    """
+    state = _loop_state()
+    if not state.tasks:
+        return 0
+    _, unfinished = await asyncio.wait(list(state.tasks), timeout=timeout)
+    if not unfinished:
+        return 0
+    messages = [state.tasks[task] for task in unfinished]
+    for task in unfinished:
+        task.cancel()
+    await asyncio.gather(*unfinished, return_exceptions=True)
+    await sync_to_async(release_messages)(messages)
+    print(f"Async pipeline: shutting down, handed {len(messages)} unfinished messages back to the worker.")
+    return len(messages)
+
+
+async def lifespan(receive, send):
+    """ASGI lifespan protocol (config/asgi.py): drains the pipeline on lifespan.shutdown."""
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await shutdown_pending_messages(settings.ASYNC_PIPELINE_SHUTDOWN_SECONDS)
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
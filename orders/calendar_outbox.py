@@ -0,0 +1,223 @@
+import threading
+from collections import Counter
+from datetime import timedelta
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from django.db.models import F, Q
+from django.utils import timezone
+from .calendar_service import apply_calendar_changes, build_event_body, calendar_event_id_for
+from .models import CalendarSyncTask, Order
+
+# Transactional outbox for Google Calendar. Order changes never call the API: they
+# queue a CalendarSyncTask in their own transaction (Order.save() / delete() through
+# orders/signals.py, confirm_orders() / cancel_orders() in the pipeline). A dispatcher
+# (a thread of `process_messages`, or `manage.py sync_calendar`) drains the outbox:
+#   - tasks wait CALENDAR_SYNC_DELAY_SECONDS, so a burst of edits is one API call
+#   - all tasks of an order become one change, decided by the order's CURRENT state
+#     (insert, update or delete), and a round's changes go out as one batch request
+#   - failures are retried with exponential backoff, then parked as dead letters
+#   - events are inserted with a deterministic id (calendar_event_id_for), so a retry
+#     after a lost answer can't create a duplicate; the id is saved on the order
+
+CALENDAR_STATUSES = ('CONFIRMED', 'COMPLETED')  # orders that belong in the calendar
+
+_lock = threading.Lock()
+_stats = Counter()
+
+
+def wants_event(order):
+    return order.status in CALENDAR_STATUSES and order.due_date is not None
+
+
+def queue_calendar_sync(orders, deleted=False):
+    """
+    Queues a sync task for each order whose event may have to change (a PENDING order
+    without an event has none; neither has a deleted order that never got one). Call it
+    in the transaction that changes the orders.
+    """
+    available_at = timezone.now() + timedelta(seconds=settings.CALENDAR_SYNC_DELAY_SECONDS)
+    in_flight = _inserts_in_flight(orders) if deleted else set()
+    tasks = []
+    for order in orders:
+        if order.status == 'PENDING' and not order.calendar_event_id:
+            continue
+        if deleted:
+            if not order.calendar_event_id and order.id not in in_flight:
+                continue  # never got an event (e.g. seeded / benchmark orders): nothing to delete
+            # The event may exist even if its id was never saved (a lost insert answer)
+            action, event_id = 'delete', order.calendar_event_id or calendar_event_id_for(order)
+        elif wants_event(order):
+            action, event_id = ('update' if order.calendar_event_id else 'create'), order.calendar_event_id
+        else:
+            action, event_id = 'delete', order.calendar_event_id
+        tasks.append(CalendarSyncTask(order_id=order.id, action=action, event_id=event_id, available_at=available_at))
+    if tasks:
+        CalendarSyncTask.objects.bulk_create(tasks)
+    return len(tasks)
+
+
+def _inserts_in_flight(orders):
+    """Ids of deleted orders without a saved event id whose insert may have reached Google."""
+    ids = [order.id for order in orders if not order.calendar_event_id and wants_event(order)]
+    if not ids:
+        return set()
+    # A queued (or dead-lettered) task: its insert may have been sent, the answer lost
+    return set(CalendarSyncTask.objects.filter(order_id__in=ids).values_list('order_id', flat=True))
+
+
+def claim_calendar_tasks(limit, flush=False):
+    """
+    Claims up to `limit` ready tasks (SKIP LOCKED, with a lease like claim_messages),
+    skipping orders another dispatcher is working on. `flush` ignores the coalescing delay.
+    """
+    now = timezone.now()
+    ready = now + timedelta(seconds=settings.CALENDAR_SYNC_DELAY_SECONDS) if flush else now
+    lease = now + timedelta(seconds=settings.CALENDAR_SYNC_LEASE_SECONDS)
+
+    with transaction.atomic():
+        busy = CalendarSyncTask.objects.filter(claimed_until__gt=now).values('order_id')
+        tasks = list(
+            CalendarSyncTask.objects
+            .select_for_update(skip_locked=True)
+            .filter(is_dead_letter=False, available_at__lte=ready)
+            .filter(Q(claimed_until__isnull=True) | Q(claimed_until__lte=now))
+            .exclude(order_id__in=busy)
+            .order_by('available_at', 'id')[:limit]
+        )
+        if not tasks:
+            return []
+        CalendarSyncTask.objects.filter(id__in=[task.id for task in tasks]).update(
+            claimed_until=lease,
+            attempts=F('attempts') + 1,
+        )
+
+    for task in tasks:
+        task.attempts += 1
+        task.claimed_until = lease
+    return tasks
+
+
+def _change_for(order_id, order, tasks):
+    """(order_id, action, event_id, body) that makes the calendar match the order, or None."""
+    if order is not None and wants_event(order):
+        if order.calendar_event_id:
+            return order_id, 'update', order.calendar_event_id, build_event_body(order)
+        return order_id, 'insert', calendar_event_id_for(order), build_event_body(order)
+    if order is not None:
+        event_id = order.calendar_event_id
+    else:
+        event_id = next((task.event_id for task in reversed(tasks) if task.event_id), None)
+    return (order_id, 'delete', event_id, None) if event_id else None
+
+
+def _mark_failed(tasks, error):
+    attempts = max(task.attempts for task in tasks)
+    dead = attempts >= settings.CALENDAR_SYNC_MAX_ATTEMPTS
+    delay = min(settings.CALENDAR_SYNC_RETRY_BASE_SECONDS * (2 ** (attempts - 1)), 3600)
+    CalendarSyncTask.objects.filter(id__in=[task.id for task in tasks]).update(
+        claimed_until=None,
+        available_at=timezone.now() + timedelta(seconds=delay),
+        last_error=str(error)[:2000],
+        is_dead_letter=dead,
+    )
+    return dead
+
+
+def dispatch_calendar_sync(limit=None, flush=False):
+    """
+    One dispatcher round: claims ready tasks, sends one change per order (all in one
+    batch request) and records the outcome. Returns the number of tasks handled.
+    """
+    tasks = claim_calendar_tasks(limit or settings.CALENDAR_SYNC_BATCH_SIZE, flush)
+    if not tasks:
+        return 0
+
+    by_order = {}
+    for task in tasks:
+        by_order.setdefault(task.order_id, []).append(task)
+    orders = Order.objects.in_bulk(list(by_order))
+    changes = [change for order_id, order_tasks in by_order.items()
+               if (change := _change_for(order_id, orders.get(order_id), order_tasks))]
+
+    results = apply_calendar_changes(changes)
+    if results is None:
+        # Calendar not configured (no service_account.json): nothing to sync to
+        print(f"Calendar Sync: calendar not configured, dropping {len(tasks)} task(s).")
+        CalendarSyncTask.objects.filter(id__in=[task.id for task in tasks]).delete()
+        return len(tasks)
+
+    done = [order_id for order_id in by_order if order_id not in results]  # nothing to change
+    new_ids, failed = [], 0
+    for order_id, action, event_id, _ in changes:
+        result = results[order_id]
+        if result['error'] is None:
+            done.append(order_id)
+            if action == 'delete':
+                Order.objects.filter(id=order_id, calendar_event_id=event_id).update(calendar_event_id=None)
+            elif result['event_id'] != orders[order_id].calendar_event_id:
+                new_ids.append(Order(id=order_id, calendar_event_id=result['event_id']))
+            continue
+        if action == 'update' and result['status'] in (404, 410):
+            # Removed by hand in the calendar: forget the id, the retry creates a new event
+            Order.objects.filter(id=order_id, calendar_event_id=event_id).update(calendar_event_id=None)
+        failed += 1
+        if _mark_failed(by_order[order_id], result['error']):
+            print(f"Calendar Sync: order #{order_id} moved to dead letter: {result['error']}")
+
+    if new_ids:
+        # bulk_update sends no post_save, so recording the id doesn't queue another sync
+        Order.objects.bulk_update(new_ids, ['calendar_event_id'])
+    CalendarSyncTask.objects.filter(id__in=[task.id for order_id in done for task in by_order[order_id]]).delete()
+
+    with _lock:
+        _stats['tasks'] += len(tasks)
+        _stats['orders'] += len(by_order)
+        _stats['api_changes'] += len(changes)
+        _stats['failed'] += failed
+    return len(tasks)
+
+
+def drain_calendar_outbox(flush=True):
+    """Runs dispatcher rounds until nothing is ready. Returns the number of tasks handled."""
+    handled = 0
+    while count := dispatch_calendar_sync(flush=flush):
+        handled += count
+    return handled
+
+
+def run_calendar_dispatcher(stop_event, poll_interval=None):
+    """Dispatcher loop for a background thread; returns once `stop_event` is set."""
+    poll_interval = settings.CALENDAR_SYNC_POLL_SECONDS if poll_interval is None else poll_interval
+    try:
+        while not stop_event.is_set():
+            try:
+                close_old_connections()
+                handled = dispatch_calendar_sync()
+            except Exception as e:
+                print(f"Calendar Sync Error: {e}")
+                handled = 0
+            if not handled:
+                stop_event.wait(poll_interval)
+    finally:
+        close_old_connections()
+
+
+def start_calendar_dispatcher():
+    """Starts run_calendar_dispatcher() in a daemon thread. Returns its stop event."""
+    stop_event = threading.Event()
+    threading.Thread(target=run_calendar_dispatcher, args=(stop_event,), name='calendar-sync', daemon=True).start()
+    return stop_event
+
+
+def get_calendar_sync_stats():
+    """Tasks handled, orders they covered, calendar changes sent and failures, plus the backlog."""
+    with _lock:
+        stats = {key: _stats[key] for key in ('tasks', 'orders', 'api_changes', 'failed')}
+    stats['pending'] = CalendarSyncTask.objects.filter(is_dead_letter=False).count()
+    stats['dead_letter'] = CalendarSyncTask.objects.filter(is_dead_letter=True).count()
+    return stats
+
+
+def requeue_calendar_tasks(queryset):
+    """Puts dead-lettered (or backed-off) tasks back on the outbox with a fresh retry budget."""
+    return queryset.update(is_dead_letter=False, attempts=0, claimed_until=None, available_at=timezone.now())
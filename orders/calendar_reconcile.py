@@ -0,0 +1,167 @@
+import re
+from collections import Counter
+from datetime import timedelta
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from .calendar_outbox import CALENDAR_STATUSES, queue_calendar_sync, wants_event
+from .calendar_service import (
+    CalendarSyncTokenExpired, _get_calendar_id, apply_calendar_changes, build_event_body, list_event_changes,
+)
+from .models import CalendarSyncTask, Order
+from .sync_state import get_sync_state, set_sync_state
+
+# Drift repair between Order.calendar_event_id and the calendar (`manage.py reconcile_calendar`).
+# The calendar is listed incrementally: Google's syncToken returns only the events changed
+# since the last run (deleted ones with status 'cancelled'), so a run costs the number of
+# changes, not the size of the calendar. Changed events are matched to orders through
+# order_calendar_event_idx, or through their deterministic id (calendar_event_id_for) when
+# the order never saved it. The orders are the source of truth:
+#   - event deleted by hand, order still CONFIRMED -> queued update (restores the event)
+#   - event deleted, order no longer wants one     -> the order forgets the id
+#   - live event of a cancelled order              -> queued delete
+#   - event edited by hand (summary / start)       -> queued update
+#   - our event, order has no id saved             -> the order adopts it
+#   - our event, order has another one / none due  -> deleted (a duplicate)
+# Orders with a sync already queued are left to the dispatcher. Events that aren't ours
+# (no order references them, no order id prefix) are never touched. An order that never
+# got an event leaves no change to list: full listings also queue those (queue_unsynced_orders).
+
+SYNC_TOKEN_KEY = 'calendar:syncToken:{}'
+
+_OWN_EVENT_ID = re.compile(rf'{re.escape(settings.CALENDAR_EVENT_ID_PREFIX)}(\d+)')
+
+
+def _drifted(order, event):
+    """True if the event's summary or start no longer match the order."""
+    start = parse_datetime((event.get('start') or {}).get('dateTime') or '')
+    return event.get('summary') != build_event_body(order)['summary'] or start != order.due_date
+
+
+def reconcile_events(events, dry_run=False, delete_orphans=False):
+    """
+    Repairs the orders behind one page of changed events, in bulk. Returns a Counter of
+    what was found. `delete_orphans` also deletes our events whose order no longer exists.
+    """
+    counts = Counter(events=len(events))
+    by_id = {event['id']: event for event in events}
+    orders = {order.calendar_event_id: order for order in Order.objects.filter(calendar_event_id__in=list(by_id))}
+    unclaimed = {
+        event_id: int(match.group(1)) for event_id in by_id
+        if event_id not in orders and (match := _OWN_EVENT_ID.fullmatch(event_id))
+    }
+    owners = Order.objects.in_bulk(set(unclaimed.values()))
+    queued = set(
+        CalendarSyncTask.objects
+        .filter(order_id__in=[order.id for order in orders.values()] + list(owners), is_dead_letter=False)
+        .values_list('order_id', flat=True)
+    )
+
+    resync, forget, adopt, stray = [], [], [], []
+    for event_id, event in by_id.items():
+        cancelled = event.get('status') == 'cancelled'
+        order = orders.get(event_id)
+        if order is None:
+            if event_id not in unclaimed or cancelled:
+                continue  # not ours, or already gone
+            owner = owners.get(unclaimed[event_id])
+            if owner is None:
+                if delete_orphans:
+                    stray.append(event_id)
+                counts['orphaned'] += 1
+            elif owner.id in queued:
+                counts['queued'] += 1
+            elif wants_event(owner) and not owner.calendar_event_id:
+                owner.calendar_event_id = event_id
+                adopt.append(owner)
+                counts['adopted'] += 1
+            else:
+                stray.append(event_id)
+                counts['duplicates'] += 1
+        elif order.id in queued:
+            counts['queued'] += 1
+        elif cancelled:
+            if wants_event(order):
+                resync.append(order)
+                counts['restored'] += 1
+            else:
+                forget.append(order)
+                counts['forgotten'] += 1
+        elif not wants_event(order):
+            resync.append(order)
+            counts['stale'] += 1
+        elif _drifted(order, event):
+            resync.append(order)
+            counts['drifted'] += 1
+
+    if dry_run:
+        return counts
+    with transaction.atomic():
+        # bulk_update / update send no post_save: only `resync` queues a sync. Both only
+        # touch ids the dispatcher hasn't changed since they were read.
+        if adopt:
+            free = set(
+                Order.objects.select_for_update()
+                .filter(id__in=[order.id for order in adopt], calendar_event_id__isnull=True)
+                .values_list('id', flat=True)
+            )
+            Order.objects.bulk_update([order for order in adopt if order.id in free], ['calendar_event_id'])
+        if forget:
+            Order.objects.filter(
+                id__in=[order.id for order in forget],
+                calendar_event_id__in=[order.calendar_event_id for order in forget],
+            ).update(calendar_event_id=None)
+        queue_calendar_sync(resync)
+    if stray:
+        results = apply_calendar_changes([(event_id, 'delete', event_id, None) for event_id in stray]) or {}
+        counts['delete_failed'] += sum(1 for result in results.values() if result['error'])
+    return counts
+
+
+def queue_unsynced_orders(dry_run=False, horizon_days=1):
+    """
+    Queues a sync for upcoming orders that belong in the calendar but have no event and
+    no sync queued (an insert that failed before the outbox, a purged dead letter). Scans
+    the orders, so it runs with full listings only. Returns how many.
+    """
+    orders = list(
+        Order.objects
+        .filter(status__in=CALENDAR_STATUSES, calendar_event_id__isnull=True,
+                due_date__gte=timezone.now() - timedelta(days=horizon_days))
+        .exclude(id__in=CalendarSyncTask.objects.values('order_id'))
+    )
+    if orders and not dry_run:
+        queue_calendar_sync(orders)
+    return len(orders)
+
+
+def reconcile_calendar(full=False, dry_run=False, delete_orphans=False):
+    """
+    One reconciliation run: lists the calendar changes since the stored syncToken (all
+    events on the first run, with `full`, or once Google expires the token), repairs them
+    page by page, then stores the new token. Returns a Counter of what was found.
+    """
+    key = SYNC_TOKEN_KEY.format(_get_calendar_id())
+    sync_token = None if full else get_sync_state(key)
+    counts = Counter(full_listing=int(sync_token is None))
+
+    def run(token):
+        next_token = None
+        for events, next_token in list_event_changes(token):
+            counts.update(reconcile_events(events, dry_run, delete_orphans))
+        return next_token
+
+    try:
+        next_token = run(sync_token)
+    except CalendarSyncTokenExpired:
+        print("Calendar Reconcile: sync token expired, listing the whole calendar.")
+        counts = Counter(full_listing=1)
+        next_token = run(None)
+
+    if counts['full_listing']:
+        counts['unsynced'] = queue_unsynced_orders(dry_run)
+    # Stored only after the repairs: a failed run lists the same changes again
+    if next_token and not dry_run:
+        set_sync_state(key, next_token)
+    return counts
@@ -1,53 +1,116 @@
 import os
+import json
+import threading
+import httplib2
+import google_auth_httplib2
+from google.auth.credentials import AnonymousCredentials
 from google.oauth2 import service_account
-from googleapiclient.discovery import build
+from googleapiclient.discovery import build_from_document
+from googleapiclient.discovery_cache import get_static_doc
+from googleapiclient.errors import HttpError
 from datetime import timedelta
+from django.conf import settings
+from .metrics import stage
 
 # We look for the file in the same folder as manage.py
 SCOPES = ['https://www.googleapis.com/auth/calendar']
 SERVICE_ACCOUNT_FILE = 'service_account.json'
 
-def create_calendar_event(order):
+# Point the client at a local stub (e.g. http://127.0.0.1:8099/) for tests / load tests.
+# In that mode a missing service_account.json falls back to anonymous credentials.
+CALENDAR_API_ROOT_URL = os.environ.get('CALENDAR_API_ROOT_URL')
 
-    # --- DEBUG PRINTS ---
-    target_calendar = os.environ.get('CALENDAR_ID')
-    print(f"DEBUG: .env variable CALENDAR_ID is: '{target_calendar}'")
-    
-    if not target_calendar:
+# Google accepts up to 1000 calls per batch, but recommends staying around 50
+BATCH_SIZE = 50
+
+# --- Process-wide client state ---
+# Credentials and the discovery document are loaded once per process. The access
+# token is reused until it expires. httplib2 is NOT thread-safe, so every thread
+# gets its own service object (built from the already-parsed discovery doc).
+_lock = threading.Lock()
+_credentials = None
+_discovery_doc = None
+_local = threading.local()
+
+
+def _get_calendar_id():
+    calendar_id = os.environ.get('CALENDAR_ID')
+    if not calendar_id:
         print("WARNING: No CALENDAR_ID found. Defaulting to 'primary' (The Bot's Calendar).")
-        calendar_id = 'primary'
-    else:
-        calendar_id = target_calendar
-    # --------------------
+        return 'primary'
+    return calendar_id
+
+
+def _get_credentials():
+    global _credentials
+
+    if _credentials is None:
+        with _lock:
+            if _credentials is None:
+                if os.path.exists(SERVICE_ACCOUNT_FILE):
+                    _credentials = service_account.Credentials.from_service_account_file(
+                        SERVICE_ACCOUNT_FILE, scopes=SCOPES
+                    )
+                elif CALENDAR_API_ROOT_URL:
+                    _credentials = AnonymousCredentials()
+                else:
+                    print("Error: service_account.json not found.")
+                    return None
+
+    # Refresh under the lock so concurrent workers don't all fetch a new token at once
+    if not _credentials.valid:
+        with _lock:
+            if not _credentials.valid:
+                _credentials.refresh(google_auth_httplib2.Request(httplib2.Http(timeout=30)))
+
+    return _credentials
+
+
+def _get_discovery_doc():
+    """The Calendar v3 discovery document bundled with google-api-python-client, parsed once."""
+    global _discovery_doc
+    if _discovery_doc is None:
+        with _lock:
+            if _discovery_doc is None:
+                doc = json.loads(get_static_doc('calendar', 'v3'))
+                if CALENDAR_API_ROOT_URL:
+                    # rootUrl drives both the REST base URL and the batch endpoint
+                    doc['rootUrl'] = CALENDAR_API_ROOT_URL.rstrip('/') + '/'
+                _discovery_doc = doc
+    return _discovery_doc
 
+
+def get_calendar_service():
     """
-    Takes an Order object and adds it to Google Calendar.
+    Returns this thread's Calendar service (or None if credentials are missing).
+    No disk read, discovery fetch or token request happens in the steady state.
     """
-    # 1. Authenticate
-    if not os.path.exists(SERVICE_ACCOUNT_FILE):
-        print("Error: service_account.json not found.")
-        return False
+    credentials = _get_credentials()
+    if credentials is None:
+        return None
+
+    service = getattr(_local, 'service', None)
+    if service is None:
+        http = google_auth_httplib2.AuthorizedHttp(credentials, http=httplib2.Http(timeout=30))
+        service = build_from_document(_get_discovery_doc(), http=http)
+        _local.service = service
+    return service
 
-    creds = service_account.Credentials.from_service_account_file(
-        SERVICE_ACCOUNT_FILE, scopes=SCOPES
-    )
-    service = build('calendar', 'v3', credentials=creds)
 
-    # 2. Prepare Event Details
+def build_event_body(order):
+    """Google Calendar event payload for an Order."""
     # Default to 1 hour duration
     start_time = order.due_date
     end_time = start_time + timedelta(hours=1)
-    
-    summary = f"Order: {order.quantity}x {order.item_description}"
+
     description = f"""
     Client: {order.client_name}
     Item: {order.item_description}
     Qty: {order.quantity}
-    Price: Rp {order.price:,}
+    Price: Rp {order.price or 0:,}
     """
 
-    event = {
-        # 'summary': summary,
+    return {
         'summary': f"{order.client_name} - {order.item_description}",
         'description': description,
         'start': {
@@ -60,46 +123,124 @@ def create_calendar_event(order):
         },
     }
 
-    try:
-        # # 3. Insert Event (using 'primary' calendar of the account shared with)
-        # # We assume the user shared THEIR primary calendar with this service account
-        # # In that case, we actually need to target the USER'S email calendar ID, 
-        # # or easier: Put the User's Email in .env as CALENDAR_ID
-        # calendar_id = os.environ.get('CALENDAR_ID', 'primary')
-        
-        # event = service.events().insert(calendarId=calendar_id, body=event).execute()
-        # print(f"Event created: {event.get('htmlLink')}")
-        # return True
-        
-        service = build('calendar', 'v3', credentials=creds)
-        
-        # Execute and GET the result
-        created_event = service.events().insert(calendarId=CALENDAR_ID, body=event).execute()
-        
-        print(f"Event created: {created_event.get('htmlLink')}")
-        
-        # --- RETURN THE ID ---
-        return created_event.get('id') 
-        # ---------------------
-        
-    
-    except Exception as e:
-        print(f"Calendar Error: {e}")
-        return False
-
-def delete_calendar_event(event_id):
-    if not event_id:
+
+def _execute_in_batches(service, calls):
+    """
+    Runs (key, request) pairs through the Google batch endpoint, BATCH_SIZE per HTTP call.
+    Returns {key: (response, error)}; one failing call never fails the others.
+    """
+    results = {}
+
+    def on_response(request_id, response, exception):
+        results[request_id] = (response, exception)
+
+    for start in range(0, len(calls), BATCH_SIZE):
+        batch = service.new_batch_http_request(callback=on_response)
+        for key, request in calls[start:start + BATCH_SIZE]:
+            batch.add(request, request_id=str(key))
+        try:
+            batch.execute()
+        except Exception as e:
+            # Transport-level failure: every call in this chunk failed
+            for key, _ in calls[start:start + BATCH_SIZE]:
+                results.setdefault(str(key), (None, e))
+
+    return results
+
+
+def calendar_event_id_for(order):
+    """
+    The id an order's event is created with. A retried insert (the first answer was
+    lost) then finds the event instead of creating a second one.
+    """
+    return f"{settings.CALENDAR_EVENT_ID_PREFIX}{order.id}"
+
+
+def _error_status(error):
+    return getattr(getattr(error, 'resp', None), 'status', None)
+
+
+def apply_calendar_changes(changes):
+    """
+    Applies (key, action, event_id, body) changes in as few HTTP calls as possible:
+    'insert' creates the event with that id, 'update' replaces it (and restores a
+    deleted one), 'delete' removes it. An insert whose id already exists becomes an
+    update; a delete of an event that is already gone succeeds.
+    Returns {key: {'event_id': str | None, 'error': str | None, 'status': int | None}},
+    or None if the calendar is not configured.
+    """
+    if not changes:
+        return {}
+
+    with stage('calendar_sync') as span:
+        service = get_calendar_service()
+        if service is None:
+            span.outcome = 'not_configured'
+            return None
+
+        calendar_id = _get_calendar_id()
+        events = service.events()
+
+        def request(action, event_id, body):
+            if action == 'insert':
+                return events.insert(calendarId=calendar_id, body=dict(body, id=event_id))
+            if action == 'update':
+                return events.update(calendarId=calendar_id, eventId=event_id, body=dict(body, status='confirmed'))
+            return events.delete(calendarId=calendar_id, eventId=event_id)
+
+        outcome = {}
+        while changes:
+            results = _execute_in_batches(
+                service, [(key, request(action, event_id, body)) for key, action, event_id, body in changes]
+            )
+            retry = []
+            for key, action, event_id, body in changes:
+                response, error = results.get(str(key), (None, 'No response in batch'))
+                status = _error_status(error)
+                if action == 'insert' and status == 409:
+                    retry.append((key, 'update', event_id, body))
+                    continue
+                if action == 'delete' and status in (404, 410):
+                    error = None
+                if error:
+                    print(f"Calendar Error ({action} {event_id}): {error}")
+                    span.outcome = 'error'
+                outcome[key] = {
+                    'event_id': (response or {}).get('id', event_id) if not error and action != 'delete' else None,
+                    'error': str(error) if error else None,
+                    'status': status,
+                }
+            changes = retry
+        return outcome
+
+
+class CalendarSyncTokenExpired(Exception):
+    """Google no longer accepts the stored syncToken (410 Gone): a full listing is needed."""
+
+
+def list_event_changes(sync_token=None, page_size=250):
+    """
+    Yields (events, next_sync_token) page by page. With `sync_token`, only the events
+    changed since the listing that returned it; without, every event (the first run).
+    Deleted events are included, with status 'cancelled'. next_sync_token is only set
+    on the last page. Raises CalendarSyncTokenExpired when the token is too old.
+    """
+    service = get_calendar_service()
+    if service is None:
         return
+    params = {'calendarId': _get_calendar_id(), 'maxResults': page_size, 'showDeleted': True}
+    if sync_token:
+        params['syncToken'] = sync_token
 
-    # ... Setup service (same as create) ...
-    creds = service_account.Credentials.from_service_account_file(
-        SERVICE_ACCOUNT_FILE, scopes=SCOPES
-    )
-    service = build('calendar', 'v3', credentials=creds)
-    CALENDAR_ID = os.environ.get('CALENDAR_ID', 'primary')
-
-    try:
-        service.events().delete(calendarId=CALENDAR_ID, eventId=event_id).execute()
-        print(f"✅ Successfully deleted event {event_id}")
-    except Exception as e:
-        print(f"❌ Failed to delete event: {e}")
\ No newline at end of file
+    while True:
+        with stage('calendar_list'):
+            try:
+                response = service.events().list(**params).execute()
+            except HttpError as e:
+                if e.resp.status == 410:
+                    raise CalendarSyncTokenExpired() from e
+                raise
+        yield response.get('items', []), response.get('nextSyncToken')
+        if not response.get('nextPageToken'):
+            return
+        params['pageToken'] = response['nextPageToken']
@@ -0,0 +1,72 @@
+import threading
+import time
+from collections import namedtuple
+from django.conf import settings
+from django.core.cache import cache
+from .models import Customer
+
+# Read-through cache: Telegram chat_id -> (customer pk, name).
+# The customer set is small and almost never changes, so the webhook can resolve
+# the sender without a SELECT (or SELECT + INSERT) per update. Tiers:
+#   1. in-process dict (bounded staleness: CUSTOMER_CACHE_TTL_SECONDS)
+#   2. shared Django cache (invalidated by the Customer post_save/post_delete signal)
+#   3. the database (get_or_create)
+
+CachedCustomer = namedtuple('CachedCustomer', ['pk', 'chat_id', 'name'])
+
+_local_cache = {}  # chat_id -> (expires_at, CachedCustomer)
+_lock = threading.Lock()
+stats = {'local_hits': 0, 'shared_hits': 0, 'db_lookups': 0}
+
+
+def _cache_key(chat_id):
+    return f"customer:{chat_id}"
+
+
+def resolve_customer(chat_id, sender_name, platform='TG'):
+    """Returns the CachedCustomer for a chat, creating the Customer on first contact."""
+    chat_id = str(chat_id)
+    now = time.monotonic()
+
+    with _lock:
+        entry = _local_cache.get(chat_id)
+        if entry and entry[0] > now:
+            stats['local_hits'] += 1
+            return entry[1]
+
+    try:
+        customer = cache.get(_cache_key(chat_id))
+    except Exception as e:
+        print(f"Customer Cache Error (shared get): {e}")
+        customer = None
+
+    if customer is not None:
+        customer = CachedCustomer(*customer)
+        with _lock:
+            stats['shared_hits'] += 1
+    else:
+        obj, _ = Customer.objects.get_or_create(
+            chat_id=chat_id,
+            defaults={'name': sender_name, 'platform': platform}
+        )
+        customer = CachedCustomer(obj.pk, obj.chat_id, obj.name)
+        with _lock:
+            stats['db_lookups'] += 1
+        try:
+            cache.set(_cache_key(chat_id), tuple(customer), timeout=None)
+        except Exception as e:
+            print(f"Customer Cache Error (shared set): {e}")
+
+    with _lock:
+        _local_cache[chat_id] = (now + settings.CUSTOMER_CACHE_TTL_SECONDS, customer)
+    return customer
+
+
+def invalidate_customer(chat_id):
+    chat_id = str(chat_id)
+    with _lock:
+        _local_cache.pop(chat_id, None)
+    try:
+        cache.delete(_cache_key(chat_id))
+    except Exception as e:
+        print(f"Customer Cache Error (delete): {e}")
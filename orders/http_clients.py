@@ -0,0 +1,147 @@
+import asyncio
+import threading
+import httpx
+from django.conf import settings
+
+# Shared outbound HTTP layer for DeepSeek and Telegram.
+# One long-lived httpx.Client per upstream host keeps TCP+TLS connections warm
+# (keep-alive), so e.g. the several replies of a CONFIRM reuse one connection
+# instead of paying a new handshake to api.telegram.org each time.
+
+try:
+    import h2  # noqa: F401  (optional: enables HTTP/2 in httpx)
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+_clients = {}
+_async_clients = {}  # (name, event loop) -> httpx.AsyncClient
+_stats = {}
+_lock = threading.Lock()
+
+
+class _ConnectionTracer:
+    """
+    httpx "trace" extension callback. httpcore only emits connect_tcp events when it
+    opens a NEW connection, so counting them against requests gives the reuse rate.
+    """
+
+    def __init__(self, name):
+        self.name = name
+
+    def __call__(self, event_name, info):
+        if event_name == 'connection.connect_tcp.complete':
+            with _lock:
+                _stats[self.name]['new_connections'] += 1
+
+
+class _AsyncConnectionTracer(_ConnectionTracer):
+    # httpcore awaits the trace callback on async connections
+    async def __call__(self, event_name, info):
+        super().__call__(event_name, info)
+
+
+def _make_request_hook(name):
+    tracer = _ConnectionTracer(name)
+
+    def on_request(request):
+        request.extensions['trace'] = tracer
+        with _lock:
+            _stats[name]['requests'] += 1
+
+    return on_request
+
+
+def get_http_client(name, timeout=None):
+    """
+    Returns the process-wide pooled client for an upstream ('deepseek', 'telegram', ...).
+    Clients are thread-safe and sized from settings.HTTP_POOL_* (defaults follow the
+    worker concurrency, so every worker thread can hold a warm connection).
+    """
+    client = _clients.get(name)
+    if client is not None:
+        return client
+
+    with _lock:
+        if name not in _clients:
+            _stats[name] = {'requests': 0, 'new_connections': 0}
+            _clients[name] = httpx.Client(
+                http2=HTTP2_AVAILABLE,
+                limits=httpx.Limits(
+                    max_connections=settings.HTTP_POOL_MAX_CONNECTIONS,
+                    max_keepalive_connections=settings.HTTP_POOL_MAX_KEEPALIVE,
+                    keepalive_expiry=settings.HTTP_POOL_KEEPALIVE_SECONDS,
+                ),
+                timeout=timeout or httpx.Timeout(settings.HTTP_TIMEOUT_SECONDS, connect=5.0),
+                event_hooks={'request': [_make_request_hook(name)]},
+            )
+        return _clients[name]
+
+
+def _make_async_request_hook(name):
+    tracer = _AsyncConnectionTracer(name)
+
+    async def on_request(request):
+        request.extensions['trace'] = tracer
+        with _lock:
+            _stats[name]['requests'] += 1
+
+    return on_request
+
+
+def get_async_http_client(name, timeout=None):
+    """
+    asyncio counterpart of get_http_client() for the async pipeline.
+    Async connections belong to the event loop that opened them, so there is one
+    client per (upstream, loop); under uvicorn that is one per process. Its pool is
+    sized from settings.ASYNC_PIPELINE_CONCURRENCY, not the worker thread count.
+    """
+    loop = asyncio.get_running_loop()
+    key = (name, loop)
+    client = _async_clients.get(key)
+    if client is not None:
+        return client
+
+    with _lock:
+        if key not in _async_clients:
+            stats_name = f"{name} (async)"
+            _stats.setdefault(stats_name, {'requests': 0, 'new_connections': 0})
+            _async_clients[key] = httpx.AsyncClient(
+                http2=HTTP2_AVAILABLE,
+                limits=httpx.Limits(
+                    max_connections=settings.ASYNC_PIPELINE_CONCURRENCY,
+                    max_keepalive_connections=settings.ASYNC_PIPELINE_CONCURRENCY,
+                    keepalive_expiry=settings.HTTP_POOL_KEEPALIVE_SECONDS,
+                ),
+                timeout=timeout or httpx.Timeout(settings.HTTP_TIMEOUT_SECONDS, connect=5.0),
+                event_hooks={'request': [_make_async_request_hook(stats_name)]},
+            )
+        return _async_clients[key]
+
+
+def get_http_stats():
+    """Per-upstream request / new-connection counters and the connection reuse rate."""
+    with _lock:
+        stats = {name: dict(values) for name, values in _stats.items()}
+    for values in stats.values():
+        requests = values['requests']
+        values['reuse_rate'] = (1 - values['new_connections'] / requests) if requests else 0.0
+        values['http2'] = HTTP2_AVAILABLE
+    return stats
+
+
+def close_http_clients():
+    with _lock:
+        for client in _clients.values():
+            client.close()
+        _clients.clear()
+
+
+async def aclose_http_clients():
+    """Closes the async clients that belong to the running event loop."""
+    loop = asyncio.get_running_loop()
+    with _lock:
+        keys = [key for key in _async_clients if key[1] is loop]
+        clients = [_async_clients.pop(key) for key in keys]
+    for client in clients:
+        await client.aclose()
@@ -0,0 +1,113 @@
+from collections import Counter
+from django.db import IntegrityError, transaction
+from .models import RawMessage
+from .customer_cache import resolve_customer, invalidate_customer
+from .metrics import stage
+from .update_dedup import claim_update, claim_updates, seen_recently, update_id_of
+
+# Turning Telegram updates into queued RawMessages, shared by both ingest paths:
+# the webhooks (one update per request) and `manage.py poll_updates` (getUpdates
+# batches of up to 100, saved with one claim INSERT and one bulk INSERT).
+
+
+def read_update(data):
+    """
+    Pulls (chat_id, text, sender_name) out of a Telegram update.
+    Returns (None, reason) for updates we ignore.
+    """
+    # Safety Check 1: Does 'message' exist?
+    if 'message' not in data:
+        return None, 'ignored - no message found'
+
+    message_data = data['message']
+
+    # Safety Check 2: Extract data safely using .get()
+    # If 'chat' is missing, we can't reply, so we ignore it
+    if 'chat' not in message_data:
+        return None, 'ignored - no chat id'
+
+    chat_id = message_data['chat']['id']
+    text = message_data.get('text', '')
+
+    # Handle missing 'from' field (this was your error!)
+    from_data = message_data.get('from', {})
+    sender_name = from_data.get('first_name', 'Unknown Owner')
+    return (chat_id, text, sender_name), None
+
+
+def _insert_raw_message(customer, update_id, data, text, fields):
+    """Claims the update_id and saves the RawMessage in one transaction; None for a redelivery."""
+    with transaction.atomic():
+        if update_id is not None and not claim_update(update_id):
+            return None
+        return RawMessage.objects.create(customer_id=customer.pk, text=text, meta_data=data, **fields)
+
+
+def save_update(data, chat_id, text, sender_name, **fields):
+    """
+    Save Raw Message (this is the job the worker will pick up).
+    The sender is resolved from the customer cache, not a query per update.
+    Returns (None, customer) when the update_id was already saved (Telegram redelivery).
+    """
+    update_id = update_id_of(data)
+    with stage('customer_lookup'):
+        customer = resolve_customer(chat_id, sender_name)
+    try:
+        with stage('raw_message_insert'):
+            raw_msg = _insert_raw_message(customer, update_id, data, text, fields)
+    except IntegrityError:
+        # Cached customer was deleted in the meantime: drop the stale entry and retry once
+        invalidate_customer(chat_id)
+        customer = resolve_customer(chat_id, sender_name)
+        raw_msg = _insert_raw_message(customer, update_id, data, text, fields)
+    return raw_msg, customer
+
+
+def _insert_batch(rows, customers):
+    with transaction.atomic():
+        claimed = claim_updates([update_id for update_id, _, _ in rows if update_id is not None])
+        return RawMessage.objects.bulk_create([
+            RawMessage(customer_id=customers[chat_id].pk, text=text, meta_data=data)
+            for update_id, data, (chat_id, text, _) in rows
+            if update_id is None or update_id in claimed
+        ])
+
+
+def ingest_updates(updates):
+    """
+    Batch save_update() for getUpdates results. Duplicates and ignored updates are
+    dropped first; the rest are claimed and inserted in one transaction.
+    Returns (saved RawMessages, Counter of 'queued' / 'duplicate' / 'ignored').
+    """
+    counts = Counter()
+    rows = {}  # update_id (or position) -> (update_id, data, fields); a batch may repeat an id
+    for position, data in enumerate(updates):
+        update_id = update_id_of(data)
+        if seen_recently(update_id) or update_id in rows:
+            counts['duplicate'] += 1
+            continue
+        fields, ignored = read_update(data)
+        if ignored:
+            counts['ignored'] += 1
+            continue
+        rows[update_id if update_id is not None else f"#{position}"] = (update_id, data, fields)
+    rows = list(rows.values())
+    if not rows:
+        return [], counts
+
+    senders = {chat_id: sender_name for _, _, (chat_id, _, sender_name) in rows}
+    with stage('customer_lookup'):
+        customers = {chat_id: resolve_customer(chat_id, name) for chat_id, name in senders.items()}
+    try:
+        with stage('raw_message_insert'):
+            saved = _insert_batch(rows, customers)
+    except IntegrityError:
+        # A cached customer was deleted in the meantime: re-resolve them all and retry once
+        for chat_id in senders:
+            invalidate_customer(chat_id)
+        customers = {chat_id: resolve_customer(chat_id, name) for chat_id, name in senders.items()}
+        saved = _insert_batch(rows, customers)
+
+    counts['queued'] += len(saved)
+    counts['duplicate'] += len(rows) - len(saved)
+    return saved, counts
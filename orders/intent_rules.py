@@ -0,0 +1,107 @@
+import re
+import threading
+from collections import Counter
+
+# Fast-path classifier for command-style messages ("Ok 15", "Batal 12", "Cek order").
+# These are the canonical CONFIRM / CANCEL / LIST_ORDERS examples from the AI prompt,
+# so we resolve them locally and only send NEW_ORDER / ambiguous text to DeepSeek.
+# Every pattern must match the WHOLE (normalized) message: "Ok 15 tapi jamnya ganti"
+# is not a plain confirm and falls through to the LLM.
+
+_IDS = r"(?:order|pesanan|id)?\s*#?(?P<ids>\d+(?:\s*(?:,|dan|&|\s)\s*#?\d+)*)"
+
+_RULES = [
+    ('CONFIRM', re.compile(
+        r"(?:ok|okk|oke|okey|okay|okeh|ya|yes|iya|y|sip|siap|deal|confirm|konfirmasi|setuju)"
+        r"(?:[\s,]+" + _IDS + r")?"
+    )),
+    ('CANCEL', re.compile(
+        r"(?:batal|batalkan|cancel|hapus|gak jadi|ga jadi|tidak jadi)"
+        r"(?:[\s,]+" + _IDS + r")?"
+    )),
+    ('LIST_ORDERS', re.compile(
+        r"(?:(?:cek|check|lihat|list|show|daftar)\s+(?:order|orders|pesanan|jadwal|schedule)"
+        r"|jadwal|list|list hari ini|cek hari ini|order hari ini|pesanan hari ini)"
+        r"(?:\s+(?:hari ini|besok|minggu ini))?"
+        # The page needs its keyword: "cek order 2" is about order 2, not page 2
+        r"(?:\s+(?:hal|halaman|page)\s*(?P<page>\d+))?"
+    )),
+]
+
+_PUNCTUATION = re.compile(r"[^\w#,&\s]")
+_SPACES = re.compile(r"\s+")
+
+_lock = threading.Lock()
+_hits = Counter()
+_checked = 0      # messages classified
+_fallthrough = 0  # of those, sent to the LLM (not answered by rules, grammar or cache)
+
+
+def normalize_text(text):
+    """Lowercases, drops punctuation (except '#', ',' and '&') and collapses whitespace."""
+    text = _PUNCTUATION.sub(" ", (text or "").lower())
+    return _SPACES.sub(" ", text).strip()
+
+
+def classify_intent(text):
+    """
+    Returns an AI-shaped result dict for command-style messages, or None when the
+    message needs the LLM (new orders, free text, anything ambiguous).
+    """
+    global _checked
+    normalized = normalize_text(text)
+    with _lock:
+        _checked += 1
+
+    for intent, pattern in _RULES:
+        match = pattern.fullmatch(normalized)
+        if not match:
+            continue
+
+        groups = match.groupdict()
+        ids_text = groups.get('ids')
+        order_ids = [int(i) for i in re.findall(r"\d+", ids_text)] if ids_text else []
+
+        with _lock:
+            _hits[intent] += 1
+        return {
+            'intent': intent,
+            'items': [],
+            'due_date': None,
+            'order_id': order_ids[0] if order_ids else None,
+            'order_ids': order_ids,
+            'page': int(groups['page']) if groups.get('page') else None,
+            'source': 'rules',
+        }
+    return None
+
+
+def record_fallthrough():
+    """Counts a classified message that the LLM had to parse (called by ai_service)."""
+    global _fallthrough
+    with _lock:
+        _fallthrough += 1
+
+
+def get_rule_stats():
+    """
+    Per-intent rule hits plus the share of messages that never reached the LLM
+    (answered by the rules, the order grammar or the parse cache).
+    """
+    with _lock:
+        hits = dict(_hits)
+        total = _checked
+        fallthrough = _fallthrough
+    return {
+        'hits': hits,
+        'fallthrough': fallthrough,
+        'total': total,
+        'hit_rate': ((total - fallthrough) / total) if total else 0.0,
+    }
+
+
+def reset_rule_stats():
+    global _checked, _fallthrough
+    with _lock:
+        _hits.clear()
+        _checked = _fallthrough = 0
@@ -0,0 +1,311 @@
+import asyncio
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from asgiref.sync import sync_to_async
+from django.db import connections
+from .llm_usage import record_llm_call
+from prometheus_client import Counter
+
+# Provider routing for single-message parses (ai_service.parse_order_with_ai):
+#   1. providers are tried in LLM_PROVIDERS order; one that failed LLM_BREAKER_FAILURES
+#      times in a row is skipped (circuit open) for LLM_BREAKER_COOLDOWN_SECONDS, then
+#      gets another try
+#   2. a request slower than the LLM_HEDGE_PERCENTILE of its provider's recent latencies
+#      gets a hedged second request (next provider, or the same one if it is alone);
+#      the first good answer wins. At most LLM_HEDGE_BUDGET of the requests are hedged,
+#      so a provider that is slow for everyone doesn't get twice the load
+#   3. if every attempt fails, the remaining providers are tried one at a time
+# A provider has a `name` and parse(text, hedge=False) / async aparse(...) returning the
+# decoded parse dict; they raise on any failure.
+
+provider_requests = Counter(
+    'orders_llm_provider_requests_total',
+    "LLM parse requests by provider and outcome (ok / error).",
+    ['provider', 'outcome'],
+)
+
+
+def release_db_after(fn, *args):
+    """
+    Runs fn(*args) on a pool thread, then closes the thread's DB connections: calls write
+    LLMCall rows (record_llm_call), and a pooled connection only goes back on close.
+    """
+    try:
+        return fn(*args)
+    finally:
+        connections.close_all()
+
+
+class ProviderHealth:
+    """Circuit breaker and recent successful latencies of one provider."""
+
+    def __init__(self, name, failure_threshold, cooldown, window=200):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self._latencies = deque(maxlen=window)
+        self._failures = 0
+        self._opened_at = None  # monotonic time the circuit opened; None = closed
+        self._lock = threading.Lock()
+
+    def available(self):
+        """Closed, or open long enough that the next call is a trial (half-open)."""
+        with self._lock:
+            return self._opened_at is None or time.monotonic() - self._opened_at >= self.cooldown
+
+    @property
+    def state(self):
+        if self._opened_at is None:
+            return 'closed'
+        return 'half_open' if self.available() else 'open'
+
+    def record(self, ok, seconds=None):
+        with self._lock:
+            if ok:
+                if self._opened_at is not None:
+                    print(f"LLM provider '{self.name}' recovered; circuit closed.")
+                self._failures = 0
+                self._opened_at = None
+                if seconds is not None:
+                    self._latencies.append(seconds)
+                return
+            self._failures += 1
+            if self._failures >= self.failure_threshold:
+                if self._opened_at is None:
+                    print(f"LLM provider '{self.name}' failed {self._failures}x in a row; circuit open.")
+                # A failed trial after the cooldown starts a new cooldown
+                self._opened_at = time.monotonic()
+
+    def latency_percentile(self, percentile, min_samples):
+        """The `percentile` of the recent latencies, or None with fewer than `min_samples`."""
+        with self._lock:
+            if len(self._latencies) < max(1, min_samples):
+                return None
+            ordered = sorted(self._latencies)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * percentile / 100))]
+
+
+class LLMRouter:
+    def __init__(self, providers, hedge_percentile, hedge_min_samples, failure_threshold, cooldown,
+                 hedge_budget=0.05, hedge_workers=16):
+        self.providers = {provider.name: provider for provider in providers}  # preference order
+        self.health = {name: ProviderHealth(name, failure_threshold, cooldown) for name in self.providers}
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_samples = hedge_min_samples
+        self.hedge_budget = hedge_budget
+        self.hedge_workers = hedge_workers
+        self.stats = {'hedged': 0, 'hedge_wins': 0, 'hedges_over_budget': 0, 'fallbacks': 0, 'all_down': 0}
+        self._hedge_tokens = 1.0  # each request earns `hedge_budget` of a hedge (capped at 10)
+        self._pool = None
+        self._lock = threading.Lock()
+
+    def available(self, name):
+        """True if `name` is configured and its circuit lets a call through."""
+        health = self.health.get(name)
+        return health is not None and health.available()
+
+    def report(self, name, ok, seconds=None):
+        """Outcome of a call made outside the router (DeepSeek batch / stream)."""
+        if name in self.health:
+            self._record(name, ok, seconds)
+
+    def snapshot(self):
+        with self._lock:
+            stats = dict(self.stats)
+        return {**stats, 'circuits': {name: health.state for name, health in self.health.items()}}
+
+    def parse(self, text_message):
+        """The first good parse from the available providers, or None if all failed."""
+        plan = self._plan()
+        if not plan:
+            return None
+
+        hedge = self._hedge_plan(plan)
+        if hedge:
+            result = self._parse_hedged(text_message, plan[0], *hedge)
+            tried = {plan[0], hedge[0]}
+        else:
+            result = self._call(plan[0], text_message)
+            tried = {plan[0]}
+
+        for name in self._fallbacks(plan, tried):
+            if result is not None:
+                break
+            if self.health[name].available():
+                self._count('fallbacks')
+                result = self._call(name, text_message)
+        return result
+
+    async def aparse(self, text_message):
+        """parse() on the event loop; a hedge race's loser is cancelled."""
+        plan = self._plan()
+        if not plan:
+            return None
+
+        hedge = self._hedge_plan(plan)
+        if hedge:
+            result = await self._aparse_hedged(text_message, plan[0], *hedge)
+            tried = {plan[0], hedge[0]}
+        else:
+            result = await self._acall(plan[0], text_message)
+            tried = {plan[0]}
+
+        for name in self._fallbacks(plan, tried):
+            if result is not None:
+                break
+            if self.health[name].available():
+                self._count('fallbacks')
+                result = await self._acall(name, text_message)
+        return result
+
+    def _plan(self):
+        plan = [name for name in self.providers if self.health[name].available()]
+        if not plan:
+            self._count('all_down')
+        return plan
+
+    def _hedge_plan(self, plan):
+        """(hedge provider, delay in seconds), or None when there is nothing to hedge on yet."""
+        if not self.hedge_percentile:
+            return None
+        with self._lock:
+            self._hedge_tokens = min(10.0, self._hedge_tokens + self.hedge_budget)
+        delay = self.health[plan[0]].latency_percentile(self.hedge_percentile, self.hedge_min_samples)
+        if delay is None:
+            return None
+        return (plan[1] if len(plan) > 1 else plan[0]), delay
+
+    def _take_hedge_token(self):
+        with self._lock:
+            if self._hedge_tokens < 1:
+                self.stats['hedges_over_budget'] += 1
+                return False
+            self._hedge_tokens -= 1
+            self.stats['hedged'] += 1
+            return True
+
+    @staticmethod
+    def _fallbacks(plan, tried):
+        # A lone provider gets one retry; otherwise each untried provider gets a turn
+        return plan[:1] if len(plan) == 1 else [name for name in plan if name not in tried]
+
+    def _call(self, name, text_message, hedge=False):
+        """One provider call: the parse, or None (the failure counts towards its circuit)."""
+        started = time.monotonic()
+        try:
+            result = self.providers[name].parse(text_message, hedge=hedge)
+        except Exception as e:
+            print(f"LLM Provider Error ({name}): {e}")
+            result = None
+        self._record(name, result is not None, time.monotonic() - started)
+        return result
+
+    async def _acall(self, name, text_message, hedge=False):
+        started = time.monotonic()
+        try:
+            result = await self.providers[name].aparse(text_message, hedge=hedge)
+        except Exception as e:
+            print(f"LLM Provider Error ({name}): {e}")
+            result = None
+        # (a cancelled hedge loser raises CancelledError past this: neither success nor failure)
+        self._record(name, result is not None, time.monotonic() - started)
+        return result
+
+    def _parse_hedged(self, text_message, primary, secondary, delay):
+        pool = self._executor()
+        first = pool.submit(release_db_after, self._call, primary, text_message)
+        done, _ = wait([first], timeout=delay)
+        if done or not self._take_hedge_token():
+            return first.result()
+
+        second = pool.submit(release_db_after, self._call, secondary, text_message, True)
+        pending = {first, second}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                result = future.result()
+                if result is not None:
+                    if future is second:
+                        self._count('hedge_wins')
+                    # A thread can't be cancelled: the slower call finishes in the background
+                    return result
+        return None
+
+    async def _aparse_hedged(self, text_message, primary, secondary, delay):
+        first = asyncio.ensure_future(self._acall(primary, text_message))
+        done, _ = await asyncio.wait({first}, timeout=delay)
+        if done or not self._take_hedge_token():
+            return await first
+
+        second = asyncio.ensure_future(self._acall(secondary, text_message, True))
+        pending = {first, second}
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.result() is not None:
+                        if task is second:
+                            self._count('hedge_wins')
+                        return task.result()
+            return None
+        finally:
+            for task in pending:
+                task.cancel()
+
+    def _executor(self):
+        with self._lock:
+            if self._pool is None:
+                self._pool = ThreadPoolExecutor(max_workers=self.hedge_workers, thread_name_prefix='llm-hedge')
+            return self._pool
+
+    def _record(self, name, ok, seconds):
+        self.health[name].record(ok, seconds)
+        provider_requests.labels(provider=name, outcome='ok' if ok else 'error').inc()
+
+    def _count(self, key):
+        with self._lock:
+            self.stats[key] += 1
+
+
+class StubProvider:
+    """
+    Offline provider for tests and demos: answers with the DeepSeek stub's rules
+    (orders/stub_servers.py) after an exponentially distributed delay averaging
+    `latency` seconds, and fails `failure_rate` of the calls. Past `timeout` a call
+    fails like a real timeout.
+    """
+    name = 'stub'
+    model = 'stub'
+
+    def __init__(self, latency, failure_rate, timeout):
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.timeout = timeout
+        from .stub_servers import FakeDeepSeek  # test / load-test code: only loaded when configured
+        self._fake = FakeDeepSeek()
+
+    def _delay(self):
+        return random.expovariate(1 / self.latency) if self.latency > 0 else 0.0
+
+    def _answer(self, text_message, delay, started, hedge):
+        ok = delay <= self.timeout and random.random() >= self.failure_rate
+        record_llm_call('parse', self.model, None, time.monotonic() - started,
+                        provider=self.name, hedge=hedge, ok=ok)
+        if delay > self.timeout:
+            raise TimeoutError(f"stub provider timed out after {self.timeout}s")
+        if not ok:
+            raise RuntimeError("stub provider failure (LLM_STUB_FAILURE_RATE)")
+        return self._fake.answer(text_message)
+
+    def parse(self, text_message, hedge=False):
+        started, delay = time.monotonic(), self._delay()
+        time.sleep(min(delay, self.timeout))
+        return self._answer(text_message, delay, started, hedge)
+
+    async def aparse(self, text_message, hedge=False):
+        started, delay = time.monotonic(), self._delay()
+        await asyncio.sleep(min(delay, self.timeout))
+        return await sync_to_async(self._answer)(text_message, delay, started, hedge)
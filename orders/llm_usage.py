@@ -0,0 +1,97 @@
+from django.conf import settings
+from django.db.models import Avg, Count, Max, Q, Sum
+from .models import LLMCall, Order
+from prometheus_client import Counter
+
+# Token accounting for DeepSeek calls: one LLMCall row per chat completion plus
+# Prometheus counters. DeepSeek caches identical prompt prefixes automatically and
+# reports the cached part as `prompt_cache_hit_tokens` (billed at a fraction of
+# the price), so the system prompt is kept constant (see ai_service.SYSTEM_PROMPT).
+
+llm_tokens = Counter(
+    'orders_llm_tokens_total',
+    "DeepSeek tokens by kind: prompt (all input), cached (input served from the prefix cache), completion.",
+    ['kind'],
+)
+
+
+def usage_of(response):
+    """(prompt, cached, completion) tokens of a chat completion response; zeros if it has no usage."""
+    usage = getattr(response, 'usage', None)
+    if usage is None:
+        return 0, 0, 0
+    cached = getattr(usage, 'prompt_cache_hit_tokens', None)
+    if cached is None:
+        # OpenAI-style usage reports it under prompt_tokens_details
+        details = getattr(usage, 'prompt_tokens_details', None)
+        cached = getattr(details, 'cached_tokens', None) or 0
+    return usage.prompt_tokens or 0, cached, usage.completion_tokens or 0
+
+
+def record_llm_call(kind, model, response, seconds, messages=1, provider='deepseek', hedge=False, ok=None):
+    """
+    Records one chat completion. `response` is None if the call failed, unless `ok`
+    says otherwise (providers without a usage report); `hedge` marks a hedged request.
+    """
+    prompt, cached, completion = usage_of(response)
+    llm_tokens.labels(kind='prompt').inc(prompt)
+    llm_tokens.labels(kind='cached').inc(cached)
+    llm_tokens.labels(kind='completion').inc(completion)
+    if not settings.LLM_USAGE_LOGGING:
+        return
+    try:
+        LLMCall.objects.create(
+            kind=kind,
+            provider=provider,
+            hedge=hedge,
+            model=getattr(response, 'model', None) or model,
+            messages=messages,
+            prompt_tokens=prompt,
+            cached_tokens=cached,
+            completion_tokens=completion,
+            latency_ms=round(seconds * 1000),
+            ok=response is not None if ok is None else ok,
+        )
+    except Exception as e:
+        # Accounting must never fail the parse itself
+        print(f"LLM Usage Error: {e}")
+
+
+def usage_summary(since):
+    """Totals of the LLM calls since `since`, with the cache hit rate, cost and cost per order."""
+    calls = LLMCall.objects.filter(created_at__gte=since)
+    totals = calls.aggregate(
+        calls=Count('id'), messages=Sum('messages'), prompt=Sum('prompt_tokens'), cached=Sum('cached_tokens'),
+        completion=Sum('completion_tokens'), latency_avg=Avg('latency_ms'), latency_max=Max('latency_ms'),
+    )
+    totals = {key: value or 0 for key, value in totals.items()}
+    totals['errors'] = calls.filter(ok=False).count()
+    totals['cache_hit_rate'] = totals['cached'] / totals['prompt'] if totals['prompt'] else 0.0
+
+    # USD per million tokens
+    totals['cost'] = (
+        totals['cached'] * settings.DEEPSEEK_PRICE_CACHE_HIT
+        + (totals['prompt'] - totals['cached']) * settings.DEEPSEEK_PRICE_CACHE_MISS
+        + totals['completion'] * settings.DEEPSEEK_PRICE_OUTPUT
+    ) / 1_000_000
+    # Orders the bot created from chat messages (not admin / seeded ones)
+    totals['orders'] = Order.objects.filter(created_at__gte=since, source_message__isnull=False).count()
+    totals['cost_per_order'] = totals['cost'] / totals['orders'] if totals['orders'] else None
+    return totals
+
+
+def usage_by_provider(since):
+    """Per provider: calls, failures, hedged requests and mean latency since `since`."""
+    return list(
+        LLMCall.objects.filter(created_at__gte=since)
+        .values('provider')
+        .annotate(calls=Count('id'), errors=Count('id', filter=Q(ok=False)),
+                  hedges=Count('id', filter=Q(hedge=True)), latency_avg=Avg('latency_ms'))
+        .order_by('-calls')
+    )
+
+
+def prune_llm_calls(older_than):
+    """Deletes LLMCall rows created before `older_than`. Returns the count."""
+    deleted, _ = LLMCall.objects.filter(created_at__lt=older_than).delete()
+    return deleted
@@ -0,0 +1,108 @@
+import random
+import statistics
+import time
+
+# Synthetic Telegram traffic for `manage.py load_test`: realistic Indonesian messages
+# from a small bakery's customers, in the shape Telegram POSTs to the webhook.
+
+NAMES = ['Budi', 'Ani', 'Siti', 'Dewi', 'Rina', 'Agus', 'Bella', 'Putri', 'Joko', 'Wati', 'Yusuf', 'Maya']
+ITEMS = [
+    ('brownies', 85), ('kue lapis', 120), ('bolu pandan', 95), ('nastar', 150), ('kastengel', 160),
+    ('risoles', 5), ('lemper', 4), ('klepon', 3), ('pie susu', 6), ('tart coklat', 250),
+]
+DAYS = ['besok', 'lusa', 'hari sabtu', 'tanggal 25', 'minggu depan']
+
+TEMPLATES = {
+    'NEW_ORDER': [
+        "{name} pesan {qty} {item} buat {day}",
+        "Pesan {qty} {item} {price}k buat {name}, ambil {day} jam {hour}",
+        "Order {qty} {item} dan {qty2} {item2} buat {name} {day}",
+        "Beli {qty} box {item} @{price}rb, atas nama {name}, kirim {day}",
+        "Kak, {name} mau pesan {qty} {item} ya buat {day} 🙏",
+    ],
+    'CONFIRM': ["Ok", "Ok {id}", "Ya", "Oke {id}", "Siap, ok {id}", "Ok {id}, {id2}"],
+    'CANCEL': ["Batal {id}", "Cancel #{id}", "Batalin {id} ya", "Gak jadi {id}"],
+    'LIST_ORDERS': ["Cek order", "cek order 2", "List hari ini", "Order apa aja besok?", "Jadwal"],
+}
+
+DEFAULT_MIX = {'NEW_ORDER': 50, 'CONFIRM': 20, 'CANCEL': 10, 'LIST_ORDERS': 20}
+
+
+def parse_mix(value):
+    """'new=50,confirm=20,cancel=10,list=20' -> {'NEW_ORDER': 50, ...}"""
+    aliases = {'new': 'NEW_ORDER', 'confirm': 'CONFIRM', 'cancel': 'CANCEL', 'list': 'LIST_ORDERS'}
+    mix = {}
+    for part in value.split(','):
+        key, _, weight = part.partition('=')
+        intent = aliases.get(key.strip().lower(), key.strip().upper())
+        if intent not in TEMPLATES:
+            raise ValueError(f"Unknown intent in mix: {key!r}")
+        mix[intent] = float(weight)
+    return mix
+
+
+def generate_updates(count, chats, chat_prefix, mix=None, seed=None, order_ids=None, duplicate_rate=0.0):
+    """
+    Yields (intent, update) pairs. `order_ids` maps chat_id -> existing order ids so
+    CONFIRM / CANCEL can reference real orders; without it they use random ids.
+    With `duplicate_rate`, that share of updates is sent again later as a Telegram
+    redelivery (same update_id), with intent 'DUPLICATE'.
+    """
+    rng = random.Random(seed)
+    mix = mix or DEFAULT_MIX
+    intents, weights = zip(*mix.items())
+    order_ids = order_ids or {}
+    # Not from the seed: a repeated run must not look like redeliveries of the last one
+    base_update = time.time_ns() // 1000 % 10**12
+    sent = []
+
+    for i in range(count):
+        if sent and rng.random() < duplicate_rate:
+            yield 'DUPLICATE', rng.choice(sent)
+            continue
+        chat_number = rng.randrange(chats)
+        chat_id = f"{chat_prefix}{chat_number}"
+        owner = NAMES[chat_number % len(NAMES)]
+        intent = rng.choices(intents, weights)[0]
+
+        (item, price), (item2, _) = rng.sample(ITEMS, 2)
+        known = order_ids.get(chat_id) or [rng.randint(1, 5000)]
+        text = rng.choice(TEMPLATES[intent]).format(
+            name=rng.choice(NAMES), qty=rng.randint(1, 30), qty2=rng.randint(1, 30),
+            item=item, item2=item2, price=price, day=rng.choice(DAYS), hour=rng.randint(8, 17),
+            id=rng.choice(known), id2=rng.choice(known),
+        )
+        update = {
+            'update_id': base_update + i,
+            'message': {
+                'message_id': i + 1,
+                'from': {'id': 700000 + chat_number, 'is_bot': False, 'first_name': owner, 'language_code': 'id'},
+                'chat': {'id': chat_id, 'first_name': owner, 'type': 'private'},
+                'date': int(time.time()),
+                'text': text,
+            },
+        }
+        sent.append(update)
+        yield intent, update
+
+
+def percentile(sorted_values, q):
+    """Nearest-rank percentile of an already sorted list (nan when empty)."""
+    if not sorted_values:
+        return float('nan')
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * q))]
+
+
+def summarize(values):
+    """p50/p95/p99/max/mean of a list of numbers, rounded for JSON reports."""
+    values = sorted(values)
+    if not values:
+        return {'count': 0}
+    return {
+        'count': len(values),
+        'p50': round(percentile(values, 0.50), 3),
+        'p95': round(percentile(values, 0.95), 3),
+        'p99': round(percentile(values, 0.99), 3),
+        'max': round(values[-1], 3),
+        'mean': round(statistics.fmean(values), 3),
+    }
@@ -0,0 +1,128 @@
+import asyncio
+import contextlib
+import io
+import os
+import time
+from urllib.parse import urlparse
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.test import AsyncClient, Client
+from orders.models import Customer, RawMessage
+from orders.async_pipeline import wait_for_pending_messages
+from orders.load_testing import percentile
+from orders.stub_servers import start_calendar_stub, start_deepseek_stub, start_telegram_stub
+
+BENCH_PREFIX = 'bench-async-'
+STUB_ENV = ('DEEPSEEK_API_BASE', 'TELEGRAM_API_BASE', 'CALENDAR_API_ROOT_URL')
+
+
+class Command(BaseCommand):
+    help = (
+        "End-to-end benchmark of the sync path (webhook + process_messages worker) against the "
+        "async ASGI path (webhook_async + event loop), from first POST to last reply. "
+        "Needs the stub env vars (DEEPSEEK_API_BASE, TELEGRAM_API_BASE, CALENDAR_API_ROOT_URL); "
+        "with --start-stubs the stubs run in this process on those ports. The stubs have no flood "
+        "control, so also raise TELEGRAM_GLOBAL_RATE, or the 30 msg/s limit dominates both runs."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--messages', type=int, default=200)
+        parser.add_argument('--chats', type=int, default=50)
+        parser.add_argument('--mode', choices=['both', 'sync', 'async'], default='both')
+        parser.add_argument('--sync-threads', type=int, default=settings.ORDER_WORKER_CONCURRENCY)
+        parser.add_argument('--start-stubs', action='store_true')
+        parser.add_argument('--latency', type=float, default=0.05, help="Calendar/Telegram stub latency (s).")
+        parser.add_argument('--llm-latency', type=float, default=0.5, help="DeepSeek stub latency (s).")
+        parser.add_argument('--llm-token-latency', type=float, default=0.0,
+                            help="Extra DeepSeek stub latency per completion token (s).")
+
+    def handle(self, *args, **options):
+        missing = [name for name in STUB_ENV if not os.environ.get(name)]
+        if missing:
+            raise CommandError(f"Point the app at the stubs first; missing: {', '.join(missing)}")
+        os.environ.setdefault('TELEGRAM_BOT_TOKEN', 'bench')
+
+        if options['start_stubs']:
+            ports = {name: urlparse(os.environ[name]).port for name in STUB_ENV}
+            start_deepseek_stub(port=ports['DEEPSEEK_API_BASE'], latency=options['llm_latency'],
+                                token_latency=options['llm_token_latency'])
+            start_telegram_stub(port=ports['TELEGRAM_API_BASE'], latency=options['latency'])
+            start_calendar_stub(port=ports['CALENDAR_API_ROOT_URL'], latency=options['latency'])
+
+        results = {}
+        if options['mode'] in ('both', 'sync'):
+            results['sync'] = self._run_sync(options)
+        if options['mode'] in ('both', 'async'):
+            results['async'] = asyncio.run(self._run_async(options))
+
+        self.stdout.write(f"\n{options['messages']} messages from {options['chats']} chats")
+        self.stdout.write("mode    wall (s)   msg/s   ack p50/p95 (ms)   end-to-end p50/p95 (ms)")
+        for mode, r in results.items():
+            self.stdout.write(
+                f"{mode:<6} {r['wall']:>9.2f} {r['throughput']:>7.1f}   "
+                f"{r['ack_p50']:>7.1f} / {r['ack_p95']:<7.1f}   {r['e2e_p50']:>9.1f} / {r['e2e_p95']:.1f}"
+            )
+
+    def _payloads(self, count, chats, run):
+        # Distinct texts, so every message misses the parse cache and goes to the LLM stub.
+        # Fresh update_ids per run, or the de-duplication would drop the second run.
+        base_update = time.time_ns() // 1000 % 10**12
+        for i in range(count):
+            chat = f"{BENCH_PREFIX}{i % chats}"
+            yield {
+                'update_id': base_update + i,
+                'message': {
+                    'message_id': i,
+                    'chat': {'id': chat},
+                    'from': {'first_name': f"Bench {i % chats}"},
+                    'text': f"Budi pesan {1 + i % 5} brownies batch {run}-{i} buat besok",
+                },
+            }
+
+    def _reset(self):
+        Customer.objects.filter(chat_id__startswith=BENCH_PREFIX).delete()
+
+    def _summary(self, wall, acks):
+        messages = RawMessage.objects.filter(customer__chat_id__startswith=BENCH_PREFIX, is_processed=True)
+        e2e = sorted((m.processed_at - m.timestamp).total_seconds() * 1000 for m in messages)
+        acks = sorted(acks)
+        return {
+            'wall': wall,
+            'throughput': len(e2e) / wall if wall else 0.0,
+            'ack_p50': percentile(acks, 0.5),
+            'ack_p95': percentile(acks, 0.95),
+            'e2e_p50': percentile(e2e, 0.5),
+            'e2e_p95': percentile(e2e, 0.95),
+        }
+
+    def _run_sync(self, options):
+        self._reset()
+        client = Client()
+        acks = []
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            for payload in self._payloads(options['messages'], options['chats'], 'sync'):
+                sent = time.perf_counter()
+                client.post('/webhooks/telegram/', payload, content_type='application/json')
+                acks.append((time.perf_counter() - sent) * 1000)
+            call_command('process_messages', once=True, concurrency=options['sync_threads'])
+        return self._summary(time.perf_counter() - start, acks)
+
+    async def _run_async(self, options):
+        await sync_to_async(self._reset)()
+        client = AsyncClient()
+        acks = []
+
+        async def post(payload):
+            sent = time.perf_counter()
+            await client.post('/webhooks/telegram/async/', payload, content_type='application/json')
+            acks.append((time.perf_counter() - sent) * 1000)
+
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            await asyncio.gather(*(post(p) for p in self._payloads(options['messages'], options['chats'], 'async')))
+            await wait_for_pending_messages()
+        wall = time.perf_counter() - start
+        return await sync_to_async(self._summary)(wall, acks)
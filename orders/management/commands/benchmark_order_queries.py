@@ -0,0 +1,142 @@
+import re
+from datetime import timedelta
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.utils import timezone
+from orders.models import Customer, Order
+from orders.agenda import agenda_range_filter
+
+# Indexes added by migration 0006; dropped inside a rolled-back transaction for the "before" run
+NEW_INDEXES = ['order_cust_status_created_idx', 'order_pending_by_cust_idx', 'order_active_due_idx']
+
+BENCH_PREFIX = 'bench-'
+
+
+class Command(BaseCommand):
+    help = (
+        "Seeds benchmark orders (default 1,000,000) and prints EXPLAIN ANALYZE timings for the "
+        "bot's hot queries without (before) and with (after) the 0006 indexes. PostgreSQL only. "
+        "Run it against a scratch database only: it writes the orders into whatever DATABASES "
+        "points at, and the 'before' run drops the indexes inside a transaction, which locks "
+        "orders_order (ACCESS EXCLUSIVE) until it rolls back. Refuses to run without --scratch-db."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--orders', type=int, default=1_000_000, help="Orders to seed (0 = reuse existing bench data).")
+        parser.add_argument('--customers', type=int, default=500)
+        parser.add_argument('--plans', action='store_true', help="Print the full plans, not just timings.")
+        parser.add_argument('--cleanup', action='store_true', help="Delete the benchmark customers/orders and exit.")
+        parser.add_argument('--scratch-db', action='store_true',
+                            help="Confirm the configured database is a scratch copy (not the live bot's).")
+
+    def handle(self, *args, **options):
+        if connection.vendor != 'postgresql':
+            raise CommandError("This benchmark needs PostgreSQL (EXPLAIN ANALYZE, transactional DDL).")
+
+        if options['cleanup']:
+            deleted, _ = Customer.objects.filter(chat_id__startswith=BENCH_PREFIX).delete()
+            self.stdout.write(f"Deleted {deleted} benchmark rows.")
+            return
+
+        if not options['scratch_db']:
+            raise CommandError(
+                f"Refusing to benchmark database '{connection.settings_dict['NAME']}': the benchmark "
+                "seeds orders into it and locks orders_order while the indexes are dropped. "
+                "Point POSTGRES_DB at a scratch database and pass --scratch-db."
+            )
+
+        if options['orders']:
+            self._seed(options['orders'], options['customers'])
+
+        customer = Customer.objects.filter(chat_id__startswith=BENCH_PREFIX).order_by('id').first()
+        if customer is None:
+            raise CommandError("No benchmark data found; run with --orders N first.")
+
+        today = timezone.localdate()
+        queries = {
+            'CONFIRM (ids)': Order.objects.filter(
+                id__in=list(Order.objects.filter(customer=customer).values_list('id', flat=True)[:3]),
+                customer=customer, status='PENDING',
+            ),
+            'CONFIRM fallback': Order.objects.filter(customer=customer, status='PENDING').order_by('-created_at')[:1],
+            'CANCEL': Order.objects.filter(id=Order.objects.filter(customer=customer).values_list('id', flat=True).first(), customer=customer),
+            'LIST_ORDERS (old __date)': Order.objects.filter(
+                customer=customer, due_date__date__range=[today, today + timedelta(days=3)]
+            ).exclude(status='CANCELLED').order_by('due_date'),
+            'LIST_ORDERS (sargable)': Order.objects.filter(
+                customer=customer, **agenda_range_filter()
+            ).exclude(status='CANCELLED').order_by('due_date'),
+        }
+
+        # "Before": drop the new indexes inside a transaction, measure, roll back (DDL is transactional
+        # in Postgres). DROP INDEX holds an ACCESS EXCLUSIVE lock on the table until then: scratch DB only.
+        with transaction.atomic():
+            with connection.cursor() as cursor:
+                for name in NEW_INDEXES:
+                    cursor.execute(f'DROP INDEX IF EXISTS "{name}"')
+            before = self._explain_all(queries, options['plans'], label='before')
+            transaction.set_rollback(True)
+
+        after = self._explain_all(queries, options['plans'], label='after')
+
+        self.stdout.write("\nQuery                          before (ms)   after (ms)")
+        for name in queries:
+            self.stdout.write(f"{name:<30} {before[name]:>11.3f}  {after[name]:>11.3f}")
+
+    def _seed(self, total_orders, total_customers):
+        customer_table = Customer._meta.db_table
+        order_table = Order._meta.db_table
+        self.stdout.write(f"Seeding {total_orders:,} orders across {total_customers} customers...")
+
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.execute(
+                f"""
+                INSERT INTO {customer_table} (chat_id, platform, name, created_at)
+                SELECT %s || g, 'TG', 'Bench ' || g, now()
+                FROM generate_series(1, %s) AS g
+                ON CONFLICT (chat_id) DO NOTHING
+                """,
+                [BENCH_PREFIX, total_customers],
+            )
+            # Mostly history (COMPLETED/CONFIRMED), some PENDING/CANCELLED, due dates spread
+            # over the past year and the next month.
+            cursor.execute(
+                f"""
+                WITH ids AS (
+                    SELECT array_agg(id ORDER BY id) AS ids, count(*) AS n
+                    FROM {customer_table} WHERE chat_id LIKE %s
+                ), rows AS (
+                    SELECT g,
+                           now() - interval '365 days' + random() * interval '395 days' AS due
+                    FROM generate_series(1, %s) AS g
+                )
+                INSERT INTO {order_table}
+                    (customer_id, client_name, item_description, quantity, price, due_date,
+                     ai_confidence, status, created_at)
+                SELECT ids.ids[1 + (rows.g %% ids.n)], 'Bench', 'Kue ' || (rows.g %% 50), 1 + rows.g %% 5,
+                       10000 * (1 + rows.g %% 20), rows.due, 1.0,
+                       CASE WHEN rows.due > now() THEN
+                                CASE rows.g %% 4 WHEN 0 THEN 'PENDING' WHEN 1 THEN 'CANCELLED' ELSE 'CONFIRMED' END
+                            ELSE CASE rows.g %% 10 WHEN 0 THEN 'CANCELLED' ELSE 'COMPLETED' END
+                       END,
+                       rows.due - interval '2 days'
+                FROM rows, ids
+                """,
+                [BENCH_PREFIX + '%', total_orders],
+            )
+        with connection.cursor() as cursor:
+            cursor.execute(f"ANALYZE {customer_table}")
+            cursor.execute(f"ANALYZE {order_table}")
+        self.stdout.write("Seeded and analyzed.")
+
+    def _explain_all(self, queries, show_plans, label):
+        timings = {}
+        for name, queryset in queries.items():
+            # First run warms the cache; the second one is measured
+            queryset.explain(analyze=True)
+            plan = queryset.explain(analyze=True, buffers=True)
+            match = re.search(r"Execution Time: ([\d.]+) ms", plan)
+            timings[name] = float(match.group(1)) if match else float('nan')
+            if show_plans:
+                self.stdout.write(f"\n--- {name} [{label}] ---\n{plan}")
+        return timings
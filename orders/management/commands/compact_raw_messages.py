@@ -0,0 +1,55 @@
+from datetime import date, timedelta
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from orders.raw_message_storage import (
+    compact_messages, detach_partitions_before, ensure_partitions, is_partitioned, add_months,
+)
+from orders.llm_usage import prune_llm_calls
+from orders.update_dedup import prune_updates
+
+
+class Command(BaseCommand):
+    help = (
+        "RawMessage retention: compresses old payloads, creates upcoming monthly partitions "
+        "and detaches months past the retention period (PostgreSQL). Safe to run daily from cron."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--hot-days', type=int, default=settings.RAW_MESSAGE_HOT_DAYS,
+                            help="Keep the full payload uncompressed for this many days.")
+        parser.add_argument('--retention-months', type=int, default=settings.RAW_MESSAGE_RETENTION_MONTHS,
+                            help="Detach monthly partitions older than this (0 = keep everything).")
+        parser.add_argument('--months-ahead', type=int, default=3,
+                            help="Create partitions up to this many months ahead.")
+        parser.add_argument('--drop', action='store_true',
+                            help="Drop detached partitions instead of keeping them as *_archive tables.")
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        # 1. Compress payloads that left the hot window
+        cutoff = timezone.now() - timedelta(days=options['hot_days'])
+        compacted = compact_messages(cutoff, batch_size=options['batch_size'])
+        self.stdout.write(f"Compacted {compacted} message payload(s) older than {cutoff:%Y-%m-%d}.")
+
+        # Telegram never redelivers updates this old; the de-duplication keys can go
+        pruned = prune_updates(timezone.now() - timedelta(days=settings.TELEGRAM_UPDATE_RETENTION_DAYS))
+        self.stdout.write(f"Pruned {pruned} Telegram update id(s).")
+        pruned = prune_llm_calls(timezone.now() - timedelta(days=settings.LLM_USAGE_RETENTION_DAYS))
+        self.stdout.write(f"Pruned {pruned} LLM usage record(s).")
+
+        if not is_partitioned():
+            self.stdout.write("RawMessage table is not partitioned (not PostgreSQL?); skipping partition maintenance.")
+            return
+
+        # 2. Make sure new rows never land in the DEFAULT partition
+        this_month = date.today().replace(day=1)
+        created = ensure_partitions(this_month, options['months_ahead'])
+        self.stdout.write(f"Created partitions: {', '.join(created) or 'none needed'}.")
+
+        # 3. Retire whole months: a DETACH, not a mass DELETE
+        if options['retention_months']:
+            cutoff_month = add_months(this_month, -options['retention_months'])
+            handled = detach_partitions_before(cutoff_month, drop=options['drop'])
+            action = "Dropped" if options['drop'] else "Detached (kept as *_archive)"
+            self.stdout.write(f"{action}: {', '.join(handled) or 'nothing older than ' + cutoff_month.isoformat()}.")
@@ -0,0 +1,46 @@
+from datetime import timedelta
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from orders.llm_usage import usage_by_provider, usage_summary
+
+
+class Command(BaseCommand):
+    help = (
+        "Summarizes recorded LLM calls: tokens, prefix cache hit rate, latency per provider and "
+        "estimated cost per order (prices from the DEEPSEEK_PRICE_* settings)."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=float, default=1, help="Look back this many days.")
+        parser.add_argument('--minutes', type=float, help="Look back this many minutes instead.")
+
+    def handle(self, *args, **options):
+        if options['minutes'] is not None:
+            since = timezone.now() - timedelta(minutes=options['minutes'])
+        else:
+            since = timezone.now() - timedelta(days=options['days'])
+        usage = usage_summary(since)
+
+        self.stdout.write(f"LLM usage since {timezone.localtime(since):%Y-%m-%d %H:%M}:")
+        self.stdout.write(
+            f"  calls: {usage['calls']} ({usage['errors']} failed), messages parsed: {usage['messages']}"
+        )
+        self.stdout.write(
+            f"  tokens: prompt {usage['prompt']} (cached {usage['cached']}, "
+            f"hit rate {usage['cache_hit_rate']:.0%}), completion {usage['completion']}"
+        )
+        if usage['calls']:
+            self.stdout.write(
+                f"  per call: {usage['prompt'] / usage['calls']:.0f} prompt + "
+                f"{usage['completion'] / usage['calls']:.0f} completion tokens, "
+                f"latency avg {usage['latency_avg']:.0f} ms / max {usage['latency_max']} ms"
+            )
+        for row in usage_by_provider(since):
+            self.stdout.write(
+                f"  provider {row['provider']}: {row['calls']} call(s), {row['errors']} failed, "
+                f"{row['hedges']} hedged, latency avg {row['latency_avg'] or 0:.0f} ms"
+            )
+        cost_per_order = f"${usage['cost_per_order']:.6f}" if usage['cost_per_order'] is not None else "n/a"
+        self.stdout.write(
+            f"  estimated cost: ${usage['cost']:.4f} for {usage['orders']} new order(s), {cost_per_order} per order"
+        )
@@ -0,0 +1,305 @@
+import contextlib
+import io
+import json
+import os
+import subprocess
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from urllib.parse import urlparse
+import httpx
+from django.conf import settings
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.db.models import Max
+from django.test import Client
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from orders.models import CalendarSyncTask, Customer, Order, RawMessage
+from orders.load_testing import DEFAULT_MIX, generate_updates, parse_mix, summarize
+from orders.stub_servers import start_calendar_stub, start_deepseek_stub, start_telegram_stub
+
+CHAT_PREFIX = 'loadtest-'
+STUB_ENV = ('DEEPSEEK_API_BASE', 'TELEGRAM_API_BASE', 'CALENDAR_API_ROOT_URL')
+
+# Metrics shown by --compare (path in the JSON report, label)
+COMPARE_METRICS = [
+    (('webhook', 'throughput_rps'), "webhook throughput (req/s)"),
+    (('webhook', 'latency_ms', 'p50'), "webhook p50 (ms)"),
+    (('webhook', 'latency_ms', 'p95'), "webhook p95 (ms)"),
+    (('webhook', 'latency_ms', 'p99'), "webhook p99 (ms)"),
+    (('webhook', 'queries_per_request', 'mean'), "queries / request"),
+    (('pipeline', 'throughput_mps'), "pipeline throughput (msg/s)"),
+    (('pipeline', 'latency_ms', 'p50'), "end-to-end p50 (ms)"),
+    (('pipeline', 'latency_ms', 'p95'), "end-to-end p95 (ms)"),
+    (('pipeline', 'latency_ms', 'p99'), "end-to-end p99 (ms)"),
+    (('stubs', 'deepseek_calls'), "DeepSeek calls"),
+    (('stubs', 'deepseek_prompt_tokens'), "DeepSeek prompt tokens"),
+    (('stubs', 'deepseek_completion_tokens'), "DeepSeek completion tokens"),
+]
+
+
+class Command(BaseCommand):
+    help = (
+        "Replays generated Telegram updates (mixed NEW_ORDER / CONFIRM / CANCEL / LIST_ORDERS, "
+        "Indonesian) against the webhook at a fixed rate and reports p50/p95/p99 latency, "
+        "throughput and queries per request; --drain also runs the worker for end-to-end numbers. "
+        "Results are saved as JSON (--output) and can be diffed against an earlier run (--compare). "
+        "External APIs must point at the stubs (DEEPSEEK_API_BASE, TELEGRAM_API_BASE, "
+        "CALENDAR_API_ROOT_URL); --start-stubs runs them in this process on those ports."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=500)
+        parser.add_argument('--rate', type=float, default=50.0, help="Requests per second (0 = as fast as possible).")
+        parser.add_argument('--concurrency', type=int, default=16, help="Max requests in flight.")
+        parser.add_argument('--chats', type=int, default=50)
+        parser.add_argument('--mix', type=parse_mix, default=DEFAULT_MIX,
+                            help="Intent weights, e.g. new=50,confirm=20,cancel=10,list=20")
+        parser.add_argument('--seed', type=int, default=None)
+        parser.add_argument('--duplicates', type=float, default=0.0,
+                            help="Share of updates redelivered with the same update_id (e.g. 0.05).")
+        parser.add_argument('--url', help="POST to a running server (e.g. http://127.0.0.1:8000/webhooks/telegram/) "
+                                          "instead of the in-process test client. Queries per request are only "
+                                          "counted in-process.")
+        parser.add_argument('--async-webhook', action='store_true', help="In-process: target the async webhook URL.")
+        parser.add_argument('--drain', action='store_true', help="Run the worker afterwards and report end-to-end latency.")
+        parser.add_argument('--worker-concurrency', type=int, default=settings.ORDER_WORKER_CONCURRENCY)
+        parser.add_argument('--start-stubs', action='store_true')
+        parser.add_argument('--latency', type=float, default=0.05, help="Telegram / Calendar stub latency (s).")
+        parser.add_argument('--llm-latency', type=float, default=0.8, help="DeepSeek stub latency (s).")
+        parser.add_argument('--llm-token-latency', type=float, default=0.0,
+                            help="Extra DeepSeek stub latency per completion token (s), e.g. 0.01.")
+        parser.add_argument('--output', help="JSON report path (default loadtest-results/<timestamp>.json).")
+        parser.add_argument('--compare', help="Earlier JSON report to compare against.")
+        parser.add_argument('--cleanup', action='store_true', help="Delete load-test customers and their data, then exit.")
+
+    def handle(self, *args, **options):
+        if options['cleanup']:
+            order_ids = list(Order.objects.filter(customer__chat_id__startswith=CHAT_PREFIX).values_list('id', flat=True))
+            deleted, _ = Customer.objects.filter(chat_id__startswith=CHAT_PREFIX).delete()
+            # The deletes queued calendar syncs, but those events only ever existed in the stub
+            CalendarSyncTask.objects.filter(order_id__in=order_ids).delete()
+            self.stdout.write(f"Deleted {deleted} load-test rows.")
+            return
+
+        missing = [name for name in STUB_ENV if not os.environ.get(name)]
+        if missing:
+            raise CommandError(f"Point the external APIs at the stubs first; missing: {', '.join(missing)}")
+        os.environ.setdefault('TELEGRAM_BOT_TOKEN', 'loadtest')
+
+        if options['drain']:
+            # The worker takes the oldest messages first, so a real backlog would be timed instead
+            backlog = RawMessage.objects.filter(is_processed=False, is_dead_letter=False).exclude(
+                customer__chat_id__startswith=CHAT_PREFIX
+            ).count()
+            if backlog:
+                raise CommandError(
+                    f"{backlog} queued messages are not from the load test; --drain would process them too. "
+                    "Run process_messages first or use a separate database."
+                )
+
+        stubs = self._start_stubs(options) if options['start_stubs'] else None
+
+        # CONFIRM / CANCEL reference orders left by earlier runs, when there are any
+        order_ids = defaultdict(list)
+        for order_id, chat_id in Order.objects.filter(customer__chat_id__startswith=CHAT_PREFIX).values_list('id', 'customer__chat_id')[:5000]:
+            order_ids[chat_id].append(order_id)
+        updates = list(generate_updates(
+            options['requests'], options['chats'], CHAT_PREFIX,
+            mix=options['mix'], seed=options['seed'], order_ids=order_ids, duplicate_rate=options['duplicates'],
+        ))
+
+        last_message_id = RawMessage.objects.aggregate(last=Max('id'))['last'] or 0
+        report = {
+            'started_at': datetime.now().isoformat(timespec='seconds'),
+            'git_commit': self._git_commit(),
+            'config': {
+                key: options[key] for key in
+                ('requests', 'rate', 'concurrency', 'chats', 'mix', 'seed', 'duplicates', 'url', 'async_webhook',
+                 'drain', 'worker_concurrency', 'latency', 'llm_latency', 'llm_token_latency')
+            },
+            'settings': {'DEBUG': settings.DEBUG, 'DB_ENGINE': settings.DATABASES['default']['ENGINE']},
+        }
+        report['config']['stubs_in_process'] = bool(stubs)
+
+        self.stdout.write(f"Replaying {len(updates)} updates at {options['rate'] or 'max'} req/s...")
+        report['webhook'] = self._replay(updates, options)
+        self._print_webhook(report['webhook'])
+
+        if options['drain']:
+            report['pipeline'] = self._drain(last_message_id, options)
+            self._print_pipeline(report['pipeline'])
+
+        if stubs:
+            report['stubs'] = {
+                'deepseek_calls': stubs['deepseek'].deepseek.calls,
+                'deepseek_prompt_tokens': stubs['deepseek'].deepseek.prompt_tokens,
+                'deepseek_cached_tokens': stubs['deepseek'].deepseek.cached_tokens,
+                'deepseek_completion_tokens': stubs['deepseek'].deepseek.completion_tokens,
+                'telegram_messages': len(stubs['telegram'].telegram.messages),
+                'calendar_events': len(stubs['calendar'].calendar.live_events),
+            }
+
+        path = options['output'] or os.path.join(
+            'loadtest-results', f"{datetime.now():%Y%m%d-%H%M%S}.json"
+        )
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        with open(path, 'w') as f:
+            json.dump(report, f, indent=2)
+        self.stdout.write(f"Saved report to {path}")
+
+        if options['compare']:
+            self._compare(options['compare'], report)
+
+    def _start_stubs(self, options):
+        ports = {name: urlparse(os.environ[name]).port for name in STUB_ENV}
+        return {
+            'deepseek': start_deepseek_stub(port=ports['DEEPSEEK_API_BASE'], latency=options['llm_latency'],
+                                            token_latency=options['llm_token_latency']),
+            'telegram': start_telegram_stub(port=ports['TELEGRAM_API_BASE'], latency=options['latency']),
+            'calendar': start_calendar_stub(port=ports['CALENDAR_API_ROOT_URL'], latency=options['latency']),
+        }
+
+    def _git_commit(self):
+        try:
+            return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True).stdout.strip() or None
+        except OSError:
+            return None
+
+    # --- Webhook replay ---
+
+    def _replay(self, updates, options):
+        url = options['url']
+        path = reverse('telegram_webhook_async' if options['async_webhook'] else 'telegram_webhook')
+        if options['async_webhook'] and not url:
+            # The test Client is WSGI: the async view would only queue. Say so in the report.
+            self.stdout.write("Note: in-process requests are WSGI, so the async webhook only queues here.")
+
+        local = threading.local()
+        http = httpx.Client(limits=httpx.Limits(max_connections=options['concurrency'])) if url else None
+        results = []  # (intent, latency_ms, service_ms, queries, webhook status or None on error)
+        lock = threading.Lock()
+
+        def send(intent, update, scheduled_at):
+            started = time.perf_counter()
+            queries = None
+            try:
+                if http:
+                    response = http.post(url, json=update)
+                else:
+                    if not hasattr(local, 'client'):
+                        local.client = Client()
+                    with CaptureQueriesContext(connection) as captured:
+                        response = local.client.post(path, update, content_type='application/json')
+                    queries = len(captured.captured_queries)
+                status = response.json().get('status') if response.status_code == 200 else None
+            except Exception as e:
+                print(f"Load test request error: {e}")
+                status = None
+            finished = time.perf_counter()
+            # Latency counts from the scheduled send time, so queueing under overload shows up
+            with lock:
+                results.append((intent, (finished - scheduled_at) * 1000, (finished - started) * 1000, queries, status))
+
+        interval = 1.0 / options['rate'] if options['rate'] else 0.0
+        with ThreadPoolExecutor(max_workers=options['concurrency'], thread_name_prefix='loadtest') as pool:
+            start = time.perf_counter()
+            for i, (intent, update) in enumerate(updates):
+                scheduled_at = start + i * interval
+                delay = scheduled_at - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+                pool.submit(send, intent, update, scheduled_at)
+        duration = time.perf_counter() - start
+        if http:
+            http.close()
+
+        by_intent = defaultdict(list)
+        for intent, latency, _, _, _ in results:
+            by_intent[intent].append(latency)
+        queries = [q for _, _, _, q, _ in results if q is not None]
+        return {
+            'requests': len(results),
+            'errors': sum(1 for *_, status in results if status is None),
+            'duplicates_dropped': sum(1 for *_, status in results if status == 'duplicate'),
+            'duration_s': round(duration, 3),
+            'throughput_rps': round(len(results) / duration, 2) if duration else None,
+            'latency_ms': summarize([r[1] for r in results]),
+            'service_time_ms': summarize([r[2] for r in results]),
+            'queries_per_request': summarize(queries) if queries else None,
+            'by_intent': {intent: summarize(values) for intent, values in sorted(by_intent.items())},
+        }
+
+    # --- Worker drain ---
+
+    def _drain(self, last_message_id, options):
+        self.stdout.write(f"Draining the queue with {options['worker_concurrency']} worker threads...")
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            call_command('process_messages', once=True, concurrency=options['worker_concurrency'])
+        duration = time.perf_counter() - start
+
+        messages = RawMessage.objects.filter(id__gt=last_message_id, customer__chat_id__startswith=CHAT_PREFIX)
+        done = [
+            (m.processed_at - m.timestamp).total_seconds() * 1000
+            for m in messages.filter(is_processed=True).only('timestamp', 'processed_at')
+        ]
+        return {
+            'messages': messages.count(),
+            'processed': len(done),
+            'failed': messages.filter(is_processed=False).count(),
+            'duration_s': round(duration, 3),
+            'throughput_mps': round(len(done) / duration, 2) if duration else None,
+            # From webhook receipt to processed, including time spent queued
+            'latency_ms': summarize(done),
+        }
+
+    # --- Output ---
+
+    def _print_webhook(self, webhook):
+        latency = webhook['latency_ms']
+        self.stdout.write(
+            f"Webhook: {webhook['requests']} requests, {webhook['errors']} errors, "
+            f"{webhook.get('duplicates_dropped', 0)} duplicates dropped, "
+            f"{webhook['throughput_rps']} req/s; latency p50 {latency.get('p50')} / p95 {latency.get('p95')} / "
+            f"p99 {latency.get('p99')} ms"
+        )
+        if webhook['queries_per_request']:
+            self.stdout.write(
+                f"Queries per request: mean {webhook['queries_per_request']['mean']}, "
+                f"max {webhook['queries_per_request']['max']}"
+            )
+        for intent, stats in webhook['by_intent'].items():
+            self.stdout.write(f"  {intent:<12} n={stats['count']:<5} p50 {stats['p50']} ms, p95 {stats['p95']} ms")
+
+    def _print_pipeline(self, pipeline):
+        latency = pipeline['latency_ms']
+        self.stdout.write(
+            f"Pipeline: {pipeline['processed']}/{pipeline['messages']} processed in {pipeline['duration_s']}s "
+            f"({pipeline['throughput_mps']} msg/s); end-to-end p50 {latency.get('p50')} / "
+            f"p95 {latency.get('p95')} / p99 {latency.get('p99')} ms"
+        )
+
+    def _compare(self, path, current):
+        with open(path) as f:
+            previous = json.load(f)
+
+        def lookup(report, keys):
+            for key in keys:
+                if not isinstance(report, dict) or report.get(key) is None:
+                    return None
+                report = report[key]
+            return report
+
+        self.stdout.write(f"\nCompared with {path} ({previous.get('started_at')}, commit {previous.get('git_commit')}):")
+        self.stdout.write(f"{'metric':<30} {'before':>10} {'after':>10} {'change':>8}")
+        for keys, label in COMPARE_METRICS:
+            before, after = lookup(previous, keys), lookup(current, keys)
+            if before is None or after is None:
+                continue
+            change = f"{(after - before) / before:+.0%}" if before else "n/a"
+            self.stdout.write(f"{label:<30} {before:>10} {after:>10} {change:>8}")
@@ -0,0 +1,75 @@
+import time
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import close_old_connections
+from orders.ingest import ingest_updates
+from orders.sync_state import get_sync_state, set_sync_state
+from orders.telegram_utils import TelegramAPIError, delete_webhook, get_updates
+
+OFFSET_KEY = 'telegram:getUpdates:offset'
+
+
+class Command(BaseCommand):
+    help = (
+        "Ingests Telegram updates with getUpdates long polling instead of the webhook, so no "
+        "public URL (ngrok) is needed. Each batch (up to 100 updates) is queued for the worker "
+        "with one bulk insert; the offset is stored in the database, so restarts resume."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--timeout', type=int, default=settings.TELEGRAM_POLL_TIMEOUT,
+                            help="Long-poll timeout in seconds.")
+        parser.add_argument('--limit', type=int, default=settings.TELEGRAM_POLL_LIMIT,
+                            help="Updates per getUpdates call (1-100).")
+        parser.add_argument('--once', action='store_true',
+                            help="Stop as soon as there are no pending updates.")
+        parser.add_argument('--delete-webhook', action='store_true',
+                            help="Remove the bot's webhook first (getUpdates is refused while one is set).")
+
+    def handle(self, *args, **options):
+        limit = min(100, max(1, options['limit']))
+        timeout = 0 if options['once'] else options['timeout']
+
+        if options['delete_webhook']:
+            delete_webhook()
+            self.stdout.write("Webhook removed.")
+
+        offset = get_sync_state(OFFSET_KEY)
+        offset = int(offset) if offset else None
+        self.stdout.write(f"Polling Telegram (offset {offset or 'none'}, up to {limit} updates per call)...")
+
+        failures = 0
+        try:
+            while True:
+                try:
+                    updates = get_updates(offset=offset, limit=limit, timeout=timeout)
+                    failures = 0
+                except TelegramAPIError as e:
+                    if e.status_code == 409:
+                        raise CommandError(f"{e}. A webhook is still set; rerun with --delete-webhook.")
+                    if e.status_code in (401, 404):
+                        raise CommandError(f"Telegram rejected the bot token: {e}")
+                    failures += 1
+                    print(f"getUpdates Error: {e}")
+                    time.sleep(min(60, 2 ** failures))
+                    continue
+                except Exception as e:
+                    failures += 1
+                    print(f"getUpdates Connection Error: {e}")
+                    time.sleep(min(60, 2 ** failures))
+                    continue
+
+                if not updates:
+                    if options['once']:
+                        break
+                    continue
+
+                close_old_connections()
+                _, counts = ingest_updates(updates)
+                # Saved first, then the offset: after a crash in between the batch is fetched
+                # again and the update_id de-duplication drops what was already queued.
+                offset = max(update['update_id'] for update in updates) + 1
+                set_sync_state(OFFSET_KEY, offset)
+                print(f"Poller: {len(updates)} update(s) -> {dict(counts)}, next offset {offset}")
+        except KeyboardInterrupt:
+            self.stdout.write("Poller stopped.")
@@ -0,0 +1,184 @@
+import time
+import traceback
+from collections import OrderedDict
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections, connection
+from orders.message_queue import claim_messages, mark_processed, mark_failed, release_messages, renew_leases
+from orders.pipeline import AI_ERROR_REPLY, AIParseError, handle_message
+from orders.intent_rules import get_rule_stats
+from orders.order_grammar import get_grammar_stats
+from orders.ai_service import llm_router, parse_batcher, parse_cache
+from orders.calendar_outbox import drain_calendar_outbox, get_calendar_sync_stats, start_calendar_dispatcher
+from orders.http_clients import get_http_stats
+from orders.metrics import observe_message, stage_totals, start_metrics_server
+from orders.telegram_utils import enqueue_telegram_reply, flush_telegram_replies, telegram_sender
+
+
+# Pool connections beyond one per thread, for the threads that only borrow one briefly
+WORKER_DB_POOL_SPARE = 2
+
+
+class Command(BaseCommand):
+    help = "Worker: claims unprocessed RawMessages and runs the intent pipeline on N threads."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--concurrency', type=int, default=settings.ORDER_WORKER_CONCURRENCY,
+                            help="Number of messages processed in parallel.")
+        parser.add_argument('--poll-interval', type=float, default=settings.ORDER_WORKER_POLL_SECONDS,
+                            help="Seconds to sleep when the queue is empty.")
+        parser.add_argument('--once', action='store_true',
+                            help="Drain the queue once and exit (useful for cron / debugging).")
+        parser.add_argument('--metrics-port', type=int, default=settings.WORKER_METRICS_PORT,
+                            help="Serve this worker's stage metrics at http://<WORKER_METRICS_HOST>:<port>/metrics "
+                                 "(0 = off, the default; not with --once).")
+
+    def handle(self, *args, **options):
+        concurrency = max(1, options['concurrency'])
+        poll_interval = options['poll_interval']
+        self.stdout.write(f"Worker started with {concurrency} threads.")
+        # A --once run (cron, load tests) exits before anyone scrapes it
+        if options['metrics_port'] and not options['once'] and start_metrics_server(options['metrics_port']):
+            self.stdout.write(f"Metrics on {settings.WORKER_METRICS_HOST}:{options['metrics_port']}/metrics")
+        calendar_sync = settings.CALENDAR_SYNC_IN_WORKER
+        stop_calendar = start_calendar_dispatcher() if calendar_sync and not options['once'] else None
+        # Worker threads + this thread + the dispatcher each hold a connection; the
+        # llm-hedge / llm-batch threads only borrow one to log usage (release_db_after)
+        self._size_db_pool(concurrency + 1 + bool(stop_calendar) + WORKER_DB_POOL_SPARE)
+
+        with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='order-worker') as pool:
+            try:
+                self._run(pool, concurrency, poll_interval, options['once'])
+            except KeyboardInterrupt:
+                self.stdout.write("Worker stopped.")
+
+        if stop_calendar:
+            stop_calendar.set()
+        elif calendar_sync:
+            # --once: sync what this run queued instead of leaving it to the next one
+            drain_calendar_outbox()
+
+        # Replies are sent in the background; don't exit with some still queued
+        if not flush_telegram_replies(timeout=30):
+            self.stdout.write("Warning: some Telegram replies were still queued at exit.")
+        self._report_stats()
+
+    def _size_db_pool(self, size):
+        """Grows the psycopg pool (DB_POOL_MAX_SIZE is sized for a web process) to `size`."""
+        pool = getattr(connection, 'pool', None)  # None without DB_POOL_MAX_SIZE / on SQLite
+        if pool is not None and pool.max_size < size:
+            pool.resize(min_size=pool.min_size, max_size=size)
+            self.stdout.write(f"DB pool: {size} connections for {size - WORKER_DB_POOL_SPARE} threads.")
+
+    def _report_stats(self):
+        stats = get_rule_stats()
+        self.stdout.write(
+            f"LLM skipped: {stats['total'] - stats['fallthrough']}/{stats['total']} messages answered by "
+            f"the rules, grammar or cache ({stats['hit_rate']:.0%}); rule hits per intent: {stats['hits']}"
+        )
+        self.stdout.write(f"Order grammar: {get_grammar_stats()}")
+        self.stdout.write(f"LLM parse cache: {parse_cache.stats()}")
+        if settings.LLM_BATCH_SIZE > 1:
+            self.stdout.write(f"LLM batching: {parse_batcher.stats}")
+        self.stdout.write(f"LLM providers: {llm_router.snapshot()}")
+        self.stdout.write(f"HTTP connection reuse: {get_http_stats()}")
+        self.stdout.write(f"Telegram sender: {telegram_sender.stats}")
+        if settings.CALENDAR_SYNC_IN_WORKER:
+            self.stdout.write(f"Calendar sync: {get_calendar_sync_stats()}")
+
+        # Mean time per stage, slowest first: which dependency eats the latency budget
+        totals = stage_totals()
+        if totals:
+            self.stdout.write("Stage timings: " + ", ".join(
+                f"{stage} {total / calls * 1000:.1f}ms x{calls:.0f}"
+                for stage, (calls, total) in sorted(totals.items(), key=lambda item: -item[1][1])
+            ))
+
+    def _run(self, pool, concurrency, poll_interval, once):
+        """
+        Keeps the threads busy: claims messages while fewer than 2x concurrency are held,
+        hands a chat to a thread as soon as that chat is idle and claims again as soon as
+        any thread is done, so a slow chat only holds up its own messages. The leases of
+        held messages are renewed while they wait.
+        """
+        running = {}  # future -> (customer_id, messages)
+        waiting = OrderedDict()  # customer_id -> messages claimed while that chat was busy
+        leases = {}  # message id -> locked_until, for every message held
+        renewed_at = time.monotonic()
+        while True:
+            close_old_connections()
+            held = len(leases)
+            messages = claim_messages(limit=concurrency * 2 - held) if held < concurrency * 2 else []
+
+            # Messages from the same chat must run in order ("Pesan ..." then "Ok 15"),
+            # so a chat is on one thread at a time and its messages run sequentially
+            # (claim_messages never hands out a message ahead of its chat's earlier ones).
+            for msg in messages:
+                waiting.setdefault(msg.customer_id, []).append(msg)
+                leases[msg.id] = msg.locked_until
+            busy = {customer_id for customer_id, _ in running.values()}
+            for customer_id in [customer_id for customer_id in waiting if customer_id not in busy]:
+                if len(running) >= concurrency:
+                    break
+                chat_messages = waiting.pop(customer_id)
+                running[pool.submit(self._process_chat, chat_messages)] = (customer_id, chat_messages)
+
+            if time.monotonic() - renewed_at >= settings.ORDER_WORKER_LEASE_SECONDS / 3:
+                leases.update(renew_leases(leases))
+                renewed_at = time.monotonic()
+
+            if not running:
+                if once:
+                    return
+                time.sleep(poll_interval)
+                continue
+            done, _ = wait(running, timeout=poll_interval, return_when=FIRST_COMPLETED)
+            for future in done:
+                customer_id, chat_messages = running.pop(future)
+                halted = future.result()
+                if halted and customer_id in waiting:
+                    # Claimed after the message that failed: they wait for its retry too
+                    parked = waiting.pop(customer_id)
+                    release_messages(parked)
+                    chat_messages = chat_messages + parked
+                for msg in chat_messages:
+                    leases.pop(msg.id, None)
+
+    def _process_chat(self, messages):
+        """
+        Runs one chat's messages in order. If one fails and will be retried, the rest are
+        released unhandled (they must not overtake it); returns True in that case.
+        """
+        try:
+            for i, msg in enumerate(messages):
+                if not self._process_one(msg):
+                    release_messages(messages[i + 1:])
+                    return True
+            return False
+        finally:
+            close_old_connections()
+
+    def _process_one(self, msg):
+        """Handles one message. Returns False if it failed and is waiting for a retry."""
+        started = time.perf_counter()
+        try:
+            status = handle_message(msg)
+            if not msg.is_processed:  # order changes mark it in their own transaction
+                mark_processed(msg)
+            observe_message('worker', status, time.perf_counter() - started)
+            print(f"Worker: message #{msg.id} -> {status}")
+            return True
+        except Exception as e:
+            status = 'ai_error' if isinstance(e, AIParseError) else 'error'
+            if status == 'error':
+                traceback.print_exc()
+            observe_message('worker', status, time.perf_counter() - started)
+            if mark_failed(msg, e):
+                print(f"Worker: message #{msg.id} moved to dead letter after {msg.attempts} attempts.")
+                if status == 'ai_error':
+                    # The user hears about it once, when retrying stops
+                    enqueue_telegram_reply(msg.customer.chat_id, AI_ERROR_REPLY)
+                return True  # given up on: the chat's next messages go ahead
+            print(f"Worker: message #{msg.id} failed (attempt {msg.attempts}): {e}; will retry.")
+            return False
@@ -0,0 +1,32 @@
+from django.core.management.base import BaseCommand, CommandError
+from orders.calendar_reconcile import reconcile_calendar
+from orders.calendar_service import get_calendar_service
+
+
+class Command(BaseCommand):
+    help = (
+        "Finds and repairs drift between orders and Google Calendar (events deleted or edited "
+        "by hand, lost inserts). Lists only the events changed since the last run (syncToken); "
+        "repairs go through the calendar outbox. Run it from cron, e.g. every 15 minutes."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--full', action='store_true',
+                            help="Ignore the stored sync token and list the whole calendar.")
+        parser.add_argument('--dry-run', action='store_true',
+                            help="Report the drift without repairing it (the token is not stored).")
+        parser.add_argument('--delete-orphans', action='store_true',
+                            help="Also delete order events whose order no longer exists. Only safe if "
+                                 "no other database syncs to this calendar with the same "
+                                 "CALENDAR_EVENT_ID_PREFIX.")
+
+    def handle(self, *args, **options):
+        if get_calendar_service() is None:
+            raise CommandError("Calendar not configured (no service_account.json).")
+        counts = reconcile_calendar(
+            full=options['full'], dry_run=options['dry_run'], delete_orphans=options['delete_orphans'],
+        )
+        mode = "full listing" if counts.pop('full_listing') else "incremental"
+        found = ', '.join(f"{key}: {value}" for key, value in sorted(counts.items()) if key != 'events') or "none"
+        prefix = "[dry run] " if options['dry_run'] else ""
+        self.stdout.write(f"{prefix}Calendar reconcile ({mode}): {counts['events']} changed event(s). Drift: {found}")
@@ -0,0 +1,34 @@
+import time
+from django.core.management.base import BaseCommand
+from orders.stub_servers import start_calendar_stub, start_deepseek_stub, start_telegram_stub
+
+
+class Command(BaseCommand):
+    help = "Runs local stand-ins for the external APIs (for load tests / offline testing)."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--calendar-port', type=int, default=8099)
+        parser.add_argument('--telegram-port', type=int, default=8098)
+        parser.add_argument('--deepseek-port', type=int, default=8097)
+        parser.add_argument('--latency', type=float, default=0.0,
+                            help="Seconds of latency injected into every stub response.")
+        parser.add_argument('--llm-latency', type=float, default=None,
+                            help="Latency of the DeepSeek stub only (defaults to --latency).")
+        parser.add_argument('--llm-token-latency', type=float, default=0.0,
+                            help="Extra DeepSeek stub latency per completion token (s).")
+
+    def handle(self, *args, **options):
+        calendar = start_calendar_stub(port=options['calendar_port'], latency=options['latency'])
+        self.stdout.write(f"Calendar stub: CALENDAR_API_ROOT_URL=http://127.0.0.1:{calendar.server_port}/")
+        telegram = start_telegram_stub(port=options['telegram_port'], latency=options['latency'])
+        self.stdout.write(f"Telegram stub: TELEGRAM_API_BASE=http://127.0.0.1:{telegram.server_port}")
+        llm_latency = options['latency'] if options['llm_latency'] is None else options['llm_latency']
+        deepseek = start_deepseek_stub(port=options['deepseek_port'], latency=llm_latency,
+                                       token_latency=options['llm_token_latency'])
+        self.stdout.write(f"DeepSeek stub: DEEPSEEK_API_BASE=http://127.0.0.1:{deepseek.server_port}")
+
+        try:
+            while True:
+                time.sleep(3600)
+        except KeyboardInterrupt:
+            self.stdout.write("Stub servers stopped.")
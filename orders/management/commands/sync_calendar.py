@@ -0,0 +1,27 @@
+import threading
+from django.core.management.base import BaseCommand
+from orders.calendar_outbox import drain_calendar_outbox, get_calendar_sync_stats, run_calendar_dispatcher
+
+
+class Command(BaseCommand):
+    help = (
+        "Calendar outbox dispatcher: turns queued CalendarSyncTasks into Google Calendar "
+        "inserts / updates / deletes, one per order, in batch requests. The worker runs one "
+        "in a thread already (CALENDAR_SYNC_IN_WORKER); use this to run it on its own."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true',
+                            help="Sync everything queued now (without the coalescing delay) and exit.")
+
+    def handle(self, *args, **options):
+        if options['once']:
+            handled = drain_calendar_outbox()
+            self.stdout.write(f"Calendar sync: {handled} task(s) handled. {get_calendar_sync_stats()}")
+            return
+
+        self.stdout.write("Calendar dispatcher started.")
+        try:
+            run_calendar_dispatcher(threading.Event())
+        except KeyboardInterrupt:
+            self.stdout.write(f"Calendar dispatcher stopped. {get_calendar_sync_stats()}")
@@ -0,0 +1,149 @@
+from collections import defaultdict
+from datetime import timedelta
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F, Q
+from django.utils import timezone
+from .models import RawMessage
+
+
+def claim_messages(limit):
+    """
+    Claims up to `limit` unprocessed RawMessages for this worker.
+
+    Uses SELECT ... FOR UPDATE SKIP LOCKED so several worker processes can poll
+    the same table without handing out the same row twice. Claimed rows get a
+    lease (locked_until); if the worker dies, the row becomes claimable again
+    once the lease runs out. A message is only claimed together with every earlier
+    unprocessed message of its chat (see _next_in_chat).
+    """
+    now = timezone.now()
+    lease = timedelta(seconds=settings.ORDER_WORKER_LEASE_SECONDS)
+
+    with transaction.atomic():
+        messages = _next_in_chat(list(
+            RawMessage.objects
+            .select_for_update(skip_locked=True, of=('self',))
+            .select_related('customer')
+            .filter(is_processed=False, is_dead_letter=False)
+            .filter(Q(locked_until__isnull=True) | Q(locked_until__lte=now))
+            .order_by('id')[:limit]
+        ))
+        if not messages:
+            return []
+
+        RawMessage.objects.filter(id__in=[m.id for m in messages]).update(
+            locked_until=now + lease,
+            attempts=F('attempts') + 1,
+        )
+
+    for msg in messages:
+        msg.attempts += 1
+        msg.locked_until = now + lease
+    return messages
+
+
+def _next_in_chat(candidates):
+    """
+    The candidates that are next in line in their chat. A message whose chat has an
+    earlier unprocessed message outside `candidates` (leased by another worker, waiting
+    for its retry, or just not picked) is left alone, so "Ok 15" never runs before the
+    "Pesan ..." it confirms. Dead letters don't hold their chat up.
+    """
+    if not candidates:
+        return []
+    candidate_ids = {msg.id for msg in candidates}
+    pending = (
+        RawMessage.objects
+        .filter(customer_id__in={msg.customer_id for msg in candidates}, id__lte=max(candidate_ids),
+                is_processed=False, is_dead_letter=False)
+        .order_by('id')
+        .values_list('customer_id', 'id')
+    )
+    blocked, allowed = set(), set()
+    for customer_id, msg_id in pending:
+        if customer_id in blocked:
+            continue
+        if msg_id in candidate_ids:
+            allowed.add(msg_id)
+        else:
+            blocked.add(customer_id)
+    return [msg for msg in candidates if msg.id in allowed]
+
+
+def renew_leases(leases):
+    """
+    Extends the leases of claimed messages that haven't been handled yet (queued behind
+    their chat's earlier messages), so nobody claims them again meanwhile. `leases` maps
+    message id -> the locked_until this worker set; rows changed since (processed, failed,
+    released) keep theirs. Returns the new {id: locked_until} of the renewed rows.
+    """
+    new_lease = timezone.now() + timedelta(seconds=settings.ORDER_WORKER_LEASE_SECONDS)
+    by_lease = defaultdict(list)
+    for msg_id, locked_until in leases.items():
+        by_lease[locked_until].append(msg_id)
+    renewed = {}
+    with transaction.atomic():
+        for locked_until, ids in by_lease.items():
+            # Row locks so a concurrent mark_failed()/mark_processed() isn't overwritten
+            held_ids = list(
+                RawMessage.objects.select_for_update()
+                .filter(id__in=ids, locked_until=locked_until, is_processed=False)
+                .values_list('id', flat=True)
+            )
+            RawMessage.objects.filter(id__in=held_ids).update(locked_until=new_lease)
+            renewed.update(dict.fromkeys(held_ids, new_lease))
+    return renewed
+
+
+def release_messages(messages):
+    """Gives claimed messages back unhandled (their chat's earlier message failed): no attempt is used up."""
+    RawMessage.objects.filter(id__in=[msg.id for msg in messages], is_processed=False).update(
+        locked_until=None,
+        attempts=F('attempts') - 1,
+    )
+
+
+def mark_processed(raw_msg):
+    """Marks a message as done and releases its lease."""
+    raw_msg.is_processed = True
+    raw_msg.processed_at = timezone.now()
+    raw_msg.locked_until = None
+    raw_msg.last_error = None
+    RawMessage.objects.filter(id=raw_msg.id).update(
+        is_processed=True,
+        processed_at=raw_msg.processed_at,
+        locked_until=None,
+        last_error=None,
+    )
+
+
+def mark_failed(raw_msg, error):
+    """
+    Records a failed attempt. The message is retried with exponential backoff
+    until ORDER_WORKER_MAX_ATTEMPTS is reached, then parked as a dead letter.
+    """
+    raw_msg.last_error = str(error)[:2000]
+
+    if raw_msg.attempts >= settings.ORDER_WORKER_MAX_ATTEMPTS:
+        raw_msg.is_dead_letter = True
+        raw_msg.locked_until = None
+    else:
+        delay = min(settings.ORDER_WORKER_RETRY_BASE_SECONDS * (2 ** (raw_msg.attempts - 1)), 300)
+        raw_msg.locked_until = timezone.now() + timedelta(seconds=delay)
+
+    RawMessage.objects.filter(id=raw_msg.id).update(
+        last_error=raw_msg.last_error,
+        is_dead_letter=raw_msg.is_dead_letter,
+        locked_until=raw_msg.locked_until,
+    )
+    return raw_msg.is_dead_letter
+
+
+def requeue_messages(queryset):
+    """Puts dead-lettered (or stuck) messages back on the queue with a fresh retry budget."""
+    return queryset.filter(is_processed=False).update(
+        is_dead_letter=False,
+        attempts=0,
+        locked_until=None,
+    )
@@ -0,0 +1,159 @@
+import contextvars
+import os
+import time
+from contextlib import contextmanager, nullcontext
+from django.conf import settings
+from prometheus_client import REGISTRY, CollectorRegistry, Counter, Histogram, generate_latest, start_http_server
+from prometheus_client import multiprocess
+
+# Per-stage latency of the message pipeline, as prometheus_client metrics served at
+# GET /metrics/ (or `process_messages --metrics-port` for the worker). Under gunicorn,
+# PROMETHEUS_MULTIPROC_DIR (set by config/gunicorn.conf.py) makes every worker keep its
+# values in that directory and a scrape of any worker serves the sum. Every stage is also
+# an OpenTelemetry span when opentelemetry-api is installed; spans are exported once an
+# SDK is configured (see configure_tracing()).
+#
+#   with stage('calendar_sync') as span:
+#       ...
+#       span.outcome = 'error'   # default: 'ok', or 'error' if the block raised
+
+try:
+    from opentelemetry import trace as otel_trace
+except ImportError:  # optional
+    otel_trace = None
+
+# Seconds; covers a ~1ms DB write up to a slow LLM call
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# Intent of the message being handled, for stages that don't know it themselves.
+# Set by the pipelines once the message is parsed; 'none' before that (webhook).
+_intent = contextvars.ContextVar('metrics_intent', default='none')
+
+stage_duration = Histogram(
+    'orders_stage_duration_seconds',
+    "Time spent in one pipeline stage (customer lookup, DB writes, LLM, Calendar, Telegram).",
+    ['stage', 'intent', 'outcome'],
+    buckets=DEFAULT_BUCKETS,
+)
+message_duration = Histogram(
+    'orders_message_duration_seconds',
+    "Time to handle one message in the worker or the async pipeline.",
+    ['pipeline', 'intent', 'outcome'],
+    buckets=DEFAULT_BUCKETS,
+)
+
+
+def set_intent(intent):
+    """Labels the following stages of this message (thread / task) with `intent`."""
+    _intent.set(intent or 'UNKNOWN')
+
+
+def current_intent():
+    """The intent set for this thread / task, for work handed to another thread."""
+    return _intent.get()
+
+
+class _Span:
+    __slots__ = ('intent', 'outcome')
+
+    def __init__(self, intent, outcome):
+        self.intent = intent
+        self.outcome = outcome
+
+
+@contextmanager
+def stage(name, intent=None):
+    """
+    Times the block as pipeline stage `name`. The block may set `span.outcome`
+    (and `span.intent` when it only learns it inside, like the LLM parse).
+    """
+    span = _Span(intent, 'ok')
+    with _otel_span(name) as otel_span:
+        start = time.perf_counter()
+        try:
+            yield span
+        except BaseException:
+            span.outcome = 'error'
+            raise
+        finally:
+            elapsed = time.perf_counter() - start
+            intent = span.intent or _intent.get()
+            stage_duration.labels(stage=name, intent=intent, outcome=span.outcome).observe(elapsed)
+            if otel_span is not None:
+                otel_span.set_attribute('orders.intent', intent)
+                otel_span.set_attribute('orders.outcome', span.outcome)
+
+
+def observe_message(pipeline, outcome, seconds):
+    message_duration.labels(pipeline=pipeline, intent=_intent.get(), outcome=outcome).observe(seconds)
+
+
+def stage_totals():
+    """{stage: (count, seconds)} observed by this process, for the worker's report."""
+    totals = {}
+    for metric in stage_duration.collect():
+        for sample in metric.samples:
+            field = sample.name[len(metric.name):]
+            if field not in ('_count', '_sum'):
+                continue
+            count, seconds = totals.get(sample.labels['stage'], (0, 0.0))
+            if field == '_count':
+                count += sample.value
+            else:
+                seconds += sample.value
+            totals[sample.labels['stage']] = (count, seconds)
+    return totals
+
+
+def render_metrics():
+    """The metrics in the Prometheus text format: all gunicorn workers summed, if multiprocess."""
+    if not os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        return generate_latest(REGISTRY)
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    return generate_latest(registry)
+
+
+def start_metrics_server(port, host=None):
+    """
+    Serves /metrics from a background thread, for processes without Django's web
+    server (the worker). Returns the server, or None if the port is taken.
+    """
+    host = host or settings.WORKER_METRICS_HOST
+    try:
+        server, _ = start_http_server(port, addr=host)
+    except OSError as e:
+        print(f"Metrics: cannot serve on {host}:{port}: {e}")
+        return None
+    return server
+
+
+# --- OpenTelemetry (optional) ---
+
+def _otel_span(name):
+    if otel_trace is None or not settings.METRICS_OTEL_ENABLED:
+        return nullcontext()
+    return otel_trace.get_tracer('orders').start_as_current_span(f'orders.{name}')
+
+
+def configure_tracing():
+    """
+    Exports the stage spans over OTLP when OTEL_EXPORTER_OTLP_ENDPOINT is set and
+    opentelemetry-sdk + opentelemetry-exporter-otlp are installed. Without them the
+    spans are no-ops (or go to whatever SDK `opentelemetry-instrument` configured).
+    """
+    if otel_trace is None or not settings.METRICS_OTEL_ENABLED or not settings.OTEL_EXPORTER_OTLP_ENDPOINT:
+        return False
+    try:
+        from opentelemetry.sdk.resources import Resource
+        from opentelemetry.sdk.trace import TracerProvider
+        from opentelemetry.sdk.trace.export import BatchSpanProcessor
+        from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
+    except ImportError:
+        print("Metrics: OTEL_EXPORTER_OTLP_ENDPOINT is set but opentelemetry-sdk / the OTLP exporter is not installed.")
+        return False
+
+    provider = TracerProvider(resource=Resource.create({'service.name': settings.OTEL_SERVICE_NAME}))
+    provider.add_span_processor(BatchSpanProcessor(OTLPSpanExporter()))
+    otel_trace.set_tracer_provider(provider)
+    return True
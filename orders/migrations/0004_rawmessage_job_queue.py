@@ -0,0 +1,37 @@
+# Generated by Django 5.2.18 on 2026-10-18 10:53
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('orders', '0003_order_calendar_event_id'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='rawmessage',
+            name='attempts',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='rawmessage',
+            name='is_dead_letter',
+            field=models.BooleanField(default=False, help_text='Gave up after too many failed attempts'),
+        ),
+        migrations.AddField(
+            model_name='rawmessage',
+            name='last_error',
+            field=models.TextField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='rawmessage',
+            name='locked_until',
+            field=models.DateTimeField(blank=True, help_text='Worker lease / retry backoff', null=True),
+        ),
+        migrations.AddIndex(
+            model_name='rawmessage',
+            index=models.Index(condition=models.Q(('is_dead_letter', False), ('is_processed', False)), fields=['id'], name='rawmsg_pending_queue_idx'),
+        ),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 5.2.18 on 2026-10-18 10:59
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('orders', '0005_create_cache_table'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(fields=['customer', 'status', '-created_at'], name='order_cust_status_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(condition=models.Q(('status', 'PENDING')), fields=['customer', '-created_at'], name='order_pending_by_cust_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(condition=models.Q(('status', 'CANCELLED'), _negated=True), fields=['customer', 'due_date'], name='order_active_due_idx'),
+        ),
+    ]
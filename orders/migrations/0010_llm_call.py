@@ -0,0 +1,29 @@
+# Generated by Django 5.2.18 on 2026-10-18 11:58
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('orders', '0009_sync_state'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LLMCall',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created_at', models.DateTimeField(db_index=True, default=django.utils.timezone.now)),
+                ('kind', models.CharField(default='parse', help_text="'parse' or 'batch'", max_length=20)),
+                ('model', models.CharField(blank=True, default='', max_length=50)),
+                ('messages', models.PositiveIntegerField(default=1, help_text='Chat messages parsed by this call')),
+                ('prompt_tokens', models.PositiveIntegerField(default=0)),
+                ('cached_tokens', models.PositiveIntegerField(default=0, help_text='Prompt tokens served from the prefix cache')),
+                ('completion_tokens', models.PositiveIntegerField(default=0)),
+                ('latency_ms', models.PositiveIntegerField(default=0)),
+                ('ok', models.BooleanField(default=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 5.2.18 on 2026-10-18 12:07
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('orders', '0010_llm_call'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='llmcall',
+            name='hedge',
+            field=models.BooleanField(default=False, help_text='A hedged second request (the first one was slow)'),
+        ),
+        migrations.AddField(
+            model_name='llmcall',
+            name='provider',
+            field=models.CharField(default='deepseek', max_length=20),
+        ),
+        migrations.AlterField(
+            model_name='llmcall',
+            name='kind',
+            field=models.CharField(default='parse', help_text="'parse', 'batch' or 'stream'", max_length=20),
+        ),
+    ]
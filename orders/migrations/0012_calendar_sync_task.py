@@ -0,0 +1,32 @@
+# Generated by Django 5.2.18 on 2026-10-18 12:20
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('orders', '0011_llm_call_provider'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CalendarSyncTask',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('order_id', models.BigIntegerField(db_index=True)),
+                ('action', models.CharField(choices=[('create', 'Create event'), ('update', 'Update event'), ('delete', 'Delete event')], help_text='What the change called for when queued', max_length=10)),
+                ('event_id', models.CharField(blank=True, help_text='The event to delete if the order is gone', max_length=255, null=True)),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('available_at', models.DateTimeField(default=django.utils.timezone.now, help_text='Coalescing delay / retry backoff')),
+                ('claimed_until', models.DateTimeField(blank=True, help_text='Dispatcher lease', null=True)),
+                ('attempts', models.PositiveIntegerField(default=0)),
+                ('last_error', models.TextField(blank=True, null=True)),
+                ('is_dead_letter', models.BooleanField(default=False, help_text='Gave up after too many failed attempts')),
+            ],
+            options={
+                'indexes': [models.Index(condition=models.Q(('is_dead_letter', False)), fields=['available_at'], name='calsync_pending_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 5.2.18 on 2026-10-18 12:24
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('orders', '0012_calendar_sync_task'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(condition=models.Q(('calendar_event_id__isnull', False)), fields=['calendar_event_id'], name='order_calendar_event_idx'),
+        ),
+    ]
@@ -1,4 +1,4 @@
-from django.db import models
+from django.db import models, transaction
 from django.utils import timezone
 
 class Customer(models.Model):
@@ -26,8 +26,12 @@ class RawMessage(models.Model):
     # The actual text content
     text = models.TextField()
     
-    # Store the full webhook payload (useful for debugging)
+    # Store the full webhook payload (useful for debugging).
+    # Old rows are compacted (manage.py compact_raw_messages): the full payload is
+    # compressed into meta_data_archive and meta_data keeps only the pipeline's fields.
     meta_data = models.JSONField(default=dict, blank=True)
+    meta_data_archive = models.BinaryField(null=True, blank=True)
+    is_compacted = models.BooleanField(default=False)
     
     timestamp = models.DateTimeField(default=timezone.now)
     
@@ -35,10 +39,115 @@ class RawMessage(models.Model):
     is_processed = models.BooleanField(default=False)
     processed_at = models.DateTimeField(null=True, blank=True)
 
+    # Job queue bookkeeping (see orders/message_queue.py)
+    attempts = models.PositiveIntegerField(default=0)
+    last_error = models.TextField(blank=True, null=True)
+    is_dead_letter = models.BooleanField(default=False, help_text="Gave up after too many failed attempts")
+    locked_until = models.DateTimeField(null=True, blank=True, help_text="Worker lease / retry backoff")
+
+    class Meta:
+        indexes = [
+            # Only the unprocessed backlog is ever scanned by the workers
+            models.Index(
+                fields=['id'],
+                name='rawmsg_pending_queue_idx',
+                condition=models.Q(is_processed=False, is_dead_letter=False),
+            ),
+        ]
+
     def __str__(self):
         return f"Msg from {self.customer} @ {self.timestamp:%H:%M}"
 
 
+class TelegramUpdate(models.Model):
+    """
+    Telegram update_ids already accepted by the webhook. Telegram redelivers an update
+    when we answer too slowly; the primary key turns the redelivery into a no-op.
+    Separate from RawMessage because a unique key on the partitioned table would have
+    to include the timestamp. Pruned by `manage.py compact_raw_messages`.
+    """
+    update_id = models.BigIntegerField(primary_key=True)
+    received_at = models.DateTimeField(default=timezone.now, db_index=True)
+
+    def __str__(self):
+        return f"Update {self.update_id} @ {self.received_at:%Y-%m-%d %H:%M}"
+
+
+class SyncState(models.Model):
+    """
+    Durable cursors of the sync jobs, one row per key (e.g. the Telegram getUpdates
+    offset), so a restart resumes where the last run stopped.
+    """
+    key = models.CharField(max_length=100, primary_key=True)
+    value = models.TextField(blank=True, default='')
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.key} = {self.value}"
+
+
+class LLMCall(models.Model):
+    """
+    One DeepSeek chat completion: token usage and latency, for tracking the prefix
+    cache hit rate and the cost per order (`manage.py llm_usage`).
+    Pruned by `manage.py compact_raw_messages`.
+    """
+    created_at = models.DateTimeField(default=timezone.now, db_index=True)
+    kind = models.CharField(max_length=20, default='parse', help_text="'parse', 'batch' or 'stream'")
+    provider = models.CharField(max_length=20, default='deepseek')
+    hedge = models.BooleanField(default=False, help_text="A hedged second request (the first one was slow)")
+    model = models.CharField(max_length=50, blank=True, default='')
+    messages = models.PositiveIntegerField(default=1, help_text="Chat messages parsed by this call")
+    prompt_tokens = models.PositiveIntegerField(default=0)
+    cached_tokens = models.PositiveIntegerField(default=0, help_text="Prompt tokens served from the prefix cache")
+    completion_tokens = models.PositiveIntegerField(default=0)
+    latency_ms = models.PositiveIntegerField(default=0)
+    ok = models.BooleanField(default=True)
+
+    def __str__(self):
+        return f"{self.kind} @ {self.created_at:%Y-%m-%d %H:%M} ({self.prompt_tokens}+{self.completion_tokens} tokens)"
+
+
+class CalendarSyncTask(models.Model):
+    """
+    Outbox row: "this order changed, bring its calendar event up to date". Queued in the
+    same transaction as the order change (orders/calendar_outbox.py) and drained by the
+    calendar dispatcher, which turns all pending rows of an order into one API call.
+    Deleted once the calendar matches the order.
+    """
+    ACTION_CHOICES = [
+        ('create', 'Create event'),
+        ('update', 'Update event'),
+        ('delete', 'Delete event'),
+    ]
+
+    # No foreign key: a delete task outlives its order
+    order_id = models.BigIntegerField(db_index=True)
+    action = models.CharField(max_length=10, choices=ACTION_CHOICES, help_text="What the change called for when queued")
+    event_id = models.CharField(max_length=255, blank=True, null=True, help_text="The event to delete if the order is gone")
+    created_at = models.DateTimeField(default=timezone.now)
+
+    # Dispatcher bookkeeping
+    available_at = models.DateTimeField(default=timezone.now, help_text="Coalescing delay / retry backoff")
+    claimed_until = models.DateTimeField(null=True, blank=True, help_text="Dispatcher lease")
+    attempts = models.PositiveIntegerField(default=0)
+    last_error = models.TextField(blank=True, null=True)
+    is_dead_letter = models.BooleanField(default=False, help_text="Gave up after too many failed attempts")
+
+    class Meta:
+        indexes = [
+            # The dispatcher only scans live tasks, oldest first
+            models.Index(
+                fields=['available_at'],
+                name='calsync_pending_idx',
+                condition=models.Q(is_dead_letter=False),
+            ),
+        ]
+
+    def __str__(self):
+        return f"{self.action} order #{self.order_id} (attempt {self.attempts})"
+
+
 class Order(models.Model):
     STATUS_CHOICES = [
         ('PENDING', 'Pending Confirmation'),
@@ -48,7 +157,11 @@ class Order(models.Model):
     ]
 
     customer = models.ForeignKey(Customer, on_delete=models.CASCADE, related_name='orders')
-    source_message = models.ForeignKey(RawMessage, on_delete=models.SET_NULL, null=True, blank=True)
+    # No DB-level constraint: RawMessage is partitioned on PostgreSQL, and a foreign key
+    # would need the partition key too. Django still applies SET_NULL on delete.
+    source_message = models.ForeignKey(
+        RawMessage, on_delete=models.SET_NULL, null=True, blank=True, db_constraint=False
+    )
     
     client_name = models.CharField(max_length=100, blank=True, null=True, help_text="The actual person buying the food")
     
@@ -77,6 +190,37 @@ class Order(models.Model):
     status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='PENDING')
     created_at = models.DateTimeField(auto_now_add=True)
 
+    class Meta:
+        # Matched to the bot's hot queries (see `manage.py benchmark_order_queries`).
+        # CANCEL filters by (id, customer): the primary key already pins the row.
+        indexes = [
+            # CONFIRM with ids: customer + status
+            models.Index(fields=['customer', 'status', '-created_at'], name='order_cust_status_created_idx'),
+            # CONFIRM fallback: latest PENDING order of a customer
+            models.Index(
+                fields=['customer', '-created_at'],
+                name='order_pending_by_cust_idx',
+                condition=models.Q(status='PENDING'),
+            ),
+            # LIST_ORDERS: a customer's non-cancelled orders in a due_date range
+            models.Index(
+                fields=['customer', 'due_date'],
+                name='order_active_due_idx',
+                condition=~models.Q(status='CANCELLED'),
+            ),
+            # reconcile_calendar: changed calendar events back to their orders
+            models.Index(
+                fields=['calendar_event_id'],
+                name='order_calendar_event_idx',
+                condition=models.Q(calendar_event_id__isnull=False),
+            ),
+        ]
+
+    def save(self, *args, **kwargs):
+        # post_save queues the calendar sync (orders/signals.py): in the same transaction
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+
     def __str__(self):
         # I updated this to show price in the string representation too
         price_display = f"Rp {self.price:,}" if self.price else "Rp ?"
@@ -0,0 +1,418 @@
+import re
+import threading
+from collections import Counter
+from datetime import datetime, timedelta
+from django.conf import settings
+from django.utils import timezone
+
+# Local parser for the common NEW_ORDER shapes, so they don't need DeepSeek:
+#   "Bella pesan 2 brownies 150rb besok jam 5"
+#   "Pesan 1 kue buat Budi 100k lusa"
+#   "Order 2 nastar dan 3 risoles buat Ani, ambil sabtu sore"
+# It applies the prompt's rules itself (name before "pesan" or after "buat"/"untuk"/
+# "atas nama", else "Owner"; "100k" = 100000; besok/lusa/weekdays/"3 hari lagi" resolved
+# against the local time) and returns the same dict as the LLM plus a `confidence` in
+# [0, 1]. A number before a measure ("kue 2 tingkat", "20 cm") belongs to the description.
+# Everything the grammar can't explain (extra words, questions, "tapi", a second name,
+# "minggu depan", a quantity after the item name) lowers the confidence; below
+# ORDER_GRAMMAR_MIN_CONFIDENCE the message goes to the LLM as before.
+
+_TOKEN = re.compile(
+    r"(?P<price>(?:rp\.?\s*)?@?\s*\d+(?:[.,]\d+)*\s*(?:k|rb|ribu|jt|juta)\b|rp\.?\s*\d+(?:[.,]\d+)*)"
+    r"|(?P<number>\d+(?:[.,:]\d+)*x?)"
+    r"|(?P<word>[^\W\d_]+(?:['-][^\W\d_]+)*)"
+    r"|(?P<sep>[,&+])"
+    r"|(?P<at>@)"
+    r"|(?P<question>\?)",
+    re.IGNORECASE,
+)
+
+VERBS = {'pesan', 'pesen', 'psn', 'order', 'beli', 'mesen', 'memesan', 'titip'}
+PREFIX_FILLERS = {
+    'kak', 'ka', 'kakak', 'bu', 'ibu', 'pak', 'mbak', 'mba', 'mas', 'sis', 'min', 'admin', 'halo', 'hallo', 'hai',
+    'hi', 'permisi', 'selamat', 'pagi', 'siang', 'sore', 'malam', 'mau', 'ingin', 'pengen', 'saya', 'aku', 'sy',
+    'gue', 'mo', 'tolong', 'mohon',
+}
+FILLERS = {
+    'ya', 'yah', 'yaa', 'dong', 'donk', 'kak', 'ka', 'kakak', 'sis', 'min', 'tolong', 'mohon', 'please', 'pls',
+    'ambil', 'diambil', 'kirim', 'dikirim', 'antar', 'diantar', 'pickup', 'lagi', 'mau', 'nya', 'terima', 'kasih',
+    'makasih', 'thanks', 'trims',
+}
+SEPARATORS = {'dan', 'sama', 'serta', 'plus'}
+# Words that make the message more than a plain order: a question, a condition, a change
+DOUBT_WORDS = {
+    'apa', 'aja', 'berapa', 'kapan', 'gimana', 'bagaimana', 'bisa', 'bisakah', 'ada', 'adakah', 'harga',
+    'tapi', 'kalau', 'kalo', 'atau', 'jangan', 'ganti', 'ubah', 'batal', 'cancel', 'tidak', 'gak', 'ga', 'nggak',
+    'enggak', 'belum', 'udah', 'sudah', 'kemarin', 'kmrn', 'tambah', 'kurang',
+}
+QUANTITY_WORDS = {
+    'satu': 1, 'sebuah': 1, 'sekotak': 1, 'sebox': 1, 'seloyang': 1, 'dua': 2, 'tiga': 3, 'empat': 4,
+    'lima': 5, 'enam': 6, 'tujuh': 7, 'delapan': 8, 'sembilan': 9, 'sepuluh': 10, 'sebelas': 11, 'selusin': 12,
+    'lusinan': 12,
+}
+# Counting words dropped from the description ("2 box brownies" -> "brownies")
+UNITS = {'box', 'kotak', 'pcs', 'pc', 'buah', 'biji', 'bungkus', 'pack', 'dus', 'loyang', 'porsi', 'toples'}
+# A number before these describes the item, it isn't a quantity ("kue 2 tingkat", "lapis 1 kg")
+MEASURES = {
+    'kg', 'kilo', 'gr', 'gram', 'ons', 'cm', 'mm', 'inch', 'inci', 'tingkat', 'susun', 'liter', 'ltr', 'ml',
+}
+# "3 hari lagi" is a date; a duration without "lagi" ("tahan 3 hari") is left to the LLM
+DURATIONS = {'hari': 1, 'minggu': 7, 'bulan': None, 'jam': None}
+NAME_MARKERS = {'buat', 'untuk', 'utk'}
+
+WEEKDAYS = {'senin': 0, 'selasa': 1, 'rabu': 2, 'kamis': 3, 'jumat': 4, "jum'at": 4, 'sabtu': 5, 'minggu': 6}
+MONTHS = {
+    'januari': 1, 'jan': 1, 'februari': 2, 'feb': 2, 'maret': 3, 'mar': 3, 'april': 4, 'apr': 4, 'mei': 5,
+    'juni': 6, 'jun': 6, 'juli': 7, 'jul': 7, 'agustus': 8, 'agu': 8, 'agt': 8, 'september': 9, 'sep': 9,
+    'oktober': 10, 'okt': 10, 'november': 11, 'nov': 11, 'desember': 12, 'des': 12,
+}
+RELATIVE_DAYS = {'sekarang': 0, 'nanti': 0, 'ntar': 0, 'besok': 1, 'bsk': 1, 'besoknya': 1, 'lusa': 2}
+DAY_PARTS = {'pagi': 9, 'siang': 12, 'sore': 16, 'malam': 19}
+DEFAULT_HOUR = 9  # a date without a time: same as the prompt's example due_date
+UNSUPPORTED = object()  # "minggu depan", "sabtu depan": ambiguous, left to the LLM
+
+_lock = threading.Lock()
+_stats = Counter()
+
+
+def _tokenize(text):
+    """[(kind, lowercased text, original text)] for the parts of `text` the grammar knows."""
+    tokens = []
+    for match in _TOKEN.finditer(text or ""):
+        kind = match.lastgroup
+        tokens.append((kind, match.group().lower(), match.group()))
+    return tokens
+
+
+def _amount(token):
+    """Rupiah amount of a price token ("150rb", "1,5jt", "Rp 150.000", "@85k")."""
+    match = re.search(r"(\d+(?:[.,]\d+)*)\s*(k|rb|ribu|jt|juta)?$", token)
+    number, suffix = match.groups()
+    if not suffix:
+        return int(re.sub(r"[.,]", "", number))
+    if re.fullmatch(r"\d+[.,]\d{1,2}", number):  # "1,5jt"; "1.500rb" is a thousands separator
+        value = float(number.replace(',', '.'))
+    else:
+        value = float(re.sub(r"[.,]", "", number))
+    return round(value * (1_000_000 if suffix in ('jt', 'juta') else 1000))
+
+
+def _word(tokens, i):
+    return tokens[i][1] if i < len(tokens) and tokens[i][0] == 'word' else None
+
+
+def _match_date(tokens, i, today):
+    """(date or UNSUPPORTED, day-part hour or None, tokens consumed) for a date phrase at `i`, else None."""
+    word = _word(tokens, i)
+    start = i
+    if word == 'hari' and _word(tokens, i + 1) in WEEKDAYS:
+        i += 1
+        word = _word(tokens, i)
+    elif word == 'hari' and _word(tokens, i + 1) == 'ini':
+        return today, None, 2
+
+    if word in RELATIVE_DAYS:
+        day = today + timedelta(days=RELATIVE_DAYS[word])
+        i += 1
+    elif word in DAY_PARTS and _word(tokens, i + 1) == 'ini':
+        return today, DAY_PARTS[word], 2
+    elif word in WEEKDAYS:
+        if _word(tokens, i + 1) == 'depan':
+            return UNSUPPORTED, None, i + 2 - start
+        day = today + timedelta(days=(WEEKDAYS[word] - today.weekday()) % 7 or 7)
+        i += 1
+        if _word(tokens, i) == 'ini':
+            i += 1
+    elif word in ('bulan', 'akhir') and _word(tokens, i + 1) in ('depan', 'pekan', 'bulan', 'minggu'):
+        return UNSUPPORTED, None, 2
+    elif word == 'weekend':
+        return UNSUPPORTED, None, 1
+    elif (i < len(tokens) and tokens[i][0] == 'number' and _word(tokens, i + 1) in DURATIONS
+          and _word(tokens, i + 2) == 'lagi'):
+        # "3 hari lagi", "2 minggu lagi"; "1 bulan lagi" / "2 jam lagi" are left to the LLM
+        days = DURATIONS[_word(tokens, i + 1)]
+        if days is None or not tokens[i][1].isdigit():
+            return UNSUPPORTED, None, 3
+        day = today + timedelta(days=days * int(tokens[i][1]))
+        i += 3
+    elif word in ('tanggal', 'tgl', 'tangal') or (
+            i < len(tokens) and tokens[i][0] == 'number' and _word(tokens, i + 1) in MONTHS):
+        if word is not None:
+            i += 1
+        if i >= len(tokens) or not tokens[i][1].isdigit():
+            return None
+        day = _calendar_day(today, int(tokens[i][1]), MONTHS.get(_word(tokens, i + 1)))
+        i += 2 if _word(tokens, i + 1) in MONTHS else 1
+    else:
+        return None
+
+    hour = None
+    if _word(tokens, i) in DAY_PARTS:
+        hour = DAY_PARTS[_word(tokens, i)]
+        i += 1
+    return day, hour, i - start
+
+
+def _calendar_day(today, day, month=None):
+    """The next `day` of `month` (this month or the next if omitted) on or after today."""
+    try:
+        if month is None:
+            candidate = today.replace(day=day)
+            if candidate < today:
+                year, month = (today.year + 1, 1) if today.month == 12 else (today.year, today.month + 1)
+                candidate = candidate.replace(year=year, month=month)
+            return candidate
+        candidate = today.replace(month=month, day=day)
+        return candidate if candidate >= today else candidate.replace(year=today.year + 1)
+    except ValueError:
+        return UNSUPPORTED  # "tanggal 31" in a 30-day month
+
+
+def _match_time(tokens, i):
+    """((hour, minute), tokens consumed) for "jam 5", "pukul 17.30", "jam 4 sore" at `i`, else None."""
+    if _word(tokens, i) not in ('jam', 'pukul', 'pkl') or i + 1 >= len(tokens) or tokens[i + 1][0] != 'number':
+        return None
+    match = re.fullmatch(r"(\d{1,2})(?:[.:](\d{2}))?", tokens[i + 1][1])
+    if not match:
+        return None
+    hour, minute = int(match.group(1)), int(match.group(2) or 0)
+    part = _word(tokens, i + 2)
+    if part in ('sore', 'malam') and hour < 12:
+        hour += 12
+    elif part == 'siang' and hour < 11:
+        hour += 12
+    elif part not in DAY_PARTS and 1 <= hour <= 6:
+        hour += 12  # "jam 5": nobody picks up a cake at 5 AM
+    consumed = 3 if part in DAY_PARTS else 2
+    if hour > 23 or minute > 59:
+        return None
+    return (hour, minute), consumed
+
+
+def _name_words(tokens, i, capitalized_only):
+    """The name starting at `i` (up to 3 words), or []."""
+    words = []
+    while i < len(tokens) and len(words) < 3 and tokens[i][0] == 'word':
+        word, raw = tokens[i][1], tokens[i][2]
+        if (word in FILLERS or word in SEPARATORS or word in RELATIVE_DAYS or word in WEEKDAYS
+                or word in DAY_PARTS or word in ('jam', 'pukul', 'tanggal', 'tgl', 'hari')):
+            break
+        if capitalized_only and not raw[0].isupper():
+            break
+        words.append(raw if raw[0].isupper() else raw.capitalize())
+        i += 1
+    return words
+
+
+def parse_order_text(text, now=None):
+    """
+    Parses a plain NEW_ORDER message. Returns the AI-shaped dict with `confidence`
+    and source 'grammar', or None if the message has no ordering verb at all.
+    """
+    tokens = _tokenize(text)
+    verb = next((i for i, token in enumerate(tokens) if token[0] == 'word' and token[1] in VERBS), None)
+    if verb is None:
+        return None
+    now = now or timezone.localtime()
+    today = now.date()
+    doubt = 0.0
+    names = []
+
+    # "Kak, Bella mau pesan ...": the name is what's left before the verb
+    prefix = [token for token in tokens[:verb] if token[1] not in PREFIX_FILLERS and token[0] != 'sep']
+    if any(token[0] != 'word' or token[1] in DOUBT_WORDS for token in prefix):
+        doubt += 0.5
+    prefix = [token for token in prefix if token[0] == 'word']
+    capitalized = [token[2] for token in prefix if token[2][0].isupper()]
+    if capitalized:
+        names.append(' '.join(capitalized[-2:]))
+        doubt += 0.3 if len(capitalized) < len(prefix) or len(capitalized) > 2 else 0.0
+    elif len(prefix) == 1:
+        names.append(prefix[0][2].capitalize())
+    elif prefix:
+        doubt += 0.4
+
+    items, current = [], None
+    date, day_hour, time_of_day = None, None, None
+
+    def close_item():
+        nonlocal current, doubt
+        if current is not None:
+            if current['words']:
+                items.append(current)
+            else:
+                doubt += 0.5  # "pesan 2 buat besok": a quantity of nothing
+        current = None
+
+    def new_item(quantity=None):
+        nonlocal current
+        close_item()
+        current = {'words': [], 'quantity': quantity, 'price': None, 'interrupted': False}
+
+    i = verb + 1
+    while i < len(tokens):
+        kind, word, raw = tokens[i]
+
+        marker = 1 if word in NAME_MARKERS else 0
+        date_match = _match_date(tokens, i + marker, today)
+        if date_match:
+            found, hour, consumed = date_match
+            if found is UNSUPPORTED:
+                doubt += 0.5
+            elif date is not None and found != date:
+                doubt += 0.4
+            date, day_hour = found, hour if hour is not None else day_hour
+            if current is not None and current['words']:
+                current['interrupted'] = True
+            i += marker + consumed
+            continue
+
+        time_match = _match_time(tokens, i)
+        if time_match:
+            if time_of_day is not None:
+                doubt += 0.4
+            time_of_day, consumed = time_match
+            if current is not None and current['words']:
+                current['interrupted'] = True
+            i += consumed
+            continue
+
+        if marker or (word == 'atas' and _word(tokens, i + 1) == 'nama') or word == 'an':
+            skip = 2 if word == 'atas' else 1
+            name = _name_words(tokens, i + skip, capitalized_only=bool(marker))
+            if name:
+                names.append(' '.join(name))
+                if current is not None and current['words']:
+                    current['interrupted'] = True
+                i += skip + len(name)
+            else:
+                doubt += 0.4  # "buat acara arisan": not a name, not a date
+                i += 1
+            continue
+
+        if kind == 'sep' or word in SEPARATORS:
+            close_item()
+        elif kind == 'price' or (kind == 'at' and i + 1 < len(tokens)
+                                 and re.fullmatch(r"\d+(?:[.,]\d+)*", tokens[i + 1][1])):
+            if kind == 'at':
+                i += 1
+                amount = _amount(tokens[i][1])
+                if amount < 1000:
+                    doubt += 0.4  # "@85": thousands or not?
+            else:
+                amount = _amount(word)
+            if current is None:
+                new_item()
+                doubt += 0.3  # a price before the item
+            if current['price'] is not None:
+                doubt += 0.3
+            current['price'] = amount
+        elif kind == 'number' and _word(tokens, i + 1) in MEASURES | DURATIONS.keys():
+            # "kue 2 tingkat", "diameter 20 cm": part of the description
+            if current is None or not current['words'] or _word(tokens, i + 1) in DURATIONS:
+                doubt += 0.5  # "2 kg brownies": one item of 2 kg or 2 items? "tahan 3 hari"?
+            elif current['interrupted']:
+                doubt += 0.3
+            if current is None:
+                new_item()
+            current['words'].append(f"{raw} {tokens[i + 1][2]}")
+            i += 1
+        elif kind == 'number' or (word in QUANTITY_WORDS and (current is None or current['words'])):
+            if kind == 'number' and not re.fullmatch(r"\d+x?", word):
+                doubt += 0.5
+            if current is not None and current['words']:
+                doubt += 0.5  # "brownies 2 loyang", "nastar 2 risoles 3": whose quantity is it?
+            quantity = QUANTITY_WORDS.get(word) or int(re.match(r"\d+", word).group())
+            if current is not None and not current['words'] and current['quantity'] is not None:
+                doubt += 0.5  # "2 3 brownies"
+            new_item(quantity)
+        elif kind == 'word' and word in UNITS and current is not None and not current['words']:
+            pass
+        elif kind == 'word' and word in FILLERS:
+            pass
+        elif kind == 'word' and word in DAY_PARTS:
+            day_hour = DAY_PARTS[word]  # "sore" on its own: today, unless a date says otherwise
+            if current is not None and current['words']:
+                current['interrupted'] = True
+        elif kind == 'word':
+            if word in VERBS or word in DOUBT_WORDS:
+                doubt += 0.5  # a second order in one message, a question, a condition
+            if current is None:
+                new_item()
+            elif current['interrupted']:
+                doubt += 0.3  # description words on both sides of a date / name
+            current['words'].append(raw)
+        else:
+            doubt += 0.5  # "?" or a stray "@"
+        i += 1
+    close_item()
+
+    if len(set(names)) > 1:
+        doubt += 0.4  # "Bella pesan ... buat Budi": who is the client?
+    client_name = names[0] if names else 'Owner'
+
+    order_items = []
+    for position, item in enumerate(items):
+        if item['quantity'] is None:
+            # "pesan brownies" is 1 brownies; "2 kue lapis dan legit" is probably one item
+            doubt += 0.1 if position == 0 else 0.3
+        if len(item['words']) > 4:
+            doubt += 0.3
+        order_items.append({
+            'description': ' '.join(item['words']),
+            'quantity': item['quantity'] or 1,
+            'price': item['price'] or 0,
+            'client_name': client_name,
+        })
+
+    due_date = None
+    if date is UNSUPPORTED:
+        pass
+    elif date is not None or time_of_day is not None or day_hour is not None:
+        hour, minute = time_of_day or (day_hour if day_hour is not None else DEFAULT_HOUR, 0)
+        due = datetime.combine(date or today, datetime.min.time()).replace(hour=hour, minute=minute)
+        if due.date() == today and ((time_of_day is None and day_hour is None) or due < now.replace(tzinfo=None)):
+            doubt += 0.3  # "hari ini" without a time, or a time that has passed: tomorrow?
+        due_date = due.strftime('%Y-%m-%d %H:%M:%S')
+
+    return {
+        'intent': 'NEW_ORDER',
+        'items': order_items,
+        'due_date': due_date,
+        'order_id': None,
+        'source': 'grammar',
+        'confidence': round(max(0.0, 1.0 - doubt), 2) if order_items else 0.0,
+    }
+
+
+def parse_order_grammar(text):
+    """
+    parse_order_text() when it is sure enough (ORDER_GRAMMAR_MIN_CONFIDENCE), else None
+    so the caller asks the LLM.
+    """
+    if not settings.ORDER_GRAMMAR_ENABLED:
+        return None
+    result = parse_order_text(text)
+    if result is None:
+        outcome = 'no_match'
+    elif result['confidence'] >= settings.ORDER_GRAMMAR_MIN_CONFIDENCE:
+        outcome = 'parsed'
+    else:
+        outcome = 'low_confidence'
+    with _lock:
+        _stats[outcome] += 1
+    return result if outcome == 'parsed' else None
+
+
+def get_grammar_stats():
+    """How many messages the grammar parsed, passed on with a low confidence, or didn't match."""
+    with _lock:
+        stats = {key: _stats[key] for key in ('parsed', 'low_confidence', 'no_match')}
+    total = sum(stats.values())
+    stats['parse_rate'] = stats['parsed'] / total if total else 0.0
+    return stats
+
+
+def reset_grammar_stats():
+    with _lock:
+        _stats.clear()
@@ -0,0 +1,276 @@
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from .models import Order
+from .message_queue import mark_processed
+from .agenda import get_agenda_page, invalidate_agenda
+from .ai_service import STOP_STREAM, STREAM_RESTART, parse_message
+from .telegram_utils import enqueue_telegram_reply
+from .calendar_outbox import queue_calendar_sync
+from .metrics import set_intent, stage
+
+
+AI_ERROR_REPLY = "⚠️ Error: AI could not process this message."
+
+
+class AIParseError(Exception):
+    """No LLM answer for the message (providers down, unparseable output): retried with backoff."""
+
+
+def _target_ids(ai_result):
+    """Order ids referenced by a CONFIRM / CANCEL ("Ok 20, 21" -> [20, 21])."""
+    raw_ids = ai_result.get('order_ids') or [ai_result.get('order_id')]
+    cleaned = (str(i).strip().lstrip('#') for i in raw_ids if i is not None)
+    return [int(i) for i in cleaned if i.isdigit()]
+
+
+def clean_order_items(raw_items):
+    """
+    Normalizes the AI's item list into dicts ready for Order(...).
+    The AI sometimes returns plain strings or prices as text ("200k"); those are fixed up here.
+    """
+    items = []
+    for item in raw_items or []:
+        # --- SAFETY FIX ---
+        # If AI returns a simple string like "Cake", convert it to a dict
+        if isinstance(item, str):
+            item = {'description': item}
+        if not isinstance(item, dict):
+            continue
+        # ------------------
+
+        # Ensure price is a number (sometimes AI sends "200k" as text here)
+        price = item.get('price')
+        if isinstance(price, float):
+            price = int(price)
+        elif isinstance(price, str) and price.strip().isdigit():
+            price = int(price.strip())
+        if not isinstance(price, int) or isinstance(price, bool):
+            price = 0  # Default to 0 if invalid
+
+        quantity = item.get('quantity')
+        if isinstance(quantity, str) and quantity.strip().isdigit():
+            quantity = int(quantity.strip())
+        if not isinstance(quantity, int) or quantity < 1:
+            quantity = 1
+
+        items.append({
+            'description': str(item.get('description') or 'Unknown Item'),
+            'quantity': quantity,
+            'price': price,
+            'client_name': item.get('client_name') or 'Unknown',
+        })
+    return items
+
+
+def parse_due_date(value):
+    """AI due_date string ("2025-12-26 09:00:00") -> aware datetime, or None if missing/invalid."""
+    if not value:
+        return None
+    try:
+        due_date = parse_datetime(str(value))
+    except ValueError:
+        return None
+    if due_date and timezone.is_naive(due_date):
+        due_date = timezone.make_aware(due_date)
+    return due_date
+
+
+def create_orders(customer, raw_msg, items, due_date):
+    """
+    Saves cleaned items as PENDING orders: one transaction, one INSERT for all items
+    (ids come back via RETURNING on Postgres). Marking the message processed in the
+    same transaction means a retry can never create the same orders twice.
+    """
+    with stage('order_write'), transaction.atomic():
+        orders = Order.objects.bulk_create([
+            Order(
+                customer=customer,
+                source_message=raw_msg,
+                client_name=item['client_name'],
+                item_description=item['description'],
+                quantity=item['quantity'],
+                price=item['price'],
+                due_date=due_date,
+                status='PENDING',
+            )
+            for item in items
+        ])
+        mark_processed(raw_msg)
+        # bulk_create skips post_save, so drop the cached agenda ourselves
+        transaction.on_commit(lambda: invalidate_agenda(customer.id))
+    return orders
+
+
+def confirm_orders(customer, orders, raw_msg=None):
+    """
+    Marks PENDING orders CONFIRMED with one UPDATE and queues their calendar events in
+    the same transaction; the outbox dispatcher creates them (orders/calendar_outbox.py).
+    `raw_msg` is marked processed in it too, so a retry never sees the orders already
+    confirmed and answers "No pending order found".
+    """
+    with stage('order_write'), transaction.atomic():
+        Order.objects.filter(id__in=[order.id for order in orders], status='PENDING').update(status='CONFIRMED')
+        for order in orders:
+            order.status = 'CONFIRMED'
+        queue_calendar_sync(orders)
+        if raw_msg is not None:
+            mark_processed(raw_msg)
+        # update() skips post_save, so drop the cached agenda ourselves
+        transaction.on_commit(lambda: invalidate_agenda(customer.id))
+
+
+def cancel_orders(customer, orders, raw_msg=None):
+    """
+    Marks orders CANCELLED and queues the removal of their calendar events, in one
+    transaction (with `raw_msg` marked processed, like confirm_orders()). The event id
+    stays on the order until the dispatcher has deleted it.
+    """
+    # A still PENDING order never had an event
+    synced = [order for order in orders if order.status != 'PENDING' or order.calendar_event_id]
+    with stage('order_write'), transaction.atomic():
+        Order.objects.filter(id__in=[order.id for order in orders]).update(status='CANCELLED')
+        for order in orders:
+            order.status = 'CANCELLED'
+        queue_calendar_sync(synced)
+        if raw_msg is not None:
+            mark_processed(raw_msg)
+        transaction.on_commit(lambda: invalidate_agenda(customer.id))
+
+
+PROCESSING_REPLY = "⏳ Processing your order..."
+
+
+def stream_intent_action(event, streamed_items):
+    """
+    What the pipelines do with a streamed parse event (LLM_STREAMING) before the answer
+    is complete. Returns 'processing' when a "processing" reply should go out now,
+    STOP_STREAM when the rest of the answer isn't needed, else None. NEW_ORDER items are
+    validated into `streamed_items` as they arrive; they are still inserted together by
+    create_orders(), in the transaction that marks the message processed, so a retry
+    can't create them twice.
+    """
+    if event[:2] == ('field', 'intent'):
+        intent = str(event[2] or 'UNKNOWN').upper()
+        set_intent(intent)
+        if intent == 'NEW_ORDER':
+            return 'processing' if settings.LLM_STREAM_PROCESSING_REPLY else None
+        if intent in ('LIST_ORDERS', 'UNKNOWN'):
+            return STOP_STREAM  # the handlers use nothing but the intent
+    elif event[0] == 'item':
+        streamed_items.extend(clean_order_items([event[1]]))
+    elif event == STREAM_RESTART:
+        streamed_items.clear()  # the stream broke off: the fallback answer has all the items
+    return None
+
+
+def render_review_reply(orders, due_display):
+    """The "Review Order" message for freshly created orders, built in one pass."""
+    lines = ["📝 **Review Order:**"]
+    for order in orders:
+        price_display = f"Rp {order.price:,}" if order.price else "?"
+        lines.append(f"- [ID: {order.id}] {order.quantity}x {order.item_description} ({price_display})")
+        lines.append(f"  👤 {order.client_name}")
+    ids_str = ", ".join(str(order.id) for order in orders)
+    lines.append(f"\nDue: {due_display}\n\nReply **'Ok {ids_str}'** to confirm.")
+    return "\n".join(lines)
+
+
+def handle_message(raw_msg):
+    """
+    Runs the intent pipeline (AI -> DB -> Calendar -> Telegram) for one saved RawMessage.
+    Returns a short status string. Exceptions are left to the caller (the worker retries them);
+    AIParseError when no LLM could parse the message.
+    """
+    customer = raw_msg.customer
+    chat_id = customer.chat_id
+    text = raw_msg.text
+    set_intent('none')  # worker threads are reused; don't inherit the last message's intent
+
+    # 1. Ask AI what to do (command-style messages are answered by the local rules)
+    streamed_items = []
+
+    def on_event(event):
+        action = stream_intent_action(event, streamed_items)
+        if action == 'processing':
+            enqueue_telegram_reply(chat_id, PROCESSING_REPLY)
+        return action
+
+    ai_result = parse_message(text, on_event=on_event)
+
+    # Check if AI failed to return a result: usually transient, so the worker retries it
+    if not ai_result:
+        raise AIParseError("no LLM provider could parse the message")
+
+    # --- FIX: Force Uppercase ---
+    raw_intent = ai_result.get('intent', 'UNKNOWN')
+    intent = raw_intent.upper() if raw_intent else 'UNKNOWN'
+    # ----------------------------
+    set_intent(intent)
+
+    # --- SCENARIO A: NEW ORDER ---
+    if intent == 'NEW_ORDER':
+        # Validate everything BEFORE touching the DB (a streamed answer was validated item by item)
+        items = streamed_items or clean_order_items(ai_result.get('items'))
+        due_date = parse_due_date(ai_result.get('due_date'))
+
+        if not items:
+            enqueue_telegram_reply(chat_id, "❓ I couldn't find any items in that order. Try 'Pesan 2 brownies buat besok'.")
+            return 'no_items'
+
+        orders = create_orders(customer, raw_msg, items, due_date)
+        enqueue_telegram_reply(chat_id, render_review_reply(orders, ai_result.get('due_date')))
+
+    # --- SCENARIO B: CONFIRMATION ---
+    elif intent == 'CONFIRM':
+        # "Ok 20, 21" confirms several orders (the rule classifier fills order_ids)
+        target_ids = _target_ids(ai_result)
+        if target_ids:
+            orders_to_confirm = Order.objects.filter(id__in=target_ids, customer=customer, status='PENDING')
+        else:
+            # Fallback to latest if no ID given (optional, or you can make this strict too)
+            orders_to_confirm = Order.objects.filter(customer=customer, status='PENDING').order_by('-created_at')[:1]
+
+        orders_to_confirm = list(orders_to_confirm)
+        if orders_to_confirm:
+            # The calendar events are created in the background (orders/calendar_outbox.py)
+            confirm_orders(customer, orders_to_confirm, raw_msg)
+            for order in orders_to_confirm:
+                enqueue_telegram_reply(chat_id, f"✅ Order #{order.id} ({order.item_description}) Confirmed!")
+        else:
+            enqueue_telegram_reply(chat_id, "❓ No pending order found to confirm.")
+
+    # --- SCENARIO C: CANCEL (STRICT MODE) ---
+    elif intent == 'CANCEL':
+        target_ids = _target_ids(ai_result)
+
+        # REQUIREMENT: Ignore if no ID is present
+        if not target_ids:
+            enqueue_telegram_reply(chat_id, "⚠️ To cancel, you must provide the ID (e.g., 'Cancel 5').")
+        else:
+            # Find orders regardless of status (Pending or Confirmed)
+            # We only let them cancel THEIR own orders
+            orders_to_cancel = list(Order.objects.filter(id__in=target_ids, customer=customer))
+
+            # Their calendar events are removed in the background (orders/calendar_outbox.py)
+            if orders_to_cancel:
+                cancel_orders(customer, orders_to_cancel, raw_msg)
+            for order in orders_to_cancel:
+                enqueue_telegram_reply(chat_id, f"❌ Order #{order.id} has been CANCELLED.")
+
+            found_ids = {o.id for o in orders_to_cancel}
+            for missing_id in target_ids:
+                if missing_id not in found_ids:
+                    enqueue_telegram_reply(chat_id, f"❓ Could not find Order #{missing_id}.")
+
+    # --- SCENARIO D: LIST ORDERS (NEXT 3 DAYS) ---
+    elif intent == 'LIST_ORDERS':
+        # Rendered agenda is cached per customer until one of their orders changes
+        enqueue_telegram_reply(chat_id, get_agenda_page(customer.id, ai_result.get('page')))
+
+    # --- SCENARIO E: UNKNOWN ---
+    else:
+        enqueue_telegram_reply(chat_id, "I didn't understand. Try 'Pesan...', 'Ok [ID]', 'Cancel [ID]', or 'Cek Order'.")
+
+    return 'ok'
@@ -0,0 +1,207 @@
+import json
+import zlib
+from datetime import date
+from django.db import connection, transaction
+from .models import RawMessage, Order
+
+# Storage helpers for RawMessage, the fastest-growing table.
+#
+# - On PostgreSQL the table is partitioned by month on `timestamp` (migration 0007),
+#   so retiring a month is a DETACH PARTITION instead of a mass DELETE.
+# - Old payloads are compacted: the full Telegram update is compressed into
+#   `meta_data_archive` and `meta_data` keeps only the fields the pipeline uses.
+
+try:
+    import zstandard  # optional, better ratio and speed than zlib
+except ImportError:
+    zstandard = None
+
+TABLE = RawMessage._meta.db_table
+DEFAULT_PARTITION = f"{TABLE}_default"
+
+
+# --- Payload compaction ---
+
+def slim_payload(payload):
+    """The few fields of a Telegram update we keep in hot storage."""
+    message = (payload or {}).get('message') or {}
+    return {
+        'update_id': (payload or {}).get('update_id'),
+        'message_id': message.get('message_id'),
+        'chat_id': (message.get('chat') or {}).get('id'),
+        'first_name': (message.get('from') or {}).get('first_name'),
+        'date': message.get('date'),
+    }
+
+
+def compress_payload(payload):
+    """Returns (codec, blob) for a JSON payload; zstd when installed, else zlib."""
+    raw = json.dumps(payload, separators=(',', ':'), ensure_ascii=False).encode()
+    if zstandard is not None:
+        return 'zstd', zstandard.ZstdCompressor(level=10).compress(raw)
+    return 'zlib', zlib.compress(raw, 9)
+
+
+def decompress_payload(codec, blob):
+    if blob is None:
+        return None
+    blob = bytes(blob)
+    if codec == 'zstd':
+        if zstandard is None:
+            raise RuntimeError("This payload was archived with zstd; install 'zstandard' to read it.")
+        raw = zstandard.ZstdDecompressor().decompress(blob)
+    else:
+        raw = zlib.decompress(blob)
+    return json.loads(raw)
+
+
+def full_payload(raw_msg):
+    """The original Telegram update, whether or not the message has been compacted."""
+    if not raw_msg.is_compacted:
+        return raw_msg.meta_data
+    return decompress_payload(raw_msg.meta_data.get('archive_codec'), raw_msg.meta_data_archive)
+
+
+def compact_messages(older_than, batch_size=1000):
+    """
+    Compresses the payload of processed messages older than `older_than` (a datetime).
+    Works in batches so it never holds long locks. Returns the number of rows compacted.
+    """
+    total = 0
+    while True:
+        with transaction.atomic():
+            # Only finished messages (processed or dead-lettered); the queue still needs the rest
+            batch = list(
+                RawMessage.objects
+                .select_for_update(skip_locked=True)
+                .filter(timestamp__lt=older_than, is_compacted=False)
+                .exclude(is_processed=False, is_dead_letter=False)
+                .only('id', 'timestamp', 'meta_data')
+                .order_by('timestamp')[:batch_size]
+            )
+            if not batch:
+                return total
+
+            for msg in batch:
+                codec, blob = compress_payload(msg.meta_data)
+                msg.meta_data = dict(slim_payload(msg.meta_data), archive_codec=codec)
+                msg.meta_data_archive = blob
+                msg.is_compacted = True
+            RawMessage.objects.bulk_update(batch, ['meta_data', 'meta_data_archive', 'is_compacted'])
+        total += len(batch)
+
+
+# --- Monthly partitions (PostgreSQL only) ---
+
+def is_partitioned():
+    if connection.vendor != 'postgresql':
+        return False
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT 1 FROM pg_partitioned_table p JOIN pg_class c ON c.oid = p.partrelid WHERE c.relname = %s",
+            [TABLE],
+        )
+        return cursor.fetchone() is not None
+
+
+def _month_start(value):
+    return date(value.year, value.month, 1)
+
+
+def add_months(month, count):
+    index = month.year * 12 + month.month - 1 + count
+    return date(index // 12, index % 12 + 1, 1)
+
+
+def partition_name(month):
+    return f"{TABLE}_{month:%Y_%m}"
+
+
+def list_partitions():
+    """[(partition_name, is_default)] currently attached to the RawMessage table."""
+    with connection.cursor() as cursor:
+        cursor.execute(
+            """
+            SELECT child.relname, pg_get_expr(child.relpartbound, child.oid) = 'DEFAULT'
+            FROM pg_inherits
+            JOIN pg_class parent ON parent.oid = pg_inherits.inhparent
+            JOIN pg_class child ON child.oid = pg_inherits.inhrelid
+            WHERE parent.relname = %s
+            ORDER BY child.relname
+            """,
+            [TABLE],
+        )
+        return cursor.fetchall()
+
+
+def ensure_month_partition(month):
+    """
+    Creates the partition for `month` if missing. Rows that already landed in the
+    DEFAULT partition for that range are moved into it (attach would fail otherwise).
+    Returns True if a partition was created.
+    """
+    month = _month_start(month)
+    name = partition_name(month)
+    existing = {partition for partition, _ in list_partitions()}
+    if name in existing:
+        return False
+
+    start, end = month, add_months(month, 1)
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute(f'CREATE TABLE "{name}" (LIKE "{TABLE}" INCLUDING DEFAULTS INCLUDING CONSTRAINTS)')
+        if DEFAULT_PARTITION in existing:
+            cursor.execute(
+                f'WITH moved AS (DELETE FROM "{DEFAULT_PARTITION}" WHERE "timestamp" >= %s AND "timestamp" < %s RETURNING *) '
+                f'INSERT INTO "{name}" SELECT * FROM moved',
+                [start, end],
+            )
+        cursor.execute(
+            f'ALTER TABLE "{TABLE}" ATTACH PARTITION "{name}" FOR VALUES FROM (%s) TO (%s)',
+            [start, end],
+        )
+    return True
+
+
+def ensure_partitions(from_month, months_ahead):
+    """Makes sure every month from `from_month` up to `months_ahead` after today has a partition."""
+    created = []
+    month = _month_start(from_month)
+    last = add_months(_month_start(date.today()), months_ahead)
+    while month <= last:
+        if ensure_month_partition(month):
+            created.append(partition_name(month))
+        month = add_months(month, 1)
+    return created
+
+
+def detach_partitions_before(cutoff_month, drop=False):
+    """
+    Detaches every monthly partition that ends on or before `cutoff_month`.
+    Orders that pointed at those messages get source_message = NULL (same as
+    on_delete=SET_NULL). Detached tables are kept as `<name>_archive` unless drop=True.
+    Returns the names of the partitions handled.
+    """
+    cutoff_month = _month_start(cutoff_month)
+    handled = []
+    for name, is_default in list_partitions():
+        if is_default:
+            continue
+        try:
+            year, month = (int(part) for part in name.rsplit('_', 2)[-2:])
+        except ValueError:
+            continue
+        if add_months(date(year, month, 1), 1) > cutoff_month:
+            continue
+
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.execute(
+                f'UPDATE "{Order._meta.db_table}" SET source_message_id = NULL '
+                f'WHERE source_message_id IN (SELECT id FROM "{name}")'
+            )
+            cursor.execute(f'ALTER TABLE "{TABLE}" DETACH PARTITION "{name}"')
+            if drop:
+                cursor.execute(f'DROP TABLE "{name}"')
+            else:
+                cursor.execute(f'ALTER TABLE "{name}" RENAME TO "{name}_archive"')
+        handled.append(name)
+    return handled
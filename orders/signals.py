@@ -1,16 +1,41 @@
-from django.db.models.signals import post_save
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete
 from django.dispatch import receiver
-from .models import Order
-from .calendar_service import create_calendar_event
+from .models import Customer, Order
+from .calendar_outbox import queue_calendar_sync
+from .customer_cache import invalidate_customer
+from .agenda import invalidate_agenda
 
 @receiver(post_save, sender=Order)
-def order_confirmed_trigger(sender, instance, created, **kwargs):
+def order_calendar_trigger(sender, instance, **kwargs):
     """
-    Triggered whenever an Order is saved.
+    Queues a calendar sync for the saved order, in the save's transaction (see
+    Order.save). The API call is made by the dispatcher in orders/calendar_outbox.py.
     """
-    # Only act if status is CONFIRMED
-    if instance.status == 'CONFIRMED' and instance.due_date:
-        # We check a custom flag to prevent duplicate events
-        # (Ideally, you'd add a boolean field 'is_synced_to_calendar' to your model)
-        print(f"Syncing Order #{instance.id} to Calendar...")
-        create_calendar_event(instance)
\ No newline at end of file
+    queue_calendar_sync([instance])
+
+
+@receiver(post_delete, sender=Order)
+def order_deleted_calendar_trigger(sender, instance, **kwargs):
+    """
+    Queues the removal of a deleted order's event (delete() runs in a transaction).
+    """
+    queue_calendar_sync([instance], deleted=True)
+
+
+@receiver(post_save, sender=Customer)
+@receiver(post_delete, sender=Customer)
+def customer_changed_trigger(sender, instance, **kwargs):
+    """
+    Keeps the chat_id -> customer cache honest when a Customer is edited or removed.
+    """
+    invalidate_customer(instance.chat_id)
+
+
+@receiver(post_save, sender=Order)
+@receiver(post_delete, sender=Order)
+def order_changed_trigger(sender, instance, **kwargs):
+    """
+    Drops the customer's cached LIST_ORDERS agenda once the change is committed.
+    """
+    transaction.on_commit(lambda: invalidate_agenda(instance.customer_id))
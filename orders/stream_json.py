@@ -0,0 +1,119 @@
+import json
+
+# Incremental reader for the model's streamed JSON answer, so the pipeline can act on
+# the intent (and each order item) while the rest is still being generated.
+
+
+class JSONStreamParser:
+    """
+    Feed it the streamed text chunk by chunk; feed() returns the events each chunk
+    completed, in order:
+      ('field', key, value)  a top-level field whose value is complete
+      ('item', value)        one element of the `items_key` array, as soon as it closes
+    Anything before the first "{" (e.g. a ```json fence) is skipped. `fields` holds the
+    top-level fields decoded so far.
+    """
+
+    def __init__(self, items_key='items'):
+        self.items_key = items_key
+        self.fields = {}
+        self._text = ''
+        self._pos = 0
+        self._depth = 0
+        self._done = False
+        self._in_string = False
+        self._escape = False
+        self._expect_key = False
+        self._key = None
+        self._key_start = None
+        self._value_start = None
+        self._in_items = False
+        self._element_start = None
+
+    @property
+    def text(self):
+        return self._text
+
+    def feed(self, chunk):
+        events = []
+        self._text += chunk
+        text = self._text
+        for pos in range(self._pos, len(text)):
+            char = text[pos]
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif char == '\\':
+                    self._escape = True
+                elif char == '"':
+                    self._in_string = False
+                    if self._key_start is not None:
+                        self._key = self._decode(text[self._key_start:pos + 1])
+                        self._key_start = None
+                continue
+            if char.isspace():
+                continue
+            if self._depth == 0:
+                if char == '{' and not self._done:
+                    self._depth = 1
+                    self._expect_key = True
+                continue
+
+            # First character of a top-level value / of an element of the items array
+            if self._depth == 1 and not self._expect_key and self._value_start is None and char not in ',}':
+                self._value_start = pos
+            elif self._depth == 2 and self._in_items and self._element_start is None and char not in ',]':
+                self._element_start = pos
+
+            if char == '"':
+                self._in_string = True
+                if self._depth == 1 and self._expect_key:
+                    self._key_start = pos
+            elif char == ':' and self._depth == 1:
+                self._expect_key = False
+            elif char in '{[':
+                if self._depth == 1 and char == '[' and self._key == self.items_key:
+                    self._in_items = True
+                self._depth += 1
+            elif char in '}]':
+                if self._depth == 2 and self._in_items:
+                    self._end_element(text, pos, events)
+                    self._in_items = False
+                self._depth -= 1
+                if self._depth == 0:
+                    self._end_value(text, pos, events)
+                    self._done = True
+            elif char == ',':
+                if self._depth == 1:
+                    self._end_value(text, pos, events)
+                    self._expect_key = True
+                elif self._depth == 2 and self._in_items:
+                    self._end_element(text, pos, events)
+        self._pos = len(text)
+        return events
+
+    def _end_value(self, text, pos, events):
+        if self._key is not None and self._value_start is not None:
+            value = self._decode(text[self._value_start:pos])
+            if value is not _INVALID:
+                self.fields[self._key] = value
+                events.append(('field', self._key, value))
+        self._key = None
+        self._value_start = None
+
+    def _end_element(self, text, pos, events):
+        if self._element_start is not None:
+            value = self._decode(text[self._element_start:pos])
+            if value is not _INVALID:
+                events.append(('item', value))
+        self._element_start = None
+
+    @staticmethod
+    def _decode(fragment):
+        try:
+            return json.loads(fragment)
+        except ValueError:
+            return _INVALID
+
+
+_INVALID = object()
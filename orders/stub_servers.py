@@ -0,0 +1,443 @@
+import json
+import re
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta
+from email.parser import BytesParser
+from email.policy import HTTP
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+# Local stand-ins for the external APIs, used by load tests and manual testing.
+# Start them with `python manage.py run_stub_servers` and point the app at them
+# (e.g. CALENDAR_API_ROOT_URL=http://127.0.0.1:8099/, TELEGRAM_API_BASE=http://127.0.0.1:8098,
+# DEEPSEEK_API_BASE=http://127.0.0.1:8097).
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass  # keep the console quiet under load
+
+    def _read_body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return self.rfile.read(length) if length else b''
+
+    def _send(self, status, body=b'', content_type='application/json'):
+        if isinstance(body, (dict, list)):
+            body = json.dumps(body).encode()
+        try:
+            self.send_response(status)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        except (BrokenPipeError, ConnectionResetError):
+            self.close_connection = True  # the client gave up (e.g. a cancelled hedged request)
+
+    def _delay(self):
+        # Injected latency (seconds), configured per server
+        if self.server.latency:
+            time.sleep(self.server.latency)
+
+
+class CalendarStubHandler(StubHandler):
+    """
+    Minimal Google Calendar v3: events insert/update/delete/list plus the multipart batch
+    endpoint (/batch/calendar/v3) used by calendar_service.apply_calendar_changes().
+    """
+
+    def do_POST(self):
+        self._delay()
+        body = self._read_body()
+        if self.path.startswith('/batch/'):
+            return self._handle_batch(body)
+        status, payload = self.server.calendar.handle('POST', self.path, body)
+        self._send(status, payload)
+
+    def do_DELETE(self):
+        self._delay()
+        self._read_body()
+        status, payload = self.server.calendar.handle('DELETE', self.path, b'')
+        self._send(status, payload)
+
+    def do_PUT(self):
+        self._delay()
+        status, payload = self.server.calendar.handle('PUT', self.path, self._read_body())
+        self._send(status, payload)
+
+    def do_GET(self):
+        self._delay()
+        status, payload = self.server.calendar.handle('GET', self.path, b'')
+        self._send(status, payload)
+
+    def _handle_batch(self, body):
+        content_type = self.headers['Content-Type']
+        message = BytesParser(policy=HTTP).parsebytes(
+            f"Content-Type: {content_type}\r\n\r\n".encode() + body
+        )
+
+        boundary = f"batch_{uuid.uuid4().hex}"
+        out = []
+        for part in message.iter_parts():
+            # Each part is a serialized HTTP request: request line, headers, blank line, body
+            inner = part.get_payload().replace('\r\n', '\n')
+            request_line, _, rest = inner.partition('\n')
+            method, path = request_line.split()[:2]
+            _, _, inner_body = rest.partition('\n\n')
+            status, payload = self.server.calendar.handle(method, path, inner_body.encode())
+            payload_text = json.dumps(payload) if payload != b'' else ''
+            out.append(
+                f"--{boundary}\r\n"
+                f"Content-Type: application/http\r\n"
+                f"Content-ID: <response-{part['Content-ID'][1:-1]}>\r\n\r\n"
+                f"HTTP/1.1 {status} {'OK' if status < 300 else 'Error'}\r\n"
+                f"Content-Type: application/json\r\n\r\n"
+                f"{payload_text}\r\n"
+            )
+        out.append(f"--{boundary}--\r\n")
+        self._send(200, ''.join(out).encode(), content_type=f"multipart/mixed; boundary={boundary}")
+
+
+class FakeCalendar:
+    """
+    In-memory event store shared by the Calendar stub's single and batch calls. Like
+    Google, a deleted event is kept with status 'cancelled': its id can't be inserted
+    again (409) but an update restores it. Listings are paged and return a syncToken
+    (a change counter): listing with it returns only the events changed since.
+    """
+
+    def __init__(self):
+        self.events = {}
+        self.lock = threading.Lock()
+        self.versions = {}  # event id -> value of `version` at its last change
+        self.version = 0
+        self.list_calls = 0
+
+    def _changed(self, event):
+        # caller holds self.lock
+        self.version += 1
+        self.versions[event['id']] = self.version
+        return event
+
+    def _list(self, query):
+        self.list_calls += 1
+        sync_token = query.get('syncToken', [None])[0]
+        if sync_token is not None and not (sync_token.isdigit() and int(sync_token) <= self.version):
+            return 410, {'error': {'code': 410, 'message': 'Sync token is no longer valid, a full sync is required.'}}
+        since = int(sync_token or 0)
+        show_deleted = sync_token is not None or query.get('showDeleted', ['false'])[0] == 'true'
+        events = sorted(
+            (event for event in self.events.values()
+             if self.versions[event['id']] > since and (show_deleted or event.get('status') != 'cancelled')),
+            key=lambda event: self.versions[event['id']],
+        )
+        start = int(query.get('pageToken', ['0'])[0])
+        size = int(query.get('maxResults', ['250'])[0])
+        page = {'items': events[start:start + size]}
+        if start + size < len(events):
+            page['nextPageToken'] = str(start + size)
+        else:
+            page['nextSyncToken'] = str(self.version)
+        return 200, page
+
+    @property
+    def live_events(self):
+        return [event for event in self.events.values() if event.get('status') != 'cancelled']
+
+    def handle(self, method, path, body):
+        path, _, query = path.partition('?')
+        parts = [p for p in path.split('/') if p]
+        # .../calendar/v3/calendars/{calendarId}/events[/{eventId}]
+        if 'events' not in parts:
+            return 404, {'error': {'code': 404, 'message': 'Not Found'}}
+        event_id = parts[parts.index('events') + 1] if parts[-1] != 'events' else None
+
+        with self.lock:
+            if method == 'POST' and event_id is None:
+                event = json.loads(body or b'{}')
+                event['id'] = event.get('id') or uuid.uuid4().hex
+                if event['id'] in self.events:
+                    return 409, {'error': {'code': 409, 'message': 'The requested identifier already exists.'}}
+                event['status'] = 'confirmed'
+                event['htmlLink'] = f"http://calendar.stub/event?eid={event['id']}"
+                self.events[event['id']] = self._changed(event)
+                return 200, event
+            if method == 'PUT' and event_id:
+                if event_id not in self.events:
+                    return 404, {'error': {'code': 404, 'message': 'Not Found'}}
+                event = json.loads(body or b'{}')
+                event.update(id=event_id, htmlLink=self.events[event_id]['htmlLink'])
+                event.setdefault('status', 'confirmed')
+                self.events[event_id] = self._changed(event)
+                return 200, event
+            if method == 'DELETE' and event_id:
+                event = self.events.get(event_id)
+                if event is None:
+                    return 404, {'error': {'code': 404, 'message': 'Not Found'}}
+                if event.get('status') == 'cancelled':
+                    return 410, {'error': {'code': 410, 'message': 'Resource has been deleted'}}
+                event['status'] = 'cancelled'
+                self._changed(event)
+                return 204, b''
+            if method == 'GET' and event_id is None:
+                return self._list(parse_qs(query))
+        return 404, {'error': {'code': 404, 'message': 'Not Found'}}
+
+
+class TelegramStubHandler(StubHandler):
+    """
+    Telegram Bot API stand-in: records sendMessage calls and serves getUpdates (long
+    polling) from updates queued with FakeTelegram.push_update(). When `retry_every`
+    is set, every Nth call is answered with a 429 + retry_after, like the real flood control.
+    """
+
+    def do_POST(self):
+        body = json.loads(self._read_body() or b'{}')
+        telegram = self.server.telegram
+        if self.path.endswith('/getUpdates'):
+            return self._send(200, {'ok': True, 'result': telegram.get_updates(
+                body.get('offset'), body.get('limit', 100), body.get('timeout', 0),
+            )})
+
+        self._delay()
+
+        with telegram.lock:
+            telegram.calls += 1
+            rate_limited = telegram.retry_every and telegram.calls % telegram.retry_every == 0
+            if not rate_limited and self.path.endswith('/sendMessage'):
+                telegram.messages.append(body)
+
+        if rate_limited:
+            return self._send(429, {'ok': False, 'error_code': 429, 'parameters': {'retry_after': 1}})
+        if self.path.endswith('/sendMessage'):
+            return self._send(200, {'ok': True, 'result': {'message_id': telegram.calls, 'chat': {'id': body.get('chat_id')}}})
+        self._send(200, {'ok': True, 'result': True})
+
+
+class FakeTelegram:
+    def __init__(self, retry_every=0):
+        self.messages = []
+        self.calls = 0
+        self.retry_every = retry_every
+        self.lock = threading.Lock()
+        self.updates = []  # pending getUpdates results, oldest first
+        self.updates_ready = threading.Condition(self.lock)
+
+    def push_update(self, update):
+        with self.updates_ready:
+            self.updates.append(update)
+            self.updates_ready.notify_all()
+
+    def get_updates(self, offset, limit, timeout):
+        deadline = time.monotonic() + (timeout or 0)
+        with self.updates_ready:
+            if offset is not None:
+                # Like Telegram: an offset confirms (forgets) every earlier update
+                self.updates = [u for u in self.updates if u['update_id'] >= offset]
+            while not self.updates and time.monotonic() < deadline:
+                self.updates_ready.wait(timeout=deadline - time.monotonic())
+            return self.updates[:limit]
+
+
+class DeepSeekStubHandler(StubHandler):
+    """
+    OpenAI-compatible /chat/completions stand-in for DeepSeek. It "understands" just
+    enough Indonesian to answer like the real model for the load-test messages
+    (see orders/load_testing.py); anything else is UNKNOWN. A user message that is
+    a JSON array of {"index", "text"} is answered in batch mode ({"results": [...]}),
+    and a system prompt asking for item arrays gets the compact schema. Like DeepSeek's
+    context cache, a system prompt seen before counts as prompt_cache_hit_tokens.
+    With "stream": true the answer is sent as server-sent events, ~one token (4 chars)
+    per chunk: `latency` is then the time to the first token.
+    """
+
+    def do_POST(self):
+        body = json.loads(self._read_body() or b'{}')
+        if not self.path.rstrip('/').endswith('/chat/completions'):
+            self._delay()
+            return self._send(404, {'error': {'message': 'Not Found'}})
+
+        messages = body.get('messages') or [{}]
+        text = messages[-1].get('content') or ''
+        deepseek = self.server.deepseek
+        prefix = (messages[0].get('content') or '') if len(messages) > 1 else ''
+        answer = deepseek.answer_content(text)
+        if 'Each item is an array' in prefix:
+            content = json.dumps(deepseek.compact(answer), separators=(',', ':'), ensure_ascii=False)
+        else:
+            content = json.dumps(answer)
+        prompt_tokens = sum(len(m.get('content') or '') for m in messages) // 4
+        with deepseek.lock:
+            cached_tokens = len(prefix) // 4 if prefix in deepseek.prefixes else 0
+            deepseek.prefixes.add(prefix)
+            deepseek.calls += 1
+            deepseek.prompt_tokens += prompt_tokens
+            deepseek.cached_tokens += cached_tokens
+            deepseek.completion_tokens += len(content) // 4
+
+        completion = {
+            'id': f"chatcmpl-{uuid.uuid4().hex}",
+            'created': int(time.time()),
+            'model': body.get('model', 'deepseek-chat'),
+        }
+        usage = {'prompt_tokens': prompt_tokens, 'completion_tokens': len(content) // 4,
+                 'total_tokens': prompt_tokens + len(content) // 4,
+                 'prompt_cache_hit_tokens': cached_tokens,
+                 'prompt_cache_miss_tokens': prompt_tokens - cached_tokens}
+        self._delay()
+        if body.get('stream'):
+            include_usage = (body.get('stream_options') or {}).get('include_usage')
+            return self._stream(completion, content, usage if include_usage else None)
+
+        # Fixed latency plus generation time: a batch answer takes longer than a single one
+        if self.server.token_latency:
+            time.sleep(self.server.token_latency * (len(content) // 4))
+        self._send(200, {
+            **completion,
+            'object': 'chat.completion',
+            'choices': [{'index': 0, 'finish_reason': 'stop',
+                         'message': {'role': 'assistant', 'content': content}}],
+            'usage': usage,
+        })
+
+    def _stream(self, completion, content, usage):
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+
+        def event(data):
+            payload = f"data: {data}\n\n".encode()
+            self.wfile.write(f"{len(payload):x}\r\n".encode() + payload + b"\r\n")
+            self.wfile.flush()
+
+        chunk = {**completion, 'object': 'chat.completion.chunk'}
+        try:
+            for start in range(0, len(content), 4):
+                if start and self.server.token_latency:
+                    time.sleep(self.server.token_latency)
+                delta = {'content': content[start:start + 4]}
+                event(json.dumps({**chunk, 'choices': [{'index': 0, 'delta': delta, 'finish_reason': None}]}))
+            event(json.dumps({**chunk, 'choices': [{'index': 0, 'delta': {}, 'finish_reason': 'stop'}]}))
+            if usage:
+                event(json.dumps({**chunk, 'choices': [], 'usage': usage}))
+            event('[DONE]')
+            self.wfile.write(b"0\r\n\r\n")
+        except (BrokenPipeError, ConnectionResetError):
+            self.close_connection = True  # the client stopped reading early
+
+
+class FakeDeepSeek:
+    ORDER_RE = re.compile(r"\b(?:pesan|order|beli)\b(.*)", re.IGNORECASE)
+    NAME_RE = re.compile(r"(?:buat|untuk|atas nama)\s+([A-Z]\w+)")
+    PRICE_RE = re.compile(r"@?(\d+)\s*(?:k|rb|ribu)\b", re.IGNORECASE)
+    ITEM_RE = re.compile(r"\s*(\d+)?\s*(?:box|pcs|buah|loyang)?\s*(.+)", re.IGNORECASE)
+    SKIP_WORDS = {'kak', 'mau', 'pesan', 'order', 'beli', 'bu', 'pak', 'mbak', 'mas'}
+
+    def __init__(self):
+        self.calls = 0
+        self.prompt_tokens = 0
+        self.cached_tokens = 0
+        self.completion_tokens = 0
+        self.prefixes = set()
+        self.lock = threading.Lock()
+
+    def compact(self, answer):
+        if 'results' in answer:
+            return {'results': [self.compact(result) for result in answer['results']]}
+        compact = {key: answer[key] for key in ('index', 'intent', 'order_id') if answer.get(key) is not None}
+        if answer.get('due_date'):
+            compact['due_date'] = answer['due_date'][:16]
+        if answer.get('items'):
+            compact['items'] = [[item['description'], item['quantity'], item['price'], item['client_name']]
+                                for item in answer['items']]
+        return compact
+
+    def answer_content(self, text):
+        try:
+            batch = json.loads(text)
+        except ValueError:
+            return self.answer(text)
+        if not isinstance(batch, list):
+            return self.answer(text)
+        return {'results': [{'index': entry.get('index'), **self.answer(entry.get('text') or '')}
+                            for entry in batch if isinstance(entry, dict)]}
+
+    def answer(self, text):
+        lowered = text.lower().strip()
+        ids = [int(i) for i in re.findall(r"\d+", lowered)]
+        if re.match(r"(?:batal|cancel|gak jadi|ga jadi)", lowered):
+            return {'intent': 'CANCEL', 'items': [], 'order_id': ids[0] if ids else None, 'order_ids': ids}
+        if re.match(r"(?:ok|oke|ya|iya|siap|sip)\b", lowered):
+            return {'intent': 'CONFIRM', 'items': [], 'order_id': ids[0] if ids else None, 'order_ids': ids}
+        if re.search(r"\b(?:cek|list|jadwal)\b|apa aja", lowered):
+            return {'intent': 'LIST_ORDERS', 'items': []}
+
+        match = self.ORDER_RE.search(text)
+        if not match:
+            return {'intent': 'UNKNOWN', 'items': []}
+        body = match.group(1)
+
+        name = self.NAME_RE.search(body)
+        # "Budi pesan ..." / "Kak, Ani mau pesan ...": last capitalized word before the verb
+        before = [w for w in re.findall(r"[A-Z]\w+", text[:match.start()]) if w.lower() not in self.SKIP_WORDS]
+        if name:
+            client_name = name.group(1)
+        elif before:
+            client_name = before[-1]
+        else:
+            client_name = 'Owner'
+
+        price = self.PRICE_RE.search(body)
+        # Items are everything before "buat <name>" / the first comma, split on "dan"
+        segment = re.split(r"\s+(?:buat|untuk|atas nama)\s+|,", body)[0]
+        items = []
+        for part in re.split(r"\s+dan\s+", segment):
+            part = re.sub(r"\s+ya\b.*", '', self.PRICE_RE.sub('', part))
+            quantity, description = self.ITEM_RE.match(part).groups()
+            if description.strip():
+                items.append({
+                    'description': description.strip(),
+                    'quantity': int(quantity or 1),
+                    'price': int(price.group(1)) * 1000 if price else 0,
+                    'client_name': client_name,
+                })
+
+        due = (datetime.now() + timedelta(days=1)).replace(hour=9, minute=0, second=0, microsecond=0)
+        return {
+            'intent': 'NEW_ORDER',
+            'items': items,
+            'due_date': due.strftime('%Y-%m-%d %H:%M:%S'),
+            'order_id': None,
+        }
+
+
+def start_stub_server(handler_class, port=0, latency=0.0, **state):
+    """
+    Starts a threaded stub server in the background and returns it.
+    `server.server_port` holds the bound port (pass port=0 for a free one).
+    """
+    server = ThreadingHTTPServer(('127.0.0.1', port), handler_class)
+    server.daemon_threads = True
+    server.latency = latency
+    for name, value in state.items():
+        setattr(server, name, value)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def start_calendar_stub(port=0, latency=0.0):
+    return start_stub_server(CalendarStubHandler, port=port, latency=latency, calendar=FakeCalendar())
+
+
+def start_telegram_stub(port=0, latency=0.0, retry_every=0):
+    return start_stub_server(TelegramStubHandler, port=port, latency=latency, telegram=FakeTelegram(retry_every))
+
+
+def start_deepseek_stub(port=0, latency=0.0, token_latency=0.0):
+    """`token_latency`: extra seconds per completion token, on top of `latency`."""
+    return start_stub_server(DeepSeekStubHandler, port=port, latency=latency,
+                             token_latency=token_latency, deepseek=FakeDeepSeek())
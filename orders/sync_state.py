@@ -0,0 +1,12 @@
+from .models import SyncState
+
+# Durable key -> value cursors for the sync commands (poll_updates, ...).
+
+
+def get_sync_state(key, default=None):
+    value = SyncState.objects.filter(key=key).values_list('value', flat=True).first()
+    return default if value is None else value
+
+
+def set_sync_state(key, value):
+    SyncState.objects.update_or_create(key=key, defaults={'value': str(value)})
@@ -1,25 +1,472 @@
-import requests
+import asyncio
 import os
+import threading
+import time
+from collections import Counter, OrderedDict, namedtuple
+import httpx
+from django.conf import settings
+from .http_clients import get_http_client, get_async_http_client
+from .metrics import current_intent, stage
 
-def send_telegram_reply(chat_id, text):
-    """
-    Sends a message back to the user via Telegram API.
-    """
+# Telegram rejects messages longer than this
+MAX_MESSAGE_LENGTH = 4096
+
+# Backoff for a 429 that doesn't say how long to wait
+DEFAULT_RETRY_AFTER = 5
+
+# A reply still rate-limited after this many tries is dropped
+MAX_SEND_ATTEMPTS = 5
+
+# How often (seconds) the per-chat rate buckets of idle chats are dropped
+BUCKET_EVICT_SECONDS = 60
+
+# _post_message() result when Telegram can't parse the Markdown (e.g. a lone '*' or '_'
+# in a customer's item name): the text must be resent without parse_mode
+MARKDOWN_ERROR = object()
+
+
+def _api_url(method):
+    """Bot API URL for `method`, or None without a bot token."""
     token = os.environ.get("TELEGRAM_BOT_TOKEN")
     if not token:
         print("Error: No TELEGRAM_BOT_TOKEN found in .env")
-        return
+        return None
+
+    # TELEGRAM_API_BASE lets load tests point at a local stub (see orders/stub_servers.py)
+    api_base = os.environ.get("TELEGRAM_API_BASE", "https://api.telegram.org")
+    return f"{api_base}/bot{token}/{method}"
+
+
+def _send_message_request(chat_id, text, markdown=True):
+    """(url, payload) for a sendMessage call, or None without a bot token."""
+    url = _api_url('sendMessage')
+    if url is None:
+        return None
 
-    url = f"https://api.telegram.org/bot{token}/sendMessage"
     payload = {
         "chat_id": chat_id,
         "text": text,
-        "parse_mode": "Markdown"  # Allows bolding text with *stars*
     }
+    if markdown:
+        payload["parse_mode"] = "Markdown"  # Allows bolding text with *stars*
+    return url, payload
 
+
+def _send_outcome(response):
+    """Outcome label for the telegram_send stage metric."""
+    if response.status_code == 200:
+        return 'ok'
+    return 'rate_limited' if response.status_code == 429 else f"http_{response.status_code}"
+
+
+def _retry_after(response):
+    """Seconds to wait after a 429: Telegram's JSON body, else a Retry-After header (proxies), else a default."""
     try:
-        response = requests.post(url, json=payload)
-        if response.status_code != 200:
-            print(f"Telegram Send Error: {response.text}")
-    except Exception as e:
-        print(f"Connection Error: {e}")
\ No newline at end of file
+        retry_after = response.json().get('parameters', {}).get('retry_after')
+    except (ValueError, AttributeError):
+        retry_after = None  # not JSON (or not an object): not Telegram's own answer
+    if retry_after is None:
+        retry_after = response.headers.get('Retry-After')
+    try:
+        return max(float(retry_after), 1) if retry_after is not None else DEFAULT_RETRY_AFTER
+    except ValueError:
+        return DEFAULT_RETRY_AFTER  # e.g. an HTTP date
+
+
+def _check_response(chat_id, response):
+    """
+    Returns retry_after seconds for a 429, MARKDOWN_ERROR when Telegram can't parse the
+    text's Markdown, else None (other errors are only logged).
+    """
+    if response.status_code == 429:
+        retry_after = _retry_after(response)
+        print(f"Telegram Rate Limit: chat {chat_id}, retry after {retry_after:g}s")
+        return retry_after
+    if response.status_code == 400 and "can't parse entities" in response.text:
+        print(f"Telegram Markdown Error: chat {chat_id}, {response.text}")
+        return MARKDOWN_ERROR
+    if response.status_code != 200:
+        print(f"Telegram Send Error: {response.text}")
+    return None
+
+
+def _post_message(chat_id, text, intent=None, markdown=True):
+    """
+    Does the actual sendMessage call (`intent` labels the metric when sent from another thread).
+    Returns the retry_after seconds if Telegram rate-limited us (HTTP 429), MARKDOWN_ERROR
+    if it rejected the Markdown, else None.
+    """
+    request = _send_message_request(chat_id, text, markdown)
+    if request is None:
+        return None
+    url, payload = request
+
+    with stage('telegram_send', intent=intent) as span:
+        try:
+            # Pooled keep-alive client: consecutive replies reuse one warm connection
+            response = get_http_client('telegram').post(url, json=payload)
+            span.outcome = _send_outcome(response)
+            return _check_response(chat_id, response)
+        except Exception as e:
+            print(f"Connection Error: {e}")
+            span.outcome = 'error'
+    return None
+
+
+async def _apost_message(chat_id, text, markdown=True):
+    """asyncio version of _post_message(), on the per-loop async client."""
+    request = _send_message_request(chat_id, text, markdown)
+    if request is None:
+        return None
+    url, payload = request
+
+    with stage('telegram_send') as span:
+        try:
+            response = await get_async_http_client('telegram').post(url, json=payload)
+            span.outcome = _send_outcome(response)
+            return _check_response(chat_id, response)
+        except Exception as e:
+            print(f"Connection Error: {e}")
+            span.outcome = 'error'
+    return None
+
+
+def send_telegram_reply(chat_id, text):
+    """
+    Sends a message back to the user via Telegram API (blocking, one HTTP call).
+    Prefer enqueue_telegram_reply() inside the pipeline.
+    """
+    if _post_message(chat_id, text) is MARKDOWN_ERROR:
+        _post_message(chat_id, text, markdown=False)
+
+
+class TelegramAPIError(Exception):
+    def __init__(self, description, status_code=None):
+        super().__init__(description)
+        self.status_code = status_code
+
+
+def _call_api(method, http_timeout=None, **params):
+    """Calls a Bot API method and returns its `result`; raises TelegramAPIError on failure."""
+    url = _api_url(method)
+    if url is None:
+        raise TelegramAPIError("No TELEGRAM_BOT_TOKEN configured")
+    response = get_http_client('telegram').post(url, json=params, timeout=http_timeout or httpx.USE_CLIENT_DEFAULT)
+    try:
+        data = response.json()
+    except ValueError:
+        data = {}
+    if response.status_code != 200 or not data.get('ok'):
+        raise TelegramAPIError(data.get('description') or response.text, response.status_code)
+    return data['result']
+
+
+def get_updates(offset=None, limit=100, timeout=30):
+    """
+    One getUpdates long-poll call: waits up to `timeout` seconds for new updates.
+    Passing offset = last update_id + 1 confirms everything before it to Telegram.
+    Only works while no webhook is set (Telegram answers 409 otherwise).
+    """
+    params = {'limit': limit, 'timeout': timeout, 'allowed_updates': ['message']}
+    if offset is not None:
+        params['offset'] = offset
+    # The HTTP timeout must outlast the long poll
+    return _call_api('getUpdates', http_timeout=timeout + 10, **params)
+
+
+def delete_webhook():
+    """Removes the webhook, so getUpdates can be used. Pending updates are kept."""
+    return _call_api('deleteWebhook', drop_pending_updates=False)
+
+
+def split_message(text, limit=MAX_MESSAGE_LENGTH):
+    """Splits text into <= limit chunks, preferring line breaks."""
+    chunks = []
+    while len(text) > limit:
+        cut = text.rfind("\n", 0, limit)
+        if cut <= 0:
+            cut = limit
+        chunks.append(text[:cut])
+        text = text[cut:].lstrip("\n")
+    if text:
+        chunks.append(text)
+    return chunks
+
+
+class TokenBucket:
+    """Classic token bucket: `rate` tokens per second, holding at most `capacity`."""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def wait_time(self, now):
+        """Seconds until one token is available (0 if available now)."""
+        self._refill(now)
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self, now):
+        self._refill(now)
+        self.tokens -= 1
+
+    def is_full(self, now):
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+
+def _evict_full_buckets(buckets, now, keep):
+    """Drops the buckets of chats not in `keep` that refilled completely: a new one starts full anyway."""
+    for chat_id in [chat_id for chat_id, bucket in buckets.items() if chat_id not in keep and bucket.is_full(now)]:
+        del buckets[chat_id]
+
+
+# A queued reply. `alone`: never merged with others (resent after a Markdown error);
+# `attempts`: 429s so far
+_Reply = namedtuple('_Reply', ['text', 'intent', 'markdown', 'alone', 'attempts'], defaults=(True, False, 0))
+
+
+class TelegramSender:
+    """
+    Non-blocking outbound queue for Telegram replies.
+
+    - Messages to the same chat that arrive within the coalescing window are merged
+      into one sendMessage (up to 4096 chars), so a 10-item confirm is one API call.
+    - A global token bucket (~30 msg/s per bot) and per-chat buckets (~1 msg/s)
+      keep us under Telegram's limits; a 429 pauses that chat for `retry_after`, and a
+      reply rate-limited MAX_SEND_ATTEMPTS times is dropped.
+    - If Telegram can't parse a merged message's Markdown, its replies are resent one by
+      one, and the one that fails alone is resent as plain text.
+    - Messages to one chat are always delivered in order.
+    """
+
+    def __init__(self, threads, coalesce_seconds, global_rate, chat_rate, chat_burst):
+        self.coalesce_seconds = coalesce_seconds
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self._global_bucket = TokenBucket(global_rate, global_rate)
+        self._chat_buckets = {}
+        self._evicted_at = time.monotonic()
+        self._pending = OrderedDict()  # chat_id -> {'texts': [_Reply, ...], 'ready_at': monotonic}
+        self._busy = set()             # chats with a send in flight
+        self._cond = threading.Condition()
+        self._threads = threads
+        self._started = False
+        self.stats = {'enqueued': 0, 'sent': 0, 'coalesced': 0, 'rate_limited': 0, 'markdown_errors': 0, 'dropped': 0}
+
+    def enqueue(self, chat_id, text):
+        with self._cond:
+            self._start()
+            self.stats['enqueued'] += 1
+            entry = self._pending.get(chat_id)
+            if entry is None:
+                entry = {'texts': [], 'ready_at': time.monotonic() + self.coalesce_seconds}
+                self._pending[chat_id] = entry
+            # The sender threads don't know the message's intent: keep it for the metric
+            entry['texts'].append(_Reply(text, current_intent()))
+            self._cond.notify()
+
+    def flush(self, timeout=30):
+        """Blocks until everything queued so far has been sent (or timeout). Returns True if drained."""
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            # Stop waiting for the coalescing window: send what we have now
+            for entry in self._pending.values():
+                entry['ready_at'] = min(entry['ready_at'], time.monotonic())
+            self._cond.notify_all()
+            while self._pending or self._busy:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self._cond.wait(timeout=remaining)
+        return True
+
+    def _start(self):
+        # caller holds self._cond
+        if self._started:
+            return
+        self._started = True
+        for i in range(self._threads):
+            threading.Thread(target=self._run, name=f'telegram-sender-{i}', daemon=True).start()
+
+    def _next_message(self, now):
+        """
+        Picks the next (chat_id, text, replies) that may be sent right now, merging queued
+        replies. Returns (None, seconds_to_wait) when nothing is ready. Caller holds self._cond.
+        """
+        if now - self._evicted_at >= BUCKET_EVICT_SECONDS:
+            self._evicted_at = now
+            _evict_full_buckets(self._chat_buckets, now, keep=self._pending.keys() | self._busy)
+        wait = None
+        for chat_id, entry in self._pending.items():
+            if chat_id in self._busy:
+                continue
+            chat_bucket = self._chat_buckets.setdefault(chat_id, TokenBucket(self.chat_rate, self.chat_burst))
+            chat_wait = max(entry['ready_at'] - now, chat_bucket.wait_time(now))
+            if chat_wait > 0:
+                wait = chat_wait if wait is None else min(wait, chat_wait)
+                continue
+
+            global_wait = self._global_bucket.wait_time(now)
+            if global_wait > 0:
+                return None, global_wait
+
+            text, replies = self._take_text(entry['texts'])
+            if not entry['texts']:
+                del self._pending[chat_id]
+            chat_bucket.take(now)
+            self._global_bucket.take(now)
+            self._busy.add(chat_id)
+            return (chat_id, text, replies), 0
+
+        return None, wait
+
+    def _take_text(self, texts):
+        """
+        Pops as many queued replies as fit in one Telegram message.
+        Returns (text, replies): the merged text and the replies in it.
+        """
+        first = texts.pop(0)
+        if len(first.text) > MAX_MESSAGE_LENGTH:
+            chunks = split_message(first.text)
+            texts[0:0] = [first._replace(text=chunk) for chunk in chunks[1:]]
+            first = first._replace(text=chunks[0])
+            return first.text, [first]
+
+        merged = [first]
+        length = len(first.text)
+        while (texts and not first.alone and not texts[0].alone and texts[0].markdown == first.markdown
+               and length + 2 + len(texts[0].text) <= MAX_MESSAGE_LENGTH):
+            length += 2 + len(texts[0].text)
+            merged.append(texts.pop(0))
+        self.stats['coalesced'] += len(merged) - 1
+        return "\n\n".join(reply.text for reply in merged), merged
+
+    def _requeue(self, chat_id, replies, delay):
+        """Puts replies back at the front of that chat's queue, ready in `delay` seconds. Caller holds self._cond."""
+        if not replies:
+            return
+        entry = self._pending.setdefault(chat_id, {'texts': [], 'ready_at': 0})
+        entry['texts'][0:0] = replies
+        entry['ready_at'] = time.monotonic() + delay
+        self._pending.move_to_end(chat_id, last=False)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                message, wait = self._next_message(time.monotonic())
+                while message is None:
+                    self._cond.wait(timeout=wait)
+                    message, wait = self._next_message(time.monotonic())
+
+            chat_id, text, replies = message
+            first = replies[0]
+            result = _post_message(chat_id, text, first.intent, first.markdown)
+
+            with self._cond:
+                self._busy.discard(chat_id)
+                if result is MARKDOWN_ERROR:
+                    # One broken reply must not sink the ones merged with it
+                    self.stats['markdown_errors'] += 1
+                    if len(replies) > 1:
+                        retry = [reply._replace(alone=True) for reply in replies]
+                    else:
+                        retry = [first._replace(markdown=False, alone=True)] if first.markdown else []
+                    self._requeue(chat_id, retry, 0)
+                elif result:
+                    # Back at the front of that chat's queue, and pause the chat
+                    self.stats['rate_limited'] += 1
+                    retry = [reply._replace(attempts=reply.attempts + 1) for reply in replies
+                             if reply.attempts + 1 < MAX_SEND_ATTEMPTS]
+                    if len(retry) < len(replies):
+                        self.stats['dropped'] += len(replies) - len(retry)
+                        print(f"Telegram: dropped a reply to chat {chat_id} after {MAX_SEND_ATTEMPTS} rate-limited tries")
+                    self._requeue(chat_id, retry, result)
+                else:
+                    self.stats['sent'] += 1
+                self._cond.notify_all()
+
+
+telegram_sender = TelegramSender(
+    threads=settings.TELEGRAM_SENDER_THREADS,
+    coalesce_seconds=settings.TELEGRAM_COALESCE_SECONDS,
+    global_rate=settings.TELEGRAM_GLOBAL_RATE,
+    chat_rate=settings.TELEGRAM_CHAT_RATE,
+    chat_burst=settings.TELEGRAM_CHAT_BURST,
+)
+
+
+def enqueue_telegram_reply(chat_id, text):
+    """Queues a reply without waiting for the network (see TelegramSender)."""
+    telegram_sender.enqueue(chat_id, text)
+
+
+def flush_telegram_replies(timeout=30):
+    return telegram_sender.flush(timeout=timeout)
+
+
+class AsyncRateLimiter:
+    """
+    The TelegramSender limits for the async pipeline: one global and one per-chat
+    token bucket. Only used from the event loop thread, so no locking is needed.
+    """
+
+    def __init__(self, global_rate, chat_rate, chat_burst):
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self._global_bucket = TokenBucket(global_rate, global_rate)
+        self._chat_buckets = {}
+        self._waiting = Counter()  # chat_id -> acquire() calls in progress
+        self._evicted_at = time.monotonic()
+
+    async def acquire(self, chat_id):
+        now = time.monotonic()
+        if now - self._evicted_at >= BUCKET_EVICT_SECONDS:
+            self._evicted_at = now
+            _evict_full_buckets(self._chat_buckets, now, keep=self._waiting)
+        chat_bucket = self._chat_buckets.setdefault(chat_id, TokenBucket(self.chat_rate, self.chat_burst))
+        self._waiting[chat_id] += 1
+        try:
+            while True:
+                now = time.monotonic()
+                wait = max(self._global_bucket.wait_time(now), chat_bucket.wait_time(now))
+                if wait <= 0:
+                    self._global_bucket.take(now)
+                    chat_bucket.take(now)
+                    return
+                await asyncio.sleep(wait)
+        finally:
+            self._waiting[chat_id] -= 1
+            if not self._waiting[chat_id]:
+                del self._waiting[chat_id]
+
+
+_async_limiter = AsyncRateLimiter(
+    global_rate=settings.TELEGRAM_GLOBAL_RATE,
+    chat_rate=settings.TELEGRAM_CHAT_RATE,
+    chat_burst=settings.TELEGRAM_CHAT_BURST,
+)
+
+
+async def asend_telegram_reply(chat_id, text, max_attempts=3):
+    """
+    Awaitable reply for the async pipeline: same 4096-char split, rate limits and
+    retry_after handling as TelegramSender, without a thread per send. A chunk whose
+    Markdown Telegram can't parse is resent as plain text.
+    """
+    for chunk in split_message(text):
+        markdown = True
+        for _ in range(max_attempts):
+            await _async_limiter.acquire(chat_id)
+            result = await _apost_message(chat_id, chunk, markdown)
+            if result is MARKDOWN_ERROR and markdown:
+                markdown = False
+                continue
+            if not result or result is MARKDOWN_ERROR:
+                break
+            await asyncio.sleep(result)
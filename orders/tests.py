@@ -1,3 +1,534 @@
-from django.test import TestCase
+import asyncio
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+from unittest import mock
+import httpx
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.utils import timezone
+from . import ai_service, calendar_service, customer_cache
+from .agenda import _current_generation, get_agenda_page
+from .async_pipeline import schedule_message, shutdown_pending_messages
+from .models import CalendarSyncTask, Customer, Order, RawMessage
+from .intent_rules import classify_intent, get_rule_stats, reset_rule_stats
+from .message_queue import claim_messages, mark_failed, release_messages, renew_leases
+from .order_grammar import parse_order_grammar, parse_order_text
+from .calendar_outbox import drain_calendar_outbox
+from .calendar_reconcile import SYNC_TOKEN_KEY, reconcile_calendar
+from .calendar_service import apply_calendar_changes, calendar_event_id_for
+from .stream_json import JSONStreamParser
+from .sync_state import get_sync_state, set_sync_state
+from .stub_servers import FakeCalendar, start_calendar_stub
+from .telegram_utils import DEFAULT_RETRY_AFTER, MARKDOWN_ERROR, MAX_SEND_ATTEMPTS, TelegramSender, _check_response
 
-# Create your tests here.
+# Monday 19 October 2026, 08:00 local time
+NOW = timezone.make_aware(datetime(2026, 10, 19, 8, 0))
+
+
+class OrderGrammarTests(SimpleTestCase):
+    # (message, [(description, quantity, price)], client_name, due_date)
+    PARSED = [
+        ("Bella pesan 2 brownies 150rb besok jam 5",
+         [('brownies', 2, 150000)], 'Bella', '2026-10-20 17:00:00'),
+        ("Pesan 1 kue buat Budi 100k lusa", [('kue', 1, 100000)], 'Budi', '2026-10-21 09:00:00'),
+        ("Order 2 nastar dan 3 risoles buat Ani, ambil sabtu sore",
+         [('nastar', 2, 0), ('risoles', 3, 0)], 'Ani', '2026-10-24 16:00:00'),
+        ("pesan 2 box brownies besok", [('brownies', 2, 0)], 'Owner', '2026-10-20 09:00:00'),
+        ("pesan 2 loyang brownies besok", [('brownies', 2, 0)], 'Owner', '2026-10-20 09:00:00'),
+        ("Pesan 2 brownies 3 hari lagi", [('brownies', 2, 0)], 'Owner', '2026-10-22 09:00:00'),
+        ("pesan 2 brownies 2 minggu lagi jam 4 sore", [('brownies', 2, 0)], 'Owner', '2026-11-02 16:00:00'),
+        ("Pesan 1 kue lapis legit 2 kg besok",
+         [('kue lapis legit 2 kg', 1, 0)], 'Owner', '2026-10-20 09:00:00'),
+        ("pesan 1 kue diameter 20 cm", [('kue diameter 20 cm', 1, 0)], 'Owner', None),
+        ("Pesan 1 kue 2 tingkat buat Budi besok", [('kue 2 tingkat', 1, 0)], 'Budi', '2026-10-20 09:00:00'),
+        ("Pesan 1 kue @85k tanggal 25", [('kue', 1, 85000)], 'Owner', '2026-10-25 09:00:00'),
+    ]
+    # Messages the grammar must leave to the LLM
+    UNSURE = [
+        "Pesan brownies 2 loyang besok",
+        "pesan nastar 2 risoles 3",
+        "pesan kue tahan 3 hari",
+        "pesan 2 kg kue lapis",
+        "pesan kue 1 bulan lagi",
+        "pesan 2 brownies minggu depan",
+        "bisa pesan 2 brownies besok?",
+        "Bella pesan 2 brownies buat Budi",
+        "pesan 2 brownies tapi jangan terlalu manis",
+    ]
+
+    def test_parses_plain_orders(self):
+        for text, items, client_name, due_date in self.PARSED:
+            with self.subTest(text=text):
+                result = parse_order_text(text, now=NOW)
+                self.assertGreaterEqual(result['confidence'], 0.8)
+                self.assertEqual(
+                    [(item['description'], item['quantity'], item['price']) for item in result['items']], items,
+                )
+                self.assertEqual({item['client_name'] for item in result['items']}, {client_name})
+                self.assertEqual(result['due_date'], due_date)
+
+    def test_unsure_messages_score_below_the_threshold(self):
+        for text in self.UNSURE:
+            with self.subTest(text=text):
+                self.assertLess(parse_order_text(text, now=NOW)['confidence'], 0.8)
+
+    def test_no_ordering_verb(self):
+        for text in ("Ok 15", "berapa harga brownies?", ""):
+            with self.subTest(text=text):
+                self.assertIsNone(parse_order_text(text, now=NOW))
+
+    @override_settings(ORDER_GRAMMAR_ENABLED=True, ORDER_GRAMMAR_MIN_CONFIDENCE=0.8)
+    def test_parse_order_grammar_leaves_unsure_messages_to_the_llm(self):
+        self.assertEqual(parse_order_grammar("Pesan 1 kue 2 tingkat besok")['source'], 'grammar')
+        for text in self.UNSURE:
+            with self.subTest(text=text):
+                self.assertIsNone(parse_order_grammar(text))
+
+
+class JSONStreamParserTests(SimpleTestCase):
+    # (streamed text, events, fields once it ends)
+    CASES = [
+        ('```json\n{"intent": "NEW_ORDER", "items": [{"description": "kue", "quantity": 2}]}\n```',
+         [('field', 'intent', 'NEW_ORDER'), ('item', {'description': 'kue', 'quantity': 2}),
+          ('field', 'items', [{'description': 'kue', 'quantity': 2}])],
+         {'intent': 'NEW_ORDER', 'items': [{'description': 'kue', 'quantity': 2}]}),
+        ('{"intent": "UNKNOWN", "note": "kata \\"ok, 2}\\" [x]", "order_id": null}',
+         [('field', 'intent', 'UNKNOWN'), ('field', 'note', 'kata "ok, 2}" [x]'), ('field', 'order_id', None)],
+         {'intent': 'UNKNOWN', 'note': 'kata "ok, 2}" [x]', 'order_id': None}),
+        # Cut off mid-array: only the closed elements and fields come out
+        ('{"intent": "NEW_ORDER", "items": [["kue", 2, 0, null], ["nastar", 1',
+         [('field', 'intent', 'NEW_ORDER'), ('item', ['kue', 2, 0, None])],
+         {'intent': 'NEW_ORDER'}),
+        ('{"items": [{"description": "a, b]"}], "due_date": "2026-10-20 09:00:00"} {"intent": "CANCEL"}',
+         [('item', {'description': 'a, b]'}), ('field', 'items', [{'description': 'a, b]'}]),
+          ('field', 'due_date', '2026-10-20 09:00:00')],
+         {'items': [{'description': 'a, b]'}], 'due_date': '2026-10-20 09:00:00'}),
+    ]
+
+    def test_events_do_not_depend_on_chunking(self):
+        for text, events, fields in self.CASES:
+            for size in (1, 3, len(text)):
+                with self.subTest(text=text, chunk_size=size):
+                    parser = JSONStreamParser()
+                    fed = []
+                    for start in range(0, len(text), size):
+                        fed.extend(parser.feed(text[start:start + size]))
+                    self.assertEqual(fed, events)
+                    self.assertEqual(parser.fields, fields)
+
+
+def _stream_chunks(*contents):
+    return [SimpleNamespace(usage=None, choices=[SimpleNamespace(delta=SimpleNamespace(content=c))]) for c in contents]
+
+
+class _FakeStream(list):
+    def close(self):
+        pass
+
+
+class StreamFallbackTests(SimpleTestCase):
+    ROUTED = {'intent': 'NEW_ORDER', 'items': [{'description': 'kue', 'quantity': 1}]}
+
+    def setUp(self):
+        patcher = mock.patch.object(ai_service, 'record_llm_call')  # no usage rows
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _stream(self, chunks=None, error=None):
+        create = mock.Mock(return_value=_FakeStream(chunks or []), side_effect=error)
+        client = SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(create=create)))
+        return mock.patch.object(ai_service, '_streaming_client', return_value=client)
+
+    def test_broken_stream_falls_back_to_the_router(self):
+        events = []
+        with self._stream(_stream_chunks('{"intent": "NEW_ORDER", "items": [{"description": "ku')), \
+                mock.patch.object(ai_service, 'parse_order_with_ai', return_value=self.ROUTED) as routed:
+            result = ai_service.stream_order_with_ai("pesan kue", events.append)
+        self.assertEqual(result, self.ROUTED)
+        routed.assert_called_once_with("pesan kue")
+        self.assertEqual(events, [('field', 'intent', 'NEW_ORDER'), ai_service.STREAM_RESTART])
+
+    def test_failed_request_falls_back_to_the_router(self):
+        with self._stream(error=TimeoutError("read timeout")), \
+                mock.patch.object(ai_service, 'parse_order_with_ai', return_value=self.ROUTED):
+            self.assertEqual(ai_service.stream_order_with_ai("pesan kue", lambda event: None), self.ROUTED)
+
+    def test_complete_stream_is_used(self):
+        with self._stream(_stream_chunks('{"intent": "LIST_ORDERS"', ', "items": []}')), \
+                mock.patch.object(ai_service, 'parse_order_with_ai') as routed:
+            result = ai_service.stream_order_with_ai("cek", lambda event: None)
+        self.assertEqual(result['intent'], 'LIST_ORDERS')
+        routed.assert_not_called()
+
+
+class TelegramRateLimitTests(SimpleTestCase):
+    def test_retry_after(self):
+        cases = [
+            (httpx.Response(429, json={'ok': False, 'parameters': {'retry_after': 7}}), 7),
+            (httpx.Response(429, json={'ok': False}), DEFAULT_RETRY_AFTER),
+            # A proxy's 429: not JSON
+            (httpx.Response(429, text="<html>Too Many Requests</html>", headers={'Retry-After': '3'}), 3),
+            (httpx.Response(429, text="<html>Too Many Requests</html>"), DEFAULT_RETRY_AFTER),
+            (httpx.Response(429, text="[]", headers={'Retry-After': 'Wed, 21 Oct 2026 07:28:00 GMT'}), DEFAULT_RETRY_AFTER),
+            (httpx.Response(200, json={'ok': True}), None),
+            (httpx.Response(400, text="Bad Request"), None),
+        ]
+        for response, retry_after in cases:
+            with self.subTest(status=response.status_code, body=response.text):
+                self.assertEqual(_check_response(1, response), retry_after)
+
+    def test_rate_limited_message_is_requeued(self):
+        sender = TelegramSender(threads=1, coalesce_seconds=0, global_rate=100, chat_rate=100, chat_burst=100)
+        responses = [1, None]  # 429 (retry after 1 s), then sent
+        with mock.patch('orders.telegram_utils._post_message', side_effect=lambda *args: responses.pop(0)) as post:
+            sender.enqueue(42, "Order received")
+            self.assertTrue(sender.flush(timeout=5))
+        self.assertEqual([call.args[:2] for call in post.call_args_list], [(42, "Order received")] * 2)
+        self.assertEqual((sender.stats['rate_limited'], sender.stats['sent']), (1, 1))
+
+    def test_rate_limited_reply_is_dropped_after_max_attempts(self):
+        sender = TelegramSender(threads=1, coalesce_seconds=0, global_rate=100, chat_rate=100, chat_burst=100)
+        with mock.patch('orders.telegram_utils._post_message', return_value=0.01) as post:
+            sender.enqueue(42, "Order received")
+            self.assertTrue(sender.flush(timeout=5))
+        self.assertEqual(post.call_count, MAX_SEND_ATTEMPTS)
+        self.assertEqual(sender.stats['dropped'], 1)
+
+    def test_broken_markdown_does_not_sink_merged_replies(self):
+        sent = []
+
+        def post(chat_id, text, intent=None, markdown=True):
+            if markdown and text.count('*') % 2:
+                return MARKDOWN_ERROR
+            sent.append((text, markdown))
+            return None
+
+        sender = TelegramSender(threads=1, coalesce_seconds=5, global_rate=100, chat_rate=100, chat_burst=100)
+        with mock.patch('orders.telegram_utils._post_message', side_effect=post):
+            for text in ("*Review Order*", "- 2x kue_*lapis", "Reply Ok 1"):
+                sender.enqueue(42, text)
+            self.assertTrue(sender.flush(timeout=5))
+        self.assertEqual(sent, [("*Review Order*", True), ("- 2x kue_*lapis", False), ("Reply Ok 1", True)])
+
+    @mock.patch('orders.telegram_utils.BUCKET_EVICT_SECONDS', 0)
+    def test_idle_chat_buckets_are_evicted(self):
+        sender = TelegramSender(threads=1, coalesce_seconds=0, global_rate=100, chat_rate=100, chat_burst=100)
+        with mock.patch('orders.telegram_utils._post_message', return_value=None):
+            for chat_id in (1, 2, 3):
+                sender.enqueue(chat_id, "hi")
+            self.assertTrue(sender.flush(timeout=5))
+            time.sleep(0.05)  # the buckets refill (100 tokens/s)
+            sender.enqueue(4, "hi")
+            self.assertTrue(sender.flush(timeout=5))
+        self.assertFalse({1, 2, 3} & set(sender._chat_buckets))
+
+
+class IntentRulesTests(SimpleTestCase):
+    # (message, intent, order_ids, page)
+    MATCHED = [
+        ("Ok 15", 'CONFIRM', [15], None),
+        ("oke, 15 dan 16", 'CONFIRM', [15, 16], None),
+        ("Ya #12 & #13", 'CONFIRM', [12, 13], None),
+        ("confirm order 7", 'CONFIRM', [7], None),
+        ("ok", 'CONFIRM', [], None),
+        ("Batal 12", 'CANCEL', [12], None),
+        ("gak jadi 3", 'CANCEL', [3], None),
+        ("cancel pesanan 4, 5", 'CANCEL', [4, 5], None),
+        ("Cek Order!", 'LIST_ORDERS', [], None),
+        ("Lihat jadwal besok", 'LIST_ORDERS', [], None),
+        ("list hari ini", 'LIST_ORDERS', [], None),
+        ("cek order hal 2", 'LIST_ORDERS', [], 2),
+        ("cek order halaman 3", 'LIST_ORDERS', [], 3),
+    ]
+    # Messages that must reach the grammar / LLM
+    UNMATCHED = [
+        "Ok 15 tapi jamnya ganti",
+        "cek order 2",  # order 2, not page 2
+        "Bella pesan 2 brownies besok",
+        "batal pesan brownies",
+        "okey deh",
+    ]
+
+    def test_command_messages(self):
+        for text, intent, order_ids, page in self.MATCHED:
+            with self.subTest(text=text):
+                result = classify_intent(text)
+                self.assertEqual((result['intent'], result['order_ids'], result['page']), (intent, order_ids, page))
+                self.assertEqual(result['order_id'], order_ids[0] if order_ids else None)
+
+    def test_other_messages_fall_through(self):
+        for text in self.UNMATCHED:
+            with self.subTest(text=text):
+                self.assertIsNone(classify_intent(text))
+
+    @override_settings(ORDER_GRAMMAR_ENABLED=True, LLM_CACHE_ENABLED=False, LLM_STREAMING=False, LLM_BATCH_SIZE=1)
+    def test_only_llm_calls_count_as_fallthrough(self):
+        reset_rule_stats()
+        llm_answer = {'intent': 'NEW_ORDER', 'items': []}
+        with mock.patch.object(ai_service, 'parse_order_with_ai', return_value=llm_answer) as llm:
+            ai_service.parse_message("Ok 15")                                     # rules
+            ai_service.parse_message("Bella pesan 2 brownies 150rb besok jam 5")  # grammar
+            ai_service.parse_message("pesan nastar 2 risoles 3")                  # LLM
+        self.assertEqual(llm.call_count, 1)
+        stats = get_rule_stats()
+        self.assertEqual((stats['total'], stats['fallthrough']), (3, 1))
+        self.assertAlmostEqual(stats['hit_rate'], 2 / 3)
+
+
+class OrderDeleteCalendarTests(TestCase):
+    def setUp(self):
+        self.customer = Customer.objects.create(chat_id='test-1', platform='TG', name='Ani')
+
+    def _order(self, status, calendar_event_id=None):
+        order = Order.objects.create(customer=self.customer, item_description='brownies', status=status,
+                                     due_date=NOW, calendar_event_id=calendar_event_id)
+        CalendarSyncTask.objects.all().delete()  # what the save queued: already synced
+        return order
+
+    def test_orders_that_never_got_an_event_queue_nothing(self):
+        for status in ('PENDING', 'CONFIRMED', 'CANCELLED'):
+            with self.subTest(status=status):
+                self._order(status).delete()
+                self.assertFalse(CalendarSyncTask.objects.exists())
+
+    def test_customer_cascade_deletes_only_existing_events(self):
+        self._order('CONFIRMED')
+        synced = self._order('CONFIRMED', calendar_event_id='order42')
+        self.customer.delete()
+        self.assertEqual(
+            list(CalendarSyncTask.objects.values_list('order_id', 'action', 'event_id')),
+            [(synced.id, 'delete', 'order42')],
+        )
+
+    def test_insert_in_flight_is_deleted_by_its_deterministic_id(self):
+        order = Order.objects.create(customer=self.customer, item_description='kue', status='CONFIRMED', due_date=NOW)
+        expected = (order.id, calendar_event_id_for(order))
+        order.delete()  # the queued create may already have reached Google
+        delete = CalendarSyncTask.objects.get(action='delete')
+        self.assertEqual((delete.order_id, delete.event_id), expected)
+
+
+@override_settings(ORDER_WORKER_RETRY_BASE_SECONDS=30, ORDER_WORKER_MAX_ATTEMPTS=5)
+class MessageQueueOrderTests(TestCase):
+    def setUp(self):
+        self.customer = Customer.objects.create(chat_id='test-1', platform='TG', name='Ani')
+        self.order_msg = RawMessage.objects.create(customer=self.customer, text='Pesan brownies 1 besok')
+        self.confirm_msg = RawMessage.objects.create(customer=self.customer, text='Ok 15')
+
+    def _claimed_ids(self, limit=10):
+        return [msg.id for msg in claim_messages(limit=limit)]
+
+    def test_leased_message_holds_back_the_rest_of_its_chat(self):
+        other = RawMessage.objects.create(
+            customer=Customer.objects.create(chat_id='test-2', platform='TG'), text='Halo')
+        self.assertEqual(self._claimed_ids(limit=1), [self.order_msg.id])
+        # Another worker polling now must not run "Ok 15" ahead of the order
+        self.assertEqual(self._claimed_ids(), [other.id])
+
+    def test_failed_message_is_retried_before_the_next_one(self):
+        order_msg, confirm_msg = claim_messages(limit=10)
+        self.assertFalse(mark_failed(order_msg, RuntimeError('LLM down')))
+        release_messages([confirm_msg])
+        self.assertEqual(self._claimed_ids(), [])  # waiting for the retry, in order
+
+        RawMessage.objects.filter(id=order_msg.id).update(locked_until=timezone.now())  # backoff over
+        self.assertEqual(self._claimed_ids(), [order_msg.id, confirm_msg.id])
+        confirm_msg.refresh_from_db()
+        self.assertEqual(confirm_msg.attempts, 1)  # the release didn't use up an attempt
+
+    def test_dead_letter_does_not_block_its_chat(self):
+        RawMessage.objects.filter(id=self.order_msg.id).update(is_dead_letter=True)
+        self.assertEqual(self._claimed_ids(), [self.confirm_msg.id])
+
+    def test_renew_leases_skips_rows_changed_since(self):
+        order_msg, confirm_msg = claim_messages(limit=10)
+        mark_failed(order_msg, RuntimeError('LLM down'))
+        backoff = RawMessage.objects.get(id=order_msg.id).locked_until
+        renewed = renew_leases({order_msg.id: confirm_msg.locked_until, confirm_msg.id: confirm_msg.locked_until})
+        self.assertEqual(list(renewed), [confirm_msg.id])
+        self.assertGreater(renewed[confirm_msg.id], confirm_msg.locked_until)
+        self.assertEqual(RawMessage.objects.get(id=order_msg.id).locked_until, backoff)
+
+    def test_worker_stops_the_chat_at_a_retryable_failure(self):
+        from orders.management.commands.process_messages import Command
+
+        handled = []
+
+        def handle(msg):
+            handled.append(msg.id)
+            raise RuntimeError('LLM down')
+
+        messages = claim_messages(limit=10)
+        with mock.patch('orders.management.commands.process_messages.handle_message', side_effect=handle), \
+                mock.patch('orders.management.commands.process_messages.traceback.print_exc'), \
+                mock.patch('orders.management.commands.process_messages.close_old_connections'), \
+                mock.patch('builtins.print'):
+            self.assertTrue(Command()._process_chat(messages))
+        self.assertEqual(handled, [self.order_msg.id])
+        self.assertIsNone(RawMessage.objects.get(id=self.confirm_msg.id).locked_until)
+
+
+class AsyncPipelineShutdownTests(TestCase):
+    def setUp(self):
+        customer = Customer.objects.create(chat_id='test-1', platform='TG', name='Ani')
+        self.raw_msg = RawMessage.objects.create(
+            customer=customer, text='Pesan brownies 1 besok', attempts=1,
+            locked_until=timezone.now() + timedelta(seconds=120),  # as the async webhook saves it
+        )
+
+    async def test_unfinished_messages_are_handed_back_to_the_worker(self):
+        async def stuck(raw_msg):
+            await asyncio.sleep(3600)  # e.g. a hanging LLM call
+
+        with mock.patch('orders.async_pipeline.ahandle_message', side_effect=stuck), \
+                mock.patch('orders.async_pipeline.close_old_connections'), mock.patch('builtins.print'):
+            task = schedule_message(self.raw_msg)
+            await asyncio.sleep(0)
+            self.assertEqual(await shutdown_pending_messages(timeout=0.01), 1)
+        self.assertTrue(task.cancelled())
+        await self.raw_msg.arefresh_from_db()
+        self.assertEqual((self.raw_msg.locked_until, self.raw_msg.attempts), (None, 0))
+
+
+class CalendarStubMixin:
+    """Points calendar_service at the Calendar stub (orders/stub_servers.py); a fresh calendar per test."""
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.stub = start_calendar_stub()
+        cls.addClassCleanup(cls.stub.server_close)
+        cls.addClassCleanup(cls.stub.shutdown)
+
+    def setUp(self):
+        super().setUp()
+        self.calendar = self.stub.calendar = FakeCalendar()
+        patcher = mock.patch.multiple(
+            calendar_service, CALENDAR_API_ROOT_URL=f'http://127.0.0.1:{self.stub.server_port}/',
+            SERVICE_ACCOUNT_FILE='missing-service-account.json',
+            _credentials=None, _discovery_doc=None, _local=threading.local(),
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        env = mock.patch.dict(os.environ, CALENDAR_ID='bakery')
+        env.start()
+        self.addCleanup(env.stop)
+        # One _execute_in_batches call is one HTTP request (changes <= BATCH_SIZE)
+        batches = mock.patch.object(calendar_service, '_execute_in_batches', wraps=calendar_service._execute_in_batches)
+        self.batches = batches.start()
+        self.addCleanup(batches.stop)
+
+
+EVENT_BODY = {'summary': 'Ani - brownies', 'start': {'dateTime': NOW.isoformat()},
+              'end': {'dateTime': (NOW + timedelta(hours=1)).isoformat()}}
+
+
+class CalendarBatchTests(CalendarStubMixin, SimpleTestCase):
+    def test_inserts_go_out_in_one_batch(self):
+        results = apply_calendar_changes([(key, 'insert', f'order{key}', EVENT_BODY) for key in (1, 2, 3)])
+        self.assertEqual(self.batches.call_count, 1)
+        self.assertEqual({key: result['event_id'] for key, result in results.items()},
+                         {1: 'order1', 2: 'order2', 3: 'order3'})
+        self.assertEqual(sorted(event['id'] for event in self.calendar.live_events), ['order1', 'order2', 'order3'])
+
+    def test_insert_of_an_existing_id_becomes_an_update(self):
+        apply_calendar_changes([(1, 'insert', 'order1', EVENT_BODY)])
+        apply_calendar_changes([(1, 'delete', 'order1', None)])  # kept by Google as 'cancelled'
+        self.batches.reset_mock()
+
+        renamed = dict(EVENT_BODY, summary='Ani - bolu')
+        results = apply_calendar_changes([(1, 'insert', 'order1', renamed)])
+        self.assertEqual(results[1], {'event_id': 'order1', 'error': None, 'status': None})
+        self.assertEqual(self.batches.call_count, 2)  # the insert (409), then the update
+        event = self.calendar.events['order1']
+        self.assertEqual((event['status'], event['summary']), ('confirmed', 'Ani - bolu'))
+
+    def test_deleting_a_missing_or_deleted_event_succeeds(self):
+        apply_calendar_changes([(1, 'insert', 'order1', EVENT_BODY)])
+        apply_calendar_changes([(1, 'delete', 'order1', None)])
+        results = apply_calendar_changes([(1, 'delete', 'order1', None), (2, 'delete', 'order2', None)])
+        self.assertEqual({key: (result['error'], result['status']) for key, result in results.items()},
+                         {1: (None, 410), 2: (None, 404)})
+
+
+class CalendarOutboxTests(CalendarStubMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.customer = Customer.objects.create(chat_id='test-1', platform='TG', name='Ani')
+
+    def test_tasks_of_one_order_become_one_calendar_call(self):
+        order = Order.objects.create(customer=self.customer, client_name='Ani', item_description='brownies',
+                                     status='CONFIRMED', due_date=NOW)
+        order.quantity = 3
+        order.save()
+        order.item_description = 'bolu'
+        order.save()
+        self.assertEqual(CalendarSyncTask.objects.filter(order_id=order.id).count(), 3)
+
+        self.assertEqual(drain_calendar_outbox(), 3)
+        self.assertEqual(self.batches.call_count, 1)
+        self.assertEqual([event['summary'] for event in self.calendar.live_events], ['Ani - bolu'])
+        order.refresh_from_db()
+        self.assertEqual(order.calendar_event_id, calendar_event_id_for(order))
+        self.assertFalse(CalendarSyncTask.objects.exists())
+
+
+class CustomerCacheTests(TestCase):
+    def setUp(self):
+        patcher = mock.patch.dict(customer_cache._local_cache, clear=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_rename_invalidates_the_cached_customer(self):
+        first = customer_cache.resolve_customer('test-1', 'Ani')
+        with self.assertNumQueries(0):  # in-process hit
+            self.assertEqual(customer_cache.resolve_customer('test-1', 'Ani'), first)
+
+        customer = Customer.objects.get(pk=first.pk)
+        customer.name = 'Bu Ani'
+        customer.save()  # e.g. edited in the Admin Panel
+
+        self.assertEqual(customer_cache.resolve_customer('test-1', 'Ani'), (first.pk, 'test-1', 'Bu Ani'))
+
+
+class AgendaCacheTests(TestCase):
+    def setUp(self):
+        self.customer = Customer.objects.create(chat_id='test-1', platform='TG', name='Ani')
+        with self.captureOnCommitCallbacks(execute=True):
+            self.order = Order.objects.create(customer=self.customer, client_name='Ani', item_description='brownies',
+                                              status='CONFIRMED', due_date=timezone.now() + timedelta(hours=2))
+
+    def test_order_save_starts_a_new_generation_and_page(self):
+        self.assertIn('brownies', get_agenda_page(self.customer.id))
+        # A change that bypasses the signals is not seen: the page comes from the cache
+        Order.objects.filter(id=self.order.id).update(item_description='bolu')
+        self.assertIn('brownies', get_agenda_page(self.customer.id))
+
+        generation = _current_generation(self.customer.id)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.order.item_description = 'bolu kukus'
+            self.order.save()
+        self.assertNotEqual(_current_generation(self.customer.id), generation)
+        self.assertIn('bolu kukus', get_agenda_page(self.customer.id))
+
+
+class CalendarReconcileTests(CalendarStubMixin, TestCase):
+    def test_expired_sync_token_falls_back_to_a_full_listing(self):
+        customer = Customer.objects.create(chat_id='test-1', platform='TG', name='Ani')
+        order = Order.objects.create(customer=customer, client_name='Ani', item_description='brownies',
+                                     status='CONFIRMED', due_date=NOW)
+        drain_calendar_outbox()
+        self.calendar.handle('DELETE', f'/calendars/bakery/events/{calendar_event_id_for(order)}', b'')  # by hand
+        key = SYNC_TOKEN_KEY.format('bakery')
+        set_sync_state(key, 'expired-token')  # the stub answers 410 Gone
+
+        with mock.patch('builtins.print'):
+            counts = reconcile_calendar()
+
+        self.assertEqual(self.calendar.list_calls, 2)  # the rejected incremental listing, then the full one
+        self.assertEqual((counts['full_listing'], counts['restored']), (1, 1))
+        self.assertEqual(list(CalendarSyncTask.objects.values_list('order_id', 'action')), [(order.id, 'update')])
+        self.assertEqual(get_sync_state(key), str(self.calendar.version))
+        self.assertEqual(reconcile_calendar()['full_listing'], 0)  # the stored token is accepted
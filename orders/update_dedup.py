@@ -0,0 +1,118 @@
+import threading
+import time
+from collections import OrderedDict
+from django.conf import settings
+from django.db import connection, transaction
+from django.utils import timezone
+from .models import TelegramUpdate
+from prometheus_client import Counter
+
+# Telegram redelivers an update when the webhook answers too slowly, so the same
+# update_id can arrive more than once. Duplicates are dropped before any real work:
+#   1. in-process seen-set with a TTL (no query for a redelivery to the same process)
+#   2. the TelegramUpdate primary key, claimed in the same transaction as the RawMessage
+
+duplicate_updates = Counter(
+    'orders_duplicate_updates_total',
+    "Redelivered Telegram updates dropped before processing, by where they were caught.",
+    ['layer'],
+)
+
+
+class SeenUpdates:
+    """Bounded update_id set whose entries expire after `ttl_seconds`."""
+
+    def __init__(self, max_entries, ttl_seconds):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._entries = OrderedDict()  # update_id -> expires_at (monotonic)
+        self._lock = threading.Lock()
+
+    def __contains__(self, update_id):
+        now = time.monotonic()
+        with self._lock:
+            expires_at = self._entries.get(update_id)
+            if expires_at is None:
+                return False
+            if expires_at <= now:
+                del self._entries[update_id]
+                return False
+            return True
+
+    def add(self, update_id):
+        with self._lock:
+            self._entries[update_id] = time.monotonic() + self.ttl_seconds
+            self._entries.move_to_end(update_id)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+seen_updates = SeenUpdates(
+    max_entries=settings.TELEGRAM_DEDUP_MAX_ENTRIES,
+    ttl_seconds=settings.TELEGRAM_DEDUP_TTL_SECONDS,
+)
+
+
+def update_id_of(data):
+    """The update_id of a Telegram update as an int, or None if it has none."""
+    try:
+        return int(data.get('update_id'))
+    except (TypeError, ValueError):
+        return None
+
+
+def seen_recently(update_id):
+    """Fast path: True if this process accepted the update moments ago."""
+    if update_id is not None and update_id in seen_updates:
+        duplicate_updates.labels(layer='memory').inc()
+        return True
+    return False
+
+
+def claim_updates(update_ids):
+    """
+    Records update_ids as accepted and returns the set of those that were new; the
+    rest are redeliveries. One INSERT ... ON CONFLICT DO NOTHING for the whole batch,
+    no savepoint. Call it inside the transaction that saves the RawMessages, so a
+    failed save releases the claims.
+    """
+    update_ids = list(dict.fromkeys(update_ids))
+    if not update_ids:
+        return set()
+
+    now = timezone.now()
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f'INSERT INTO "{TelegramUpdate._meta.db_table}" (update_id, received_at) '
+            f'VALUES {", ".join(["(%s, %s)"] * len(update_ids))} '
+            'ON CONFLICT DO NOTHING RETURNING update_id',
+            [value for update_id in update_ids for value in (update_id, now)],
+        )
+        claimed = {row[0] for row in cursor.fetchall()}
+
+    def remember_claimed():
+        for update_id in claimed:
+            seen_updates.add(update_id)
+
+    # Only remember new ids once they're committed: a rolled-back save must not block the retry
+    transaction.on_commit(remember_claimed)
+    for update_id in update_ids:
+        if update_id not in claimed:
+            seen_updates.add(update_id)
+            duplicate_updates.labels(layer='db').inc()
+    return claimed
+
+
+def claim_update(update_id):
+    """Single-update claim_updates(). Returns False for a redelivery."""
+    return update_id in claim_updates([update_id])
+
+
+def prune_updates(older_than):
+    """Deletes TelegramUpdate rows received before `older_than`. Returns the count."""
+    deleted, _ = TelegramUpdate.objects.filter(received_at__lt=older_than).delete()
+    return deleted
@@ -3,4 +3,6 @@ from . import views
 
 urlpatterns = [
     path('webhooks/telegram/', views.telegram_webhook, name='telegram_webhook'),
+    path('webhooks/telegram/async/', views.telegram_webhook_async, name='telegram_webhook_async'),
+    path('metrics/', views.metrics, name='metrics'),
 ]
\ No newline at end of file